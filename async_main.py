@@ -0,0 +1,485 @@
+import os
+import json
+import asyncio
+
+from aiohttp import web
+
+from elastic_search_wrapper import ElasticSearchWrapper, AsyncElasticSearchWrapper, close_shared_async_client, retry_after
+from payload_wrapper import PayloadWrapper
+import response_pipeline
+import metrics
+import index_versions
+import search_queries
+from source_fields import AIS_FIELDS, TLE_FIELDS, SENTENCE_FIELDS, source_filter, with_field
+from hit_jobs import hit_jobs
+
+# asyncio serving mode for the vault (main.py) and valuesearch (la_main.py)
+# APIs: the same routes and PayloadWrapper envelopes, but Elasticsearch is
+# called through the async client, so each worker keeps serving requests
+# while others wait on the cluster.
+#
+#   python async_main.py
+#   gunicorn async_main:app --bind 0.0.0.0:8000 --worker-class aiohttp.GunicornWebWorker --workers 2
+#
+# https://docs.aiohttp.org/en/stable/web_quickstart.html
+# https://docs.aiohttp.org/en/stable/deployment.html#start-gunicorn
+# https://elasticsearch-py.readthedocs.io/en/7.x/async.html
+
+VAULT = '/vault/api/v1'
+VALUESEARCH = '/valuesearch/api/v1'
+
+routes = web.RouteTableDef()
+
+
+def reply(res, status, pw, headers=None):
+    body = response_pipeline.dumps(res)
+    response = web.Response(body=body, status=status, headers=headers or pw.headers())
+    if len(body) >= response_pipeline.MIN_SIZE:
+        # gzip/deflate (br with brotli installed) as the request's Accept-Encoding allows
+        response.enable_compression()
+    return response
+
+
+def failed(pw, message):
+    """ 400 reply for message, 503 with Retry-After when Elasticsearch is unavailable """
+    res, status, headers = pw.failure(message, retry_after(message))
+    return reply(res, status, pw, headers)
+
+
+async def search(indexName, queryBody):
+    pw = PayloadWrapper()
+    try:
+        es = AsyncElasticSearchWrapper()
+        hits = await es.search(indexName, queryBody)
+        res = pw.success(hits)
+        return reply(res, 200, pw)
+
+    except Exception as message:
+        print(message)
+        return failed(pw, message)
+
+
+async def batch(request, indexName, lookups, default_fields):
+    """ Batch lookup with one _msearch, results keyed by input, see /ships/batch in main.py """
+    pw = PayloadWrapper()
+    try:
+        args = await request.json()
+        keys, queries = search_queries.batch({kind: (args.get(kind), builder) for kind, builder in lookups.items()},
+                                             source_filter(request.query.get('fields'), default_fields))
+        es = AsyncElasticSearchWrapper()
+        hits = await es.msearch(indexName, queries)
+        res = pw.success([search_queries.keyed(keys, hits)])
+        return reply(res, 200, pw)
+
+    except Exception as message:
+        print(message)
+        return failed(pw, message)
+
+
+async def histogram(request, indices, filters, time_field, id_field):
+    """ Activity histogram, see /ships/histogram in main.py """
+    pw = PayloadWrapper()
+    try:
+        indexName = search_queries.index_arg(request.query, indices)
+        queryBody = search_queries.activity_histogram(request.query, filters(request.query), time_field, id_field)
+        es = AsyncElasticSearchWrapper()
+        aggregations = await es.aggregate(indexName, queryBody)
+        res = pw.success(search_queries.histogram_buckets(aggregations))
+        return reply(res, 200, pw)
+
+    except Exception as message:
+        print(message)
+        return failed(pw, message)
+
+
+async def sentence_page(request, queryBody):
+    pw = PayloadWrapper()
+    try:
+        es = AsyncElasticSearchWrapper()
+        source = queryBody['_source']
+        withContext = request.query.get('with_context') == 'true'
+        # the paragraph of a hit is found by its context
+        queryBody['_source'] = with_field(source, 'context') if withContext else source
+        queryBody = search_queries.sentence_page(queryBody, request.query)
+        hits, total = await es.search_page('la-sentence', queryBody)
+        if withContext:
+            keys, results = list(), list()
+            for batchKeys, queries in search_queries.context_batches(hits, source):
+                keys.extend(batchKeys)
+                results.extend(await es.msearch('la-sentence', queries))
+            hits = search_queries.with_paragraphs(hits, keys, results)
+        res = pw.success(hits)
+        res['total'] = total
+        res['cursor'] = search_queries.page_cursor(hits, queryBody)
+        return reply(res, 200, pw)
+
+    except Exception as message:
+        print(message)
+        return failed(pw, message)
+
+
+async def stream_hits(request, indexName, queryBody, sort, tiebreaker=()):
+    """ NDJSON stream of every hit of a query, see stream_hits() in main.py """
+    pw = PayloadWrapper()
+    try:
+        pageSize = min(int(request.query.get('page_size', 1000)), 10000)
+        after = request.query.get('after')
+        if after is not None:
+            after = json.loads(after)
+    except Exception as message:
+        return failed(pw, message)
+
+    es = AsyncElasticSearchWrapper()
+    headers = pw.headers()
+    headers['Content-Type'] = 'application/x-ndjson'
+    response = web.StreamResponse(headers=headers)
+    await response.prepare(request)
+    try:
+        async for hit in es.stream(indexName, queryBody, sort, page_size=pageSize, search_after=after, tiebreaker=tiebreaker):
+            await response.write(response_pipeline.dumps(hit) + b'\n')
+    except Exception as message:
+        # the status line has gone out already, so report the error in-band
+        print(message)
+        await response.write(response_pipeline.dumps(pw.error(message)) + b'\n')
+    await response.write_eof()
+    return response
+
+
+async def blocking(function, *args):
+    """ Run a synchronous call (index writes, hit jobs) on the default thread pool """
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+
+@routes.route('OPTIONS', '/{tail:.*}')
+async def options(request):
+    pw = PayloadWrapper()
+    return reply("OK", 200, pw)
+
+
+@routes.get(VAULT + '/')
+@routes.get(VALUESEARCH + '/')
+async def about(request):
+    pw = PayloadWrapper()
+    res = pw.success()
+    return reply(res, 200, pw)
+
+
+@routes.get(VAULT + '/ping')
+async def ping(request):
+    pw = PayloadWrapper()
+    res = pw.success([], "OK")
+    return reply(res, 200, pw)
+
+
+@routes.get(VALUESEARCH + '/healthcheck')
+async def healthcheck(request):
+    pw = PayloadWrapper()
+    res = pw.success([], "healthcheck")
+    return reply(res, 200, pw)
+
+
+@routes.get(VAULT + '/smoketest')
+@routes.get(VALUESEARCH + '/smoketest')
+async def smoketest(request):
+    pw = PayloadWrapper()
+    try:
+        es = ElasticSearchWrapper()
+        hits, extra = await blocking(es.smoketest)
+        res = pw.success(hits, extra)
+        return reply(res, 200, pw)
+
+    except Exception as message:
+        return failed(pw, message)
+
+
+@routes.get(VAULT + '/stats/{indexName}')
+@routes.get(VALUESEARCH + '/stats/{indexName}')
+async def stats(request):
+    pw = PayloadWrapper()
+    try:
+        es = AsyncElasticSearchWrapper()
+        if request.query.get('full') == 'true':
+            hits = await es.stats(request.match_info['indexName'])
+            res = pw.success([hits])
+            return reply(res, 200, pw)
+
+        version = await es.index_version(request.match_info['indexName'])
+        unchanged, validators = index_versions.conditional(request.headers, version)
+        headers = dict(pw.headers(), **validators)
+        if unchanged:
+            return web.Response(status=304, headers=headers)
+
+        res = pw.success([version['summary']])
+        return reply(res, 200, pw, headers)
+
+    except Exception as message:
+        return failed(pw, message)
+
+
+@routes.get(VAULT + '/cache')
+@routes.get(VALUESEARCH + '/cache')
+async def cache_stats(request):
+    pw = PayloadWrapper()
+    es = AsyncElasticSearchWrapper()
+    res = pw.success([es.cache_stats()])
+    return reply(res, 200, pw)
+
+
+## vault
+
+@routes.get(VAULT + '/ships')
+async def all_ships(request):
+    queryBody = search_queries.all_ships()
+    queryBody['_source'] = source_filter(request.query.get('fields'), AIS_FIELDS)
+    return await search('ais', queryBody)
+
+
+@routes.get(VAULT + '/ships/stream')
+async def stream_ships(request):
+    queryBody = search_queries.ship_stream(request.query.get('vessel_name'))
+    queryBody['_source'] = source_filter(request.query.get('fields'), AIS_FIELDS)
+    return await stream_hits(request, 'ais', queryBody, [{"base_date_time": "asc"}], search_queries.AIS_TIEBREAKER)
+
+
+@routes.post(VAULT + '/ships/batch')
+async def batch_ships(request):
+    lookups = {'vessel_names': search_queries.ship, 'mmsis': search_queries.mmsi}
+    return await batch(request, 'ais', lookups, AIS_FIELDS)
+
+
+@routes.get(VAULT + '/ships/heatmap')
+async def ship_heatmap(request):
+    pw = PayloadWrapper()
+    try:
+        queryBody = search_queries.ship_heatmap(request.query)
+        es = AsyncElasticSearchWrapper()
+        aggregations = await es.aggregate('ais', queryBody)
+        res = pw.success(search_queries.heatmap_cells(aggregations))
+        return reply(res, 200, pw)
+
+    except Exception as message:
+        print(message)
+        return failed(pw, message)
+
+
+@routes.get(VAULT + '/ships/latest')
+async def latest_ships(request):
+    pw = PayloadWrapper()
+    try:
+        indexName = search_queries.index_arg(request.query, search_queries.AIS_INDICES)
+        queryBody = search_queries.latest_ships(request.query, source_filter(request.query.get('fields'), AIS_FIELDS))
+        es = AsyncElasticSearchWrapper()
+        aggregations = await es.aggregate(indexName, queryBody)
+        hits, cursor = search_queries.latest_hits(aggregations, queryBody)
+        res = pw.success(hits)
+        res['cursor'] = cursor
+        return reply(res, 200, pw)
+
+    except Exception as message:
+        print(message)
+        return failed(pw, message)
+
+
+@routes.get(VAULT + '/ships/histogram')
+async def ship_histogram(request):
+    return await histogram(request, search_queries.AIS_INDICES, search_queries.ais_filters, 'base_date_time', search_queries.MMSI_FIELD)
+
+
+@routes.get(VAULT + '/ship/{vessel_name}')
+async def ship(request):
+    queryBody = search_queries.ship(request.match_info['vessel_name'])
+    queryBody['_source'] = source_filter(request.query.get('fields'), AIS_FIELDS)
+    return await search('ais', queryBody)
+
+
+@routes.get(VAULT + '/satellites')
+async def all_satellites(request):
+    queryBody = search_queries.all_satellites()
+    queryBody['_source'] = source_filter(request.query.get('fields'), TLE_FIELDS)
+    pw = PayloadWrapper()
+    try:
+        es = AsyncElasticSearchWrapper()
+        # the catalog only changes when tle is written: answer 304 without searching
+        # the body is searched (or cached) for the same version the ETag is made from
+        version = await es.index_version('tle')
+        unchanged, validators = index_versions.conditional(request.headers, version, queryBody)
+        headers = dict(pw.headers(), **validators)
+        if unchanged:
+            return web.Response(status=304, headers=headers)
+
+        hits = await es.search('tle', queryBody, version)
+        res = pw.success(hits)
+        return reply(res, 200, pw, headers)
+
+    except Exception as message:
+        print(message)
+        return failed(pw, message)
+
+
+@routes.get(VAULT + '/satellites/histogram')
+async def satellite_histogram(request):
+    return await histogram(request, search_queries.TLE_INDICES, search_queries.tle_filters, 'timestamp', 'satellite_number')
+
+
+@routes.post(VAULT + '/satellites/batch')
+async def batch_satellites(request):
+    lookups = {'designators': search_queries.satellite}
+    return await batch(request, 'tle', lookups, TLE_FIELDS)
+
+
+# registered before /satellites/{designator} so that 'stream' is not taken as a designator
+@routes.get(VAULT + '/satellites/stream')
+async def stream_satellites(request):
+    queryBody = search_queries.satellite_stream(request.query.get('designator'))
+    queryBody['_source'] = source_filter(request.query.get('fields'), TLE_FIELDS)
+    return await stream_hits(request, 'tle', queryBody, [{"timestamp": "asc"}], search_queries.TLE_TIEBREAKER)
+
+
+@routes.get(VAULT + '/satellites/{designator}')
+async def satellite(request):
+    queryBody = search_queries.satellite(request.match_info['designator'])
+    queryBody['_source'] = source_filter(request.query.get('fields'), TLE_FIELDS)
+    return await search('tle', queryBody)
+
+
+@routes.post(VAULT + '/hits')
+async def submit_hits(request):
+    pw = PayloadWrapper()
+    try:
+        params = await request.json()
+        job = await blocking(hit_jobs.submit, params)
+        res = pw.pending([job], 'submitted')
+        return reply(res, 202, pw)
+
+    except Exception as message:
+        print(message)
+        return failed(pw, message)
+
+
+@routes.get(VAULT + '/hits/cache')
+async def hit_cache_stats(request):
+    pw = PayloadWrapper()
+    res = pw.success([await blocking(hit_jobs.cache_stats)])
+    return reply(res, 200, pw)
+
+
+@routes.get(VAULT + '/hits/{job_id}')
+async def hit_results(request):
+    pw = PayloadWrapper()
+    job_id = request.match_info['job_id']
+
+    job = hit_jobs.summary(job_id)
+    if job is None:
+        res = pw.error('no such job {}'.format(job_id))
+        return reply(res, 404, pw)
+
+    if job['status'] in ('pending', 'running'):
+        res = pw.pending([job], job['status'])
+        return reply(res, 202, pw)
+
+    try:
+        hits = hit_jobs.result(job_id)
+        res = pw.success(hits, job_id)
+        return reply(res, 200, pw)
+
+    except Exception as message:
+        print(message)
+        return failed(pw, message)
+
+
+## valuesearch
+
+@routes.get(VALUESEARCH + '/case/{caseid}')
+async def case(request):
+    queryBody = search_queries.case(request.match_info['caseid'])
+    queryBody['_source'] = source_filter(request.query.get('fields'))
+    return await search('la-document', queryBody)
+
+
+@routes.post(VALUESEARCH + '/query')
+async def query_sentence(request):
+    pw = PayloadWrapper()
+    try:
+        args = await request.json()
+        queryBody = search_queries.compound_sentences(args.get('rhetclass'), args.get('includeany'), args.get('includeall'),
+                                                      args.get('exactphrase'), args.get('excludeany'))
+    except Exception as message:
+        return failed(pw, message)
+
+    queryBody['_source'] = source_filter(request.query.get('fields'), SENTENCE_FIELDS)
+    return await sentence_page(request, queryBody)
+
+
+@routes.post(VALUESEARCH + '/search')
+async def search_sentence(request):
+    pw = PayloadWrapper()
+    try:
+        args = await request.json()
+        queryBody = search_queries.simple_sentences(args.get('rhetclass'), args.get('text'), args.get('queryrule'))
+    except Exception as message:
+        return failed(pw, message)
+
+    queryBody['_source'] = source_filter(request.query.get('fields'), SENTENCE_FIELDS)
+    return await sentence_page(request, queryBody)
+
+
+@routes.post(VALUESEARCH + '/contexts')
+async def batch_contexts(request):
+    lookups = {'contexts': search_queries.context_sentences}
+    return await batch(request, 'la-sentence', lookups, SENTENCE_FIELDS)
+
+
+@routes.get(VALUESEARCH + '/context/{context}')
+async def sentences_with_context(request):
+    queryBody = search_queries.context_sentences(request.match_info['context'])
+    queryBody['_source'] = source_filter(request.query.get('fields'), SENTENCE_FIELDS)
+    return await search('la-sentence', queryBody)
+
+
+async def close_client(app):
+    await close_shared_async_client()
+
+
+@web.middleware
+async def record_metrics(request, handler):
+    """ Request metrics, as metrics.instrument() records them for the Flask apps """
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else 'unmatched'
+    started = metrics.request_started('async', route)
+    status = 500
+    size = None
+    try:
+        response = await handler(request)
+        status = response.status
+        if isinstance(response, web.Response) and isinstance(response.body, bytes):
+            size = len(response.body)
+        return response
+    except web.HTTPException as error:
+        status = error.status
+        raise
+    finally:
+        metrics.request_finished('async', route, request.method, status, started, size)
+
+
+@routes.get('/metrics')
+async def serve_metrics(request):
+    return web.Response(body=metrics.render().encode('utf-8'), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+def create_app():
+    app = web.Application(middlewares=[record_metrics])
+    app.add_routes(routes)
+    app.on_cleanup.append(close_client)
+    return app
+
+
+app = create_app()
+
+
+def startup():
+    web.run_app(app, port=int(os.environ.get('LISTEN_PORT', 8000)))
+
+
+
+if __name__ == '__main__':
+    startup()
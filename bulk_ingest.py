@@ -0,0 +1,188 @@
+import os
+import csv
+import sys
+import json
+import time
+import argparse
+import itertools
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from elastic_search_wrapper import ElasticSearchWrapper
+
+# Bulk loading of AIS/TLE (or any) documents from CSV, JSON and NDJSON files.
+#
+#   python bulk_ingest.py ais ais_2015_01.csv ais_2015_02.csv --id-field id --threads 4 --chunk-size 2000
+#
+# https://www.elastic.co/guide/en/elasticsearch/reference/7.x/tune-for-indexing-speed.html
+# https://elasticsearch-py.readthedocs.io/en/7.x/helpers.html#bulk-helpers
+
+
+def read_csv(path):
+    """ Rows of a CSV file with a header line, as dicts, read a line at a time """
+    with open(path, newline='') as file:
+        for row in csv.DictReader(file):
+            yield row
+
+
+def read_ndjson(path):
+    """ Documents of a file with one JSON document per line """
+    with open(path) as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_json(path):
+    """ Documents of a JSON file: a list of documents, a PayloadWrapper
+        envelope or search response (the _source of each hit) or a single
+        document. The file is parsed whole; use NDJSON for large sources.
+    """
+    with open(path) as file:
+        data = json.load(file)
+    if isinstance(data, dict) and isinstance(data.get('payload'), list):
+        data = data['payload']
+    elif isinstance(data, dict) and isinstance(data.get('hits'), dict):
+        data = data['hits']['hits']
+    if not isinstance(data, list):
+        data = [data]
+    for document in data:
+        if isinstance(document, dict) and '_source' in document:
+            yield document['_source']
+        else:
+            yield document
+
+
+READERS = {
+    '.csv': read_csv,
+    '.json': read_json,
+    '.ndjson': read_ndjson,
+    '.jsonl': read_ndjson,
+}
+
+
+def read_documents(paths):
+    """ Documents of every file in paths, chosen by extension, lazily """
+    for path in paths:
+        extension = os.path.splitext(path)[1].lower()
+        if extension not in READERS:
+            raise ValueError("can't read {}: expected one of {}".format(path, ', '.join(READERS)))
+        yield from READERS[extension](path)
+
+
+def actions(documents, id_field=None):
+    """ Bulk actions for documents, with _id taken from id_field if given.
+        Documents that are already actions ({'_id': ..., '_source': ...}) pass through.
+    """
+    for document in documents:
+        if '_source' in document:
+            yield document
+            continue
+        action = {'_source': document}
+        if id_field is not None:
+            action['_id'] = document[id_field]
+        yield action
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+@contextlib.contextmanager
+def loading(es, index, replicas=0):
+    """ Turn off refreshes and replicas of index while documents are loaded,
+        then restore the previous settings and refresh it once
+    """
+    settings = es.index_settings(index)
+    previous = {
+        # None resets a setting to its default
+        'refresh_interval': settings.get('refresh_interval'),
+        'number_of_replicas': settings.get('number_of_replicas'),
+    }
+    es.put_index_settings(index, {'refresh_interval': '-1', 'number_of_replicas': replicas})
+    try:
+        yield
+    finally:
+        es.put_index_settings(index, previous)
+        es.refresh(index)
+
+
+def ingest(es, index, documents, id_field=None, threads=4, chunk_size=1000,
+           max_retries=3, tune_index=True, report_every=10.0):
+    """ Index documents with `threads` concurrent _bulk requests of
+        `chunk_size` documents. Documents are read lazily: at most
+        2 * threads chunks are held in memory.
+        Inputs:
+            es [ElasticSearchWrapper]: Connection
+            index [str]: Target index, which should exist
+            documents [iterable]: Documents (dicts)
+            id_field [str]: Document field used as _id (ES generates ids if None)
+            threads [int]: Concurrent bulk requests
+            chunk_size [int]: Documents per bulk request
+            max_retries [int]: Retries of documents rejected with 429
+            tune_index [bool]: Turn off refreshes and replicas while loading, see loading()
+            report_every [float]: Seconds between progress lines
+        Output:
+            report [dict]: indexed, failed, seconds, docs_per_sec and the first errors
+    """
+    report = {'index': index, 'indexed': 0, 'failed': 0, 'errors': []}
+    start = time.monotonic()
+    reported = start
+
+    def collect(future):
+        indexed, errors = future.result()
+        report['indexed'] += indexed
+        report['failed'] += len(errors)
+        report['errors'].extend(errors[:10 - len(report['errors'])])
+
+    with (loading(es, index) if tune_index else contextlib.nullcontext()):
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            pending = set()
+            for chunk in chunks(actions(documents, id_field), chunk_size):
+                if len(pending) >= 2 * threads:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        collect(future)
+                pending.add(executor.submit(es.bulk, index, chunk, max_retries))
+
+                if time.monotonic() - reported >= report_every:
+                    reported = time.monotonic()
+                    print("{}: {} indexed, {:.0f} docs/sec".format(index, report['indexed'], report['indexed'] / (reported - start)))
+            for future in pending:
+                collect(future)
+
+    report['seconds'] = time.monotonic() - start
+    report['docs_per_sec'] = report['indexed'] / report['seconds'] if report['seconds'] > 0 else 0.0
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Bulk load CSV/JSON/NDJSON files into an Elasticsearch index')
+    parser.add_argument('index')
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--id-field', default=None, help='document field to use as _id')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--max-retries', type=int, default=3)
+    parser.add_argument('--create', action='store_true', help='create the index if it does not exist')
+    parser.add_argument('--keep-settings', action='store_true', help='leave refresh and replicas on while loading')
+    args = parser.parse_args(argv)
+
+    es = ElasticSearchWrapper()
+    if args.create:
+        es.create_index(args.index)
+
+    report = ingest(es, args.index, read_documents(args.paths), id_field=args.id_field,
+                    threads=args.threads, chunk_size=args.chunk_size, max_retries=args.max_retries,
+                    tune_index=not args.keep_settings)
+    print(json.dumps(report, indent=2, default=str))
+    return 1 if report['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,251 @@
+import collections
+
+import numpy as np
+import pandas as pd
+import skyfield.api as sf
+from skyfield.constants import AU_KM, DAY_S
+from skyfield.positionlib import Geocentric
+from skyfield.sgp4lib import TEME
+
+
+def hermite(t, t0, t1, p0, v0, p1, v1):
+    """ Cubic Hermite interpolation of position and velocity between two
+        samples.
+        Inputs:
+            t [float or numpy.ndarray]: Time(s) to interpolate at
+            t0, t1 [float or numpy.ndarray]: Times of the bracketing samples
+            p0, v0 [numpy.ndarray]: Position and velocity at t0, shape (3,) or (3,N)
+            p1, v1 [numpy.ndarray]: Position and velocity at t1, shape (3,) or (3,N)
+        Outputs:
+            p [numpy.ndarray]: Interpolated position
+            v [numpy.ndarray]: Interpolated velocity (position units per time unit)
+    """
+    h = t1 - t0
+    s = (t - t0) / h
+    s2 = s*s
+    s3 = s2*s
+    p = ((2*s3 - 3*s2 + 1)*p0 + (s3 - 2*s2 + s)*h*v0 +
+         (-2*s3 + 3*s2)*p1 + (s3 - s2)*h*v1)
+    v = ((6*s2 - 6*s)*p0 + (3*s2 - 4*s + 1)*h*v0 +
+         (-6*s2 + 6*s)*p1 + (3*s2 - 2*s)*h*v1) / h
+    return p, v
+
+
+class EphemerisCache:
+    """ Interpolating ephemeris cache for the satellites in a TLE dataframe.
+
+        The first query for a satellite propagates it with SGP4 once, on a
+        time grid covering the validity window [tmin, tmax]. Each TLE is used
+        for the part of the window where it is the closest TLE (matching
+        find_closest_tle() in vault.py), so the grid is split into one
+        segment per TLE. Raw SGP4 (TEME) positions and velocities are kept
+        in compact numpy arrays; a query interpolates them with a cubic
+        Hermite polynomial and rotates the result to GCRS for the query time
+        only, so the Earth orientation is never computed for grid points.
+
+        The grid starts at `step_minutes` and is halved (up to
+        `max_refinements` times) until the interpolation error, checked
+        against SGP4 a quarter and three quarters of the way into every
+        interval, is below half of `tolerance_km`, which leaves a margin
+        for the points in between.
+
+        Up to `max_satellites` satellites are kept; the least recently used
+        satellite is evicted when that is exceeded. Queries outside the
+        validity window fall back to propagating the closest TLE directly.
+    """
+
+    def __init__(self, tle_df, ts, tmin, tmax, tolerance_km=0.01,
+                 step_minutes=10.0, max_refinements=8, max_satellites=256,
+                 satellite_id_field='satellite_number', time_field='timestamp'):
+        self.ts = ts
+        self.tolerance_km = tolerance_km
+        self.step_minutes = step_minutes
+        self.max_refinements = max_refinements
+        self.max_satellites = max_satellites
+        self.satellite_id_field = satellite_id_field
+        self.time_field = time_field
+        tmin, tmax = [pd.Timestamp(x) for x in (tmin, tmax)]
+        tmin, tmax = [x.tz_localize('UTC') if x.tzinfo is None else x for x in (tmin, tmax)]
+        # Grid times are UTC days since the midnight before tmin, which keeps
+        # them small enough to hold sub-millisecond precision as floats
+        self.t_ref = tmin.floor('D')
+        self.jd_ref = self.t_ref.to_julian_date()
+        self.day_min = self.days(tmin)
+        self.day_max = self.days(tmax)
+        self.tle_df = tle_df
+        self.__ephemerides = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+        self.evictions = 0
+
+
+    def days(self, t):
+        """ UTC days between the reference time and pd.Timestamp(s) t """
+        return (t - self.t_ref) / pd.Timedelta(days=1)
+
+    def set_tle_data(self, tle_df, sids=None):
+        """ Replace the TLE dataframe, dropping the cached ephemerides of
+            `sids` (or of every satellite if `sids` is None)
+        """
+        self.tle_df = tle_df
+        self.invalidate(sids)
+
+    def invalidate(self, sids=None):
+        if sids is None:
+            self.__ephemerides.clear()
+        else:
+            for sid in sids:
+                self.__ephemerides.pop(sid, None)
+
+
+    def __satellite_tles(self, sid):
+        sat_df = self.tle_df[self.tle_df[self.satellite_id_field] == sid]
+        sat_df = sat_df.sort_values(self.time_field, kind='mergesort')
+        sat_df = sat_df.drop_duplicates(self.time_field, keep='first')
+        if len(sat_df) == 0:
+            raise LookupError("No TLE data loaded for satellite {}".format(sid))
+        return sat_df
+
+    def __propagate(self, satellite, days):
+        """ TEME position (km) and velocity (km/day) from SGP4, each of shape (3,N) """
+        jd = np.full(len(days), self.jd_ref)
+        _, position, velocity = satellite.model.sgp4_array(jd, days)
+        return position.T, velocity.T * DAY_S
+
+    def __segment(self, satellite, day_lo, day_hi):
+        """ Sample one TLE over [day_lo, day_hi], refining the grid until the
+            interpolation error is within tolerance
+        """
+        step = self.step_minutes / 1440.0
+        n = max(1, int(np.ceil((day_hi - day_lo) / step)))
+        grid = np.linspace(day_lo, day_hi, n + 1)
+        position, velocity = self.__propagate(satellite, grid)
+        for _ in range(self.max_refinements):
+            # SGP4 velocities are not exactly the derivative of SGP4
+            # positions; that part of the error cancels at the midpoints, so
+            # check a quarter and three quarters of the way into each
+            # interval instead, where the error is largest
+            check_error = 0.0
+            for fraction in (0.25, 0.75):
+                check = (1 - fraction) * grid[:-1] + fraction * grid[1:]
+                check_position, _ = self.__propagate(satellite, check)
+                estimate, _ = hermite(check, grid[:-1], grid[1:],
+                                      position[:, :-1], velocity[:, :-1],
+                                      position[:, 1:], velocity[:, 1:])
+                check_error = max(check_error, np.linalg.norm(estimate - check_position, axis=0).max())
+            if check_error <= 0.5 * self.tolerance_km:
+                break
+            # Halve the step, reusing every sample already computed
+            mid = 0.5 * (grid[:-1] + grid[1:])
+            mid_position, mid_velocity = self.__propagate(satellite, mid)
+            grid = self.__interleave(grid, mid)
+            position = self.__interleave(position, mid_position)
+            velocity = self.__interleave(velocity, mid_velocity)
+        return {'days': grid,
+                'state': np.vstack([position, velocity]).T.copy()}
+
+    @staticmethod
+    def __interleave(samples, mid_samples):
+        """ Merge samples at the grid points with samples at the midpoints """
+        out = np.empty(samples.shape[:-1] + (samples.shape[-1] + mid_samples.shape[-1],))
+        out[..., 0::2] = samples
+        out[..., 1::2] = mid_samples
+        return out
+
+    def __build(self, sid):
+        sat_df = self.__satellite_tles(sid)
+        epochs = self.days(sat_df[self.time_field]).values
+        # A TLE is the closest one between the midpoints to its neighbours
+        bounds = np.concatenate([[-np.inf], 0.5 * (epochs[:-1] + epochs[1:]), [np.inf]])
+        segments = list()
+        for i, tle_text in enumerate(sat_df['text']):
+            day_lo = max(bounds[i], self.day_min)
+            day_hi = min(bounds[i+1], self.day_max)
+            if day_lo >= day_hi:
+                segments.append(None)
+                continue
+            tle_text = tle_text.split('\n')
+            satellite = sf.EarthSatellite(tle_text[0], tle_text[1], ts=self.ts)
+            segments.append(self.__segment(satellite, day_lo, day_hi))
+        return {'bounds': bounds,
+                'tle_times': list(sat_df[self.time_field]),
+                'tle_texts': list(sat_df['text']),
+                'segments': segments}
+
+    def __ephemeris(self, sid):
+        ephemeris = self.__ephemerides.get(sid)
+        if ephemeris is None:
+            self.misses += 1
+            ephemeris = self.__build(sid)
+            self.__ephemerides[sid] = ephemeris
+            while len(self.__ephemerides) > self.max_satellites:
+                self.__ephemerides.popitem(last=False)
+                self.evictions += 1
+        else:
+            self.hits += 1
+            self.__ephemerides.move_to_end(sid)
+        return ephemeris
+
+
+    def locate(self, sid, t, time=None):
+        """ Position of satellite `sid` at time t.
+            Inputs:
+                sid: Satellite ID
+                t [pd.Timestamp]: Time of interest (UTC)
+                time [skyfield.timelib.Time]: t converted with the cache's timescale (computed if not provided)
+            Output:
+                satellite [dict]: 'position' (skyfield Geocentric) and
+                                  'tle_time' (epoch of the TLE the position comes from)
+        """
+        if time is None:
+            time = self.ts.from_datetime(t.to_pydatetime())
+        ephemeris = self.__ephemeris(sid)
+        day = self.days(t)
+        # bounds[i] < day <= bounds[i+1] selects TLE i; ties go to the earlier TLE
+        i = int(np.searchsorted(ephemeris['bounds'], day, side='left')) - 1
+        i = min(max(i, 0), len(ephemeris['segments']) - 1)
+        tle_time = ephemeris['tle_times'][i]
+        segment = ephemeris['segments'][i]
+        if segment is None or day < segment['days'][0] or day > segment['days'][-1]:
+            # Outside the validity window: propagate the TLE directly
+            self.fallbacks += 1
+            tle_text = ephemeris['tle_texts'][i].split('\n')
+            satellite = sf.EarthSatellite(tle_text[0], tle_text[1], ts=self.ts)
+            return {'position': satellite.at(time), 'tle_time': tle_time}
+
+        grid = segment['days']
+        j = int(np.searchsorted(grid, day, side='right')) - 1
+        j = min(max(j, 0), len(grid) - 2)
+        state = segment['state']
+        position, velocity = hermite(day, grid[j], grid[j+1],
+                                     state[j, :3], state[j, 3:],
+                                     state[j+1, :3], state[j+1, 3:])
+        # TEME -> GCRS, as skyfield does for EarthSatellite.at()
+        rotation = TEME.rotation_at(time).T
+        position = Geocentric(rotation.dot(position) / AU_KM,
+                              rotation.dot(velocity) / AU_KM,
+                              t=time, center=399)
+        return {'position': position, 'tle_time': tle_time}
+
+    def at(self, sid, t, time=None):
+        """ Interpolated skyfield Geocentric position of satellite `sid` at time t """
+        return self.locate(sid, t, time=time)['position']
+
+
+    def nbytes(self):
+        """ Memory used by the cached sample arrays, in bytes """
+        total = 0
+        for ephemeris in self.__ephemerides.values():
+            for segment in ephemeris['segments']:
+                if segment is not None:
+                    total += segment['days'].nbytes + segment['state'].nbytes
+        return total
+
+    def stats(self):
+        return {'satellites': len(self.__ephemerides),
+                'hits': self.hits,
+                'misses': self.misses,
+                'fallbacks': self.fallbacks,
+                'evictions': self.evictions,
+                'bytes': self.nbytes()}
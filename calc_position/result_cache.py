@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+import collections
+
+import numpy as np
+import pandas as pd
+
+
+def canonical(value):
+    """ Convert parse_params() output to plain JSON types, so that equivalent
+        requests (5 vs 5.0, naive vs UTC times, ...) look the same
+    """
+    if isinstance(value, pd.Timestamp):
+        if value.tzinfo is None:
+            value = value.tz_localize('UTC')
+        return value.tz_convert('UTC').isoformat()
+    if isinstance(value, pd.Timedelta):
+        return value.total_seconds()
+    if isinstance(value, dict):
+        return {str(k): canonical(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [canonical(v) for v in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    return value
+
+
+def plain(value):
+    """ json.dump() fallback for the numpy/pandas values found in hit results """
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    raise TypeError('{} is not JSON serializable'.format(type(value).__name__))
+
+
+def cache_key(params, data_version=''):
+    """ Content hash of a parse_params() style request and the version of the
+        data it runs against. ID lists are treated as sets.
+        Inputs:
+            params [dict]: Output of parse_params()
+            data_version [str]: Identifies the AIS/TLE data the hits are computed from
+        Output:
+            key [str]: Hex digest
+    """
+    request = canonical(params)
+    for key in ('sat_ids', 'vessel_ids'):
+        if request.get(key) is not None:
+            request[key] = sorted(str(x) for x in request[key])
+    text = json.dumps({'params': request, 'data_version': str(data_version)}, sort_keys=True)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """ Two tier cache of hit results keyed by cache_key(): the most recently
+        used `max_entries` results are kept in memory, and every result is
+        also written as JSON under `path`. The least recently used files are
+        removed once the directory holds more than `max_bytes`. Pass
+        path=None for a memory only cache.
+
+        With a `ttl`, results older than ttl seconds are not served, so that
+        data that changed without a new data version is picked up again.
+    """
+
+    def __init__(self, path=None, max_entries=128, max_bytes=512*1024*1024, ttl=None):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.memory = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.expired = 0
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def __file(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def __remember(self, key, result, stored):
+        self.memory[key] = (result, stored)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def __fresh(self, stored):
+        return self.ttl is None or time.time() - stored < self.ttl
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                result, stored = self.memory[key]
+                if self.__fresh(stored):
+                    self.memory_hits += 1
+                    self.memory.move_to_end(key)
+                    return result
+                # another process may have written a newer file
+                del self.memory[key]
+                self.expired += 1
+
+        result = None
+        stored = None
+        if self.path is not None:
+            try:
+                with open(self.__file(key)) as file:
+                    entry = json.load(file)
+                # Files hold {'stored': epoch seconds, 'result': ...}
+                result, stored = entry['result'], entry['stored']
+                if self.__fresh(stored):
+                    # Mark as recently used for eviction
+                    os.utime(self.__file(key))
+                else:
+                    result = None
+                    with self.lock:
+                        self.expired += 1
+                    os.remove(self.__file(key))
+            except (OSError, ValueError, TypeError, KeyError):
+                result = None
+
+        with self.lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.disk_hits += 1
+                self.__remember(key, result, stored)
+        return result
+
+    def put(self, key, result):
+        stored = time.time()
+        with self.lock:
+            self.__remember(key, result, stored)
+        if self.path is None:
+            return
+
+        # Write then rename, so that readers never see a partial file
+        fd, temp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as file:
+            json.dump({'stored': stored, 'result': result}, file, default=plain)
+        os.replace(temp, self.__file(key))
+        self.evict()
+
+    def evict(self):
+        """ Remove the least recently used files until the disk tier fits in max_bytes """
+        files = list()
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.json'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def disk_bytes(self):
+        if self.path is None:
+            return 0
+        return sum(entry.stat().st_size for entry in os.scandir(self.path) if entry.name.endswith('.json'))
+
+    def stats(self):
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {'memory_hits': self.memory_hits,
+                    'disk_hits': self.disk_hits,
+                    'misses': self.misses,
+                    'expired': self.expired,
+                    'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                    'memory_entries': len(self.memory),
+                    'disk_bytes': self.disk_bytes()}
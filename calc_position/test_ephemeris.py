@@ -0,0 +1,39 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import skyfield.api as sf
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from ephemeris import EphemerisCache
+
+# ISS (ZARYA), a low orbit where the interpolation error is largest
+ISS = ('1 25544U 98067A   21001.50000000  .00001264  00000-0  31197-4 0  9993\n'
+       '2 25544  51.6456 109.3829 0000894 166.5463 312.0578 15.49262838262399')
+
+
+def max_error_km(tle_text, tolerance_km, hours=12, samples=2000):
+    ts = sf.load.timescale(builtin=True)
+    epoch = pd.Timestamp('2021-01-01 12:00', tz='UTC')
+    tle_df = pd.DataFrame({'satellite_number': [25544], 'timestamp': [epoch], 'text': [tle_text]})
+    tmin, tmax = epoch - pd.Timedelta(hours=hours / 2), epoch + pd.Timedelta(hours=hours / 2)
+    cache = EphemerisCache(tle_df, ts, tmin, tmax, tolerance_km=tolerance_km)
+    lines = tle_text.split('\n')
+    satellite = sf.EarthSatellite(lines[0], lines[1], ts=ts)
+
+    error = 0.0
+    for t in pd.date_range(tmin, tmax, periods=samples):
+        time = ts.from_datetime(t.to_pydatetime())
+        interpolated = cache.at(25544, t, time=time).position.km
+        direct = satellite.at(time).position.km
+        error = max(error, float(np.linalg.norm(interpolated - direct)))
+    return error
+
+
+def test_leo_interpolation_within_tolerance():
+    assert max_error_km(ISS, 0.01) <= 0.01
+
+
+def test_tighter_tolerance_is_honored():
+    assert max_error_km(ISS, 0.001, hours=3) <= 0.001
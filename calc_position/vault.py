@@ -7,6 +7,9 @@ import skyfield.api as sf
 from geopy.distance import geodesic
 
 import vault_db
+import vault_es
+from ephemeris import EphemerisCache
+from result_cache import cache_key
 
 RADIUS_EARTH = 6366.71 # radius in km implied by definition of nm (assumes spherical earth)
 
@@ -268,6 +271,73 @@ def find_hits(t, sat_df, ship_df, min_degrees=0, sids=None, vids=None, ts=None,
         raise LookupError("No AIS data loaded!")
     if ts is None:
         ts = sf.load.timescale()
+
+    state = hit_state(t, sat_df, ship_df, ts, min_degrees=min_degrees,
+                      sids=sids, vids=vids,
+                      satellite_id_field=satellite_id_field,
+                      vessel_id_field=vessel_id_field)
+    aer = aer_from_state(state)
+    if json:
+        aer = JSON.dumps(aer)
+    return aer
+
+
+def locate_satellite(t, this_sat_df, ts, time=None, field='timestamp'):
+    """ Propagate a single satellite to time t using its closest TLE (see
+        find_closest_tle()).
+        Inputs:
+            t [pd.Timestamp]: Reference time
+            this_sat_df [pandas.DataFrame]: TLEs for a single satellite (with the text of the TLE in the 'text' column)
+            ts [skyfield.timelib.Timescale]: Skyfield timescale object
+            time [skyfield.timelib.Time]: t converted with ts (computed if not provided)
+            field [str]: Field holding the TLE epoch
+        Output:
+            satellite [dict]: 'subpoint' (skyfield GeographicPosition) and 'tle_time' (epoch of the TLE used)
+    """
+    if time is None:
+        time = ts.from_datetime(t.to_pydatetime())
+    this_sat_df = find_closest_tle(t, this_sat_df, field=field)
+    tle_text = this_sat_df['text'].split('\n')
+    this_sat = sf.EarthSatellite(tle_text[0],tle_text[1],ts=ts)
+    return {'subpoint': this_sat.at(time).subpoint(),
+            'tle_time': this_sat_df[field]}
+
+
+def pair_aer(sid, vid, subpoint, topo, time, min_degrees=0):
+    """ Azimuth, elevation and range of satellite `sid` (at `subpoint`) as seen
+        from vessel `vid` (at `topo`), and whether that counts as a hit.
+    """
+    alt,  az, distance = (subpoint - topo).at(time).altaz()
+    # We have a hit if satellite is above min_degrees for this ship at this time
+    hit = True if alt.degrees > min_degrees else False
+    return {'sat_id': int(sid), 'ves_id': int(vid),
+            'azimuth': az.degrees,
+            'elevation': alt.degrees,
+            'range': distance.km,
+            'hit': hit}
+
+
+def hit_state(t, sat_df, ship_df, ts, min_degrees=0, sids=None, vids=None,
+              satellite_id_field='satellite_number', vessel_id_field='mmsi',
+              ephemeris=None):
+    """ Compute the intermediate results behind find_hits() for a single time:
+        the vessel estimates, the satellite subpoints (with the epoch of the
+        TLE each one was propagated from) and the AER of every
+        satellite-vessel pair.
+
+        The state can be brought up to date after new AIS/TLE rows arrive
+        with stale_vessels()/stale_satellites() and update_hit_state(), which
+        only recompute the vessels, satellites and pairs whose inputs changed.
+        Use aer_from_state() to turn it into the find_hits() output.
+
+        Inputs are the same as find_hits(); `ts` is required. If an
+        EphemerisCache is given as `ephemeris`, satellite positions are
+        interpolated from it instead of propagating each TLE with SGP4.
+        Output:
+            state [dict]: Hit state for time t
+    """
+    sat_filter = None if sids is None else set(sids)
+    vessel_filter = None if vids is None else set(vids)
     if sids is None:
         sids = sat_df[satellite_id_field].unique()
     else:
@@ -277,17 +347,69 @@ def find_hits(t, sat_df, ship_df, min_degrees=0, sids=None, vids=None, ts=None,
     else:
         ship_df = ship_df[ship_df[vessel_id_field].isin(vids)]
 
-    time = ts.from_datetime(t.to_pydatetime())
+    state = {
+        't': t,
+        'time': ts.from_datetime(t.to_pydatetime()),
+        'ts': ts,
+        'min_degrees': min_degrees,
+        'satellite_id_field': satellite_id_field,
+        'vessel_id_field': vessel_id_field,
+        'sat_filter': sat_filter,
+        'vessel_filter': vessel_filter,
+        'ephemeris': ephemeris,
+        'vessels': dict(),
+        'satellites': dict(),
+        'pairs': dict(),
+        'stale_vessels': dict(),
+        'stale_satellites': dict(),
+    }
+    update_hit_state(state, sat_df, ship_df, sids=sids, vids=vids)
+    return state
+
+
+def update_hit_state(state, sat_df, ship_df, sids=(), vids=()):
+    """ Recompute the given satellites and vessels of a hit state, and every
+        pair involving at least one of them. Pairs between satellites and
+        vessels that are not listed are left untouched.
+        Inputs:
+            state [dict]: Hit state from hit_state()
+            sat_df [pandas.DataFrame]: DataFrame containing satellite TLEs
+            ship_df [pandas.DataFrame]: DataFrame containing AIS data
+            sids [list]: Satellite IDs to recompute
+            vids [list]: Vessel IDs to recompute
+    """
+    t = state['t']
+    time = state['time']
+    if len(vids) > 0:
+        state['vessels'].update(extrapolate_ais(vids, t, ship_df))
+    for sid in sids:
+        if state['ephemeris'] is not None:
+            satellite = state['ephemeris'].locate(sid, t, time=time)
+            state['satellites'][sid] = {'subpoint': satellite['position'].subpoint(),
+                                        'tle_time': satellite['tle_time']}
+        else:
+            this_sat_df = sat_df[sat_df[state['satellite_id_field']] == sid]
+            state['satellites'][sid] = locate_satellite(t, this_sat_df, state['ts'], time=time)
+
+    sids = set(sids)
+    vids = set(vids)
+    for sid, satellite in state['satellites'].items():
+        for vid, vessel_estimate in state['vessels'].items():
+            if sid in sids or vid in vids:
+                state['pairs'][(sid,vid)] = pair_aer(sid, vid, satellite['subpoint'],
+                                                     vessel_estimate['topo'], time,
+                                                     min_degrees=state['min_degrees'])
+
+
+def aer_from_state(state):
+    """ Format a hit state as the dictionary returned by find_hits() """
     aer = {
-        'utc': time.utc_iso(),
+        'utc': state['time'].utc_iso(),
         'satellites': list(),
         'vessels': list(),
         'pairs': dict()
     }
-
-    vessel_estimates = extrapolate_ais(vids, t, ship_df)
-    for vid in vids:
-        vessel_estimate = vessel_estimates[vid]
+    for vid, vessel_estimate in state['vessels'].items():
         aer['vessels'].append({'id': int(vid),
                                     'lat': vessel_estimate['lat'],
                                     'lon': vessel_estimate['lon'],
@@ -297,35 +419,115 @@ def find_hits(t, sat_df, ship_df, min_degrees=0, sids=None, vids=None, ts=None,
                                     'delta_t': vessel_estimate['delta_t'],
                                     'sog': vessel_estimate['sog'],
                                     'cog': vessel_estimate['cog']})
-    sat_subpoint = dict()
-    for sid in sids:
-        this_sat_df = find_closest_tle(t, sat_df[sat_df[satellite_id_field] == sid])
-        tle_text = this_sat_df['text'].split('\n')
-        #this_sat = this_sat_df['satellite']
-        this_sat = sf.EarthSatellite(tle_text[0],tle_text[1],ts=ts)
-        sat_subpoint[sid] = this_sat.at(time).subpoint()
-        horiz_angle = horizon_angle(sat_subpoint[sid].elevation.km)
+    for sid, satellite in state['satellites'].items():
+        subpoint = satellite['subpoint']
+        horiz_angle = horizon_angle(subpoint.elevation.km)
         aer['satellites'].append({'id': int(sid),
-                                        'lat': sat_subpoint[sid].latitude.degrees,
-                                        'lon': sat_subpoint[sid].longitude.degrees,
-                                        'alt': sat_subpoint[sid].elevation.km,
+                                        'lat': subpoint.latitude.degrees,
+                                        'lon': subpoint.longitude.degrees,
+                                        'alt': subpoint.elevation.km,
                                         'horizon': horiz_angle})
-    for sid in sids:
-        for vid in vids:
-            vessel_topo = vessel_estimates[vid]['topo']
-            alt,  az, distance = (sat_subpoint[sid] - vessel_topo).at(time).altaz()
-            # We have a hit if satellite is above min_degrees for this ship at this time
-            hit = True if alt.degrees > min_degrees else False
-            aer['pairs']['{},{}'.format(sid,vid)] = {'sat_id': int(sid), 'ves_id': int(vid),
-                                                            'azimuth': az.degrees,
-                                                            'elevation': alt.degrees,
-                                                            'range': distance.km,
-                                                            'hit': hit}
-    if json:
-        aer = JSON.dumps(aer)
+    for (sid, vid), pair in state['pairs'].items():
+        aer['pairs']['{},{}'.format(sid,vid)] = pair
     return aer
 
 
+def stale_vessels(state, new_ais_df, time_field='base_date_time'):
+    """ Given a hit state and newly arrived AIS rows, return the vessel IDs
+        whose position estimate at the state's time may change.
+
+        A vessel is stale if it is new to the state (and among the state's
+        vessel IDs, if these were restricted), or if one of its new AIS
+        entries falls inside the interval spanned by the entries its current
+        estimate was built from (see extrapolate_ais()), i.e. if it would
+        replace the previous or next AIS entry around the state's time.
+        Inputs:
+            state [dict]: Hit state from hit_state()
+            new_ais_df [pandas.DataFrame]: Newly arrived AIS rows (UTC timestamps)
+            time_field [str]: Field holding the AIS timestamp
+        Output:
+            stale [list]: Vessel IDs to recompute
+    """
+    stale = list()
+    for vid, rows in new_ais_df.groupby(state['vessel_id_field']):
+        if state['vessel_filter'] is not None and vid not in state['vessel_filter']:
+            continue
+        estimate = state['vessels'].get(vid)
+        if estimate is None:
+            stale.append(vid)
+            continue
+        prev_time, next_time = [None if r is None else pd.Timestamp(r) for r in estimate['nearest_records']]
+        affected = np.ones(len(rows), dtype=bool)
+        if prev_time is not None:
+            affected &= (rows[time_field] >= prev_time).values
+        if next_time is not None:
+            affected &= (rows[time_field] <= next_time).values
+        if affected.any():
+            stale.append(vid)
+    return stale
+
+
+def stale_satellites(state, new_tle_df, time_field='timestamp'):
+    """ Given a hit state and newly arrived TLE rows, return the satellite IDs
+        whose position at the state's time may change: satellites new to the
+        state, and satellites with a new TLE at least as close to the state's
+        time as the one currently used (see find_closest_tle()).
+        Inputs:
+            state [dict]: Hit state from hit_state()
+            new_tle_df [pandas.DataFrame]: Newly arrived TLE rows (UTC timestamps)
+            time_field [str]: Field holding the TLE epoch
+        Output:
+            stale [list]: Satellite IDs to recompute
+    """
+    t = state['t']
+    stale = list()
+    for sid, rows in new_tle_df.groupby(state['satellite_id_field']):
+        if state['sat_filter'] is not None and sid not in state['sat_filter']:
+            continue
+        satellite = state['satellites'].get(sid)
+        if satellite is None:
+            stale.append(sid)
+        elif (abs(rows[time_field] - t) <= abs(satellite['tle_time'] - t)).any():
+            stale.append(sid)
+    return stale
+
+
+def merge_sorted(df, new_df, field):
+    """ Merge new rows into a dataframe that is already sorted by `field`,
+        without re-sorting the existing rows. Only the new rows are sorted;
+        they are then placed with a binary search over the existing times.
+        New rows land after existing rows with an equal time. If all of the
+        new rows are at or after the last existing row (the usual case for
+        live feeds) they are simply appended.
+        Inputs:
+            df [pandas.DataFrame]: Dataframe sorted by `field`
+            new_df [pandas.DataFrame]: Rows to merge in (any order)
+            field [str]: Name of field to sort on
+        Output:
+            merged [pandas.DataFrame]: Dataframe with all rows, sorted by `field`, with a fresh index
+    """
+    new_df = new_df.sort_values(field)
+    if len(new_df) == 0:
+        return df
+    if len(df) == 0:
+        return new_df.reset_index(drop=True)
+    old_times = df[field].values
+    new_times = new_df[field].values
+    merged = pd.concat([df, new_df], ignore_index=True)
+    if new_times[0] >= old_times[-1]:
+        return merged
+
+    n_old = len(df)
+    n_new = len(new_df)
+    # New row i goes in front of old row positions[i]; old row j is pushed
+    # back by the number of new rows placed in front of it.
+    positions = np.searchsorted(old_times, new_times, side='right')
+    order = np.empty(n_old + n_new, dtype=np.int64)
+    order[positions + np.arange(n_new)] = n_old + np.arange(n_new)
+    order[np.arange(n_old) + np.searchsorted(positions, np.arange(n_old), side='right')] = np.arange(n_old)
+    return merged.iloc[order].reset_index(drop=True)
+
+
 def parse_params(params,defaults=None):
     """ Parse user input, apply a set of sensible defaults, and convert times
         to pd.Timestep objects
@@ -340,7 +542,9 @@ def parse_params(params,defaults=None):
                     'sat_ids': None,
                     'sat_limit': 10,
                     'vessel_ids': None,
-                    'vessel_limit': 10}
+                    'vessel_limit': 10,
+                    'ephemeris_tolerance_km': 0.01,
+                    'ephemeris_cache_size': 256}
 
     for key in defaults.keys():
         if key not in params:
@@ -357,7 +561,7 @@ def parse_params(params,defaults=None):
 
 class HitFinder():
 
-    def __init__(self,params):
+    def __init__(self,params,result_cache=None,data_version=''):
         # OPEN MYSQL DATABASE CONNECTION
         #self.open_db_connection()
         # LOAD BASELINE TIMESCALE FOR TIME CONVERSIONS
@@ -369,6 +573,17 @@ class HitFinder():
         self.ais_df = None
         self.sat_ids = None
         self.vessel_ids = None
+        self.ephemeris = None
+        # Data comes from MySQL (open_db_connection) unless
+        # open_es_connection() is called
+        self.es = None
+        # Hit states by time, kept up to date by append_ais_data/append_tle_data
+        self.__hit_states = dict()
+        # Optional result_cache.ResultCache for find_all_hits(); data_version
+        # must identify the AIS/TLE data that will be loaded
+        self.result_cache = result_cache
+        self.data_version = data_version
+        self.__appends = 0
 
 
     def get_params(self):
@@ -377,6 +592,7 @@ class HitFinder():
     def set_params(self,new_params):
         for key in new_params.keys():
             self.__params[key] = new_params[key]
+        self.__hit_states.clear()
 
 
     def open_db_connection(self,host,user,password):
@@ -386,9 +602,31 @@ class HitFinder():
                                         password=password)
 
 
+    def open_es_connection(self,es,ais_index='ais',tle_index='tle',slices=5,page_size=5000):
+        """ Load AIS/TLE data from the search cluster instead of MySQL.
+            Inputs:
+                es [ElasticSearchWrapper]: Connection (see elastic_search_wrapper.py)
+                ais_index, tle_index [str]: Indices holding the AIS and TLE documents
+                slices [int]: Parallel scroll slices per load (see vault_es.ESConnection)
+                page_size [int]: Hits per scroll page
+        """
+        print("Opening ES connection...")
+        self.es = vault_es.ESConnection(es,slices=slices,page_size=page_size)
+        self.ais_index = ais_index
+        self.tle_index = tle_index
+
+
     def get_sat_ids(self):
         if self.__params['sat_ids'] is not None:
             self.sat_ids = self.__params['sat_ids']
+        elif self.es is not None:
+            print("Fetching satellite IDs")
+            self.sat_ids = self.es.get_ids(self.tle_index,
+                                           tmin=self.__params['tmin'],
+                                           tmax=self.__params['tmax'],
+                                           id_field='satellite_number',
+                                           time_field='timestamp',
+                                           limit=self.__params['sat_limit'])
         else:
             print("Fetching satellite IDs")
             self.sat_ids = vault_db.get_ids(self.db,
@@ -410,24 +648,61 @@ class HitFinder():
             tmax = self.__params['tmax']
         if tmin is None:
             tmin = self.__params['tmin']
-        tle_query = vault_db.build_query(ids=ids,
-                                         tmin=tmin,tmax=tmax,
-                                         table=table,
-                                         id_field=id_field,
-                                         time_field=time_field)
-        self.tle_df = self.db.query(tle_query,df=True)
+        if self.es is not None:
+            tle_query = vault_es.build_query(ids=ids,
+                                             tmin=tmin,tmax=tmax,
+                                             id_field=id_field,
+                                             time_field=time_field)
+            # Timestamps are decoded as UTC
+            self.tle_df = self.es.query(self.tle_index,tle_query,vault_es.TLE_COLUMNS)
+        else:
+            tle_query = vault_db.build_query(ids=ids,
+                                             tmin=tmin,tmax=tmax,
+                                             table=table,
+                                             id_field=id_field,
+                                             time_field=time_field)
+            self.tle_df = self.db.query(tle_query,df=True)
+            if len(self.tle_df) > 0:
+                # Add UTC to timezones of timestamps
+                self.tle_df['timestamp'] = self.tle_df['timestamp'].apply(lambda x: x.replace(tzinfo=datetime.timezone.utc))
         if len(self.tle_df) == 0:
             raise LookupError('Error: query returned no TLE data. Query was {}'.format(tle_query))
         else:
-            # Add UTC to timezones of timestamps
-            self.tle_df['timestamp'] = self.tle_df['timestamp'].apply(lambda x: x.replace(tzinfo=datetime.timezone.utc))
             # Sort by time
             self.tle_df.sort_values('timestamp',inplace=True)
+        self.open_ephemeris(tmin=tmin,tmax=tmax)
+        self.__hit_states.clear()
+
+
+    def open_ephemeris(self,tmin=None,tmax=None):
+        """ Set up an interpolating ephemeris cache over the loaded TLEs for
+            the window [tmin, tmax] (see ephemeris.EphemerisCache). Disabled
+            if the 'ephemeris_tolerance_km' parameter is None.
+        """
+        tolerance = self.__params.get('ephemeris_tolerance_km')
+        if tolerance is None:
+            self.ephemeris = None
+            return
+        if tmax is None:
+            tmax = self.__params['tmax']
+        if tmin is None:
+            tmin = self.__params['tmin']
+        self.ephemeris = EphemerisCache(self.tle_df,self.ts,tmin,tmax,
+                                        tolerance_km=tolerance,
+                                        max_satellites=self.__params.get('ephemeris_cache_size',256))
 
 
     def get_vessel_ids(self):
         if self.__params['vessel_ids'] is not None:
             self.vessel_ids = self.__params['vessel_ids']
+        elif self.es is not None:
+            print("Fetching vessel IDs")
+            self.vessel_ids = self.es.get_ids(self.ais_index,
+                                              tmin=self.__params['tmin'],
+                                              tmax=self.__params['tmax'],
+                                              id_field='mmsi',
+                                              time_field='base_date_time',
+                                              limit=self.__params['vessel_limit'])
         else:
             print("Fetching vessel IDs")
             self.vessel_ids = vault_db.get_ids(self.db,
@@ -449,30 +724,120 @@ class HitFinder():
             tmax = self.__params['tmax']
         if tmin is None:
             tmin = self.__params['tmin']
-        ais_query = vault_db.build_query(ids=ids,
-                                tmin=tmin,tmax=tmax,
-                                table=table,
-                                id_field=id_field,
-                                time_field=time_field)
-        self.ais_df = self.db.query(ais_query,df=True)
+        if self.es is not None:
+            ais_query = vault_es.build_query(ids=ids,
+                                             tmin=tmin,tmax=tmax,
+                                             id_field=id_field,
+                                             time_field=time_field)
+            self.ais_df = self.es.query(self.ais_index,ais_query,vault_es.AIS_COLUMNS)
+        else:
+            ais_query = vault_db.build_query(ids=ids,
+                                    tmin=tmin,tmax=tmax,
+                                    table=table,
+                                    id_field=id_field,
+                                    time_field=time_field)
+            self.ais_df = self.db.query(ais_query,df=True)
+            if len(self.ais_df) > 0:
+                self.ais_df['base_date_time'] = self.ais_df['base_date_time'].apply(lambda x: x.replace(tzinfo=datetime.timezone.utc))
         if len(self.ais_df) == 0:
             raise LookupError('Error: query returned no AIS data. Query was {}'.format(ais_query))
         else:
-            self.ais_df['base_date_time'] = self.ais_df['base_date_time'].apply(lambda x: x.replace(tzinfo=datetime.timezone.utc))
             self.ais_df.sort_values('base_date_time',inplace=True)
+        self.__hit_states.clear()
+
+
+    def append_ais_data(self,new_ais_df,time_field='base_date_time'):
+        """ Merge newly arrived AIS rows into the loaded AIS data without
+            re-sorting it, and mark the vessels whose estimates they affect
+            as stale in every hit state computed so far. Stale vessels (and
+            their pairs) are recomputed by the next find_hits() at that time.
+        """
+        self.__appends += 1
+        new_ais_df = new_ais_df.copy()
+        new_ais_df[time_field] = new_ais_df[time_field].apply(lambda x: x.replace(tzinfo=datetime.timezone.utc))
+        if self.ais_df is None:
+            self.ais_df = merge_sorted(new_ais_df.iloc[0:0],new_ais_df,time_field)
+        else:
+            self.ais_df = merge_sorted(self.ais_df,new_ais_df,time_field)
+        for state in self.__hit_states.values():
+            state['stale_vessels'].update(dict.fromkeys(stale_vessels(state,new_ais_df,time_field=time_field)))
+
+    def append_tle_data(self,new_tle_df,time_field='timestamp'):
+        """ Merge newly arrived TLE rows into the loaded TLE data without
+            re-sorting it, and mark the satellites whose closest TLE they
+            change as stale in every hit state computed so far. Stale
+            satellites (and their pairs) are recomputed by the next
+            find_hits() at that time.
+        """
+        self.__appends += 1
+        new_tle_df = new_tle_df.copy()
+        new_tle_df[time_field] = new_tle_df[time_field].apply(lambda x: x.replace(tzinfo=datetime.timezone.utc))
+        if self.tle_df is None:
+            self.tle_df = merge_sorted(new_tle_df.iloc[0:0],new_tle_df,time_field)
+            self.open_ephemeris()
+        else:
+            self.tle_df = merge_sorted(self.tle_df,new_tle_df,time_field)
+            if self.ephemeris is not None:
+                self.ephemeris.set_tle_data(self.tle_df,sids=new_tle_df['satellite_number'].unique())
+        for state in self.__hit_states.values():
+            state['stale_satellites'].update(dict.fromkeys(stale_satellites(state,new_tle_df,time_field=time_field)))
 
 
     def find_hits(self,t,json=True):
-        hits = find_hits(t,self.tle_df,self.ais_df,ts=self.ts,
-                         min_degrees=self.__params['altitude_min'],json=json)
+        if self.tle_df is None or len(self.tle_df) == 0:
+            raise LookupError("No TLE data loaded!")
+        if self.ais_df is None or len(self.ais_df) == 0:
+            raise LookupError("No AIS data loaded!")
+        state = self.__hit_states.get(t)
+        if state is None:
+            state = hit_state(t,self.tle_df,self.ais_df,self.ts,
+                              min_degrees=self.__params['altitude_min'],
+                              ephemeris=self.ephemeris)
+            self.__hit_states[t] = state
+        elif len(state['stale_vessels']) > 0 or len(state['stale_satellites']) > 0:
+            update_hit_state(state,self.tle_df,self.ais_df,
+                             sids=list(state['stale_satellites']),
+                             vids=list(state['stale_vessels']))
+            state['stale_vessels'].clear()
+            state['stale_satellites'].clear()
+        hits = aer_from_state(state)
+        if json:
+            hits = JSON.dumps(hits)
+        return hits
+
+    def cache_key(self,times=None):
+        """ Result cache key for find_all_hits(times): the parsed parameters
+            plus the data version and the number of appends so far
+        """
+        params = dict(self.__params)
+        if times is not None:
+            params['times'] = [pd.Timestamp(t) for t in times]
+        return cache_key(params,'{}+{}'.format(self.data_version,self.__appends))
+
+    def cached_hits(self,times=None,json=True):
+        """ find_all_hits(times) from the result cache, or None if not cached.
+            Does not need any data to be loaded.
+        """
+        if self.result_cache is None:
+            return None
+        hits = self.result_cache.get(self.cache_key(times))
+        if hits is not None and json:
+            hits = [JSON.dumps(hit) for hit in hits]
         return hits
 
     def find_all_hits(self,times=None,json=True):
-        if times is None:
-            times = self.__params['times']
-        hits = list()
-        for t in times:
-            hits.append(self.find_hits(t,json=json))
+        hits = self.cached_hits(times,json=False)
+        if hits is None:
+            key = self.cache_key(times)
+            if times is None:
+                times = self.__params['times']
+            hits = list()
+            for t in times:
+                hits.append(self.find_hits(t,json=False))
+            if self.result_cache is not None:
+                self.result_cache.put(key,hits)
+        if json:
+            hits = [JSON.dumps(hit) for hit in hits]
         return hits
 
 
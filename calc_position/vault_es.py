@@ -0,0 +1,112 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# Columns HitFinder needs from each index, and how they are decoded
+AIS_COLUMNS = {'mmsi': 'str',
+               'vessel_name': 'str',
+               'base_date_time': 'time',
+               'lat': 'float',
+               'lon': 'float',
+               'sog': 'float',
+               'cog': 'float'}
+TLE_COLUMNS = {'satellite_number': 'int',
+               'international_designator': 'str',
+               'timestamp': 'time',
+               'text': 'str'}
+
+
+def time_range(tmin=None, tmax=None, time_field='timestamp'):
+    """ ES range filter matching vault_db.time_query_stub() """
+    bounds = {'format': 'strict_date_optional_time'}
+    if tmin is not None:
+        bounds['gte'] = tmin.isoformat()
+    if tmax is not None:
+        bounds['lte'] = tmax.isoformat()
+    return {'range': {time_field: bounds}}
+
+
+def build_query(ids, tmin=None, tmax=None, id_field='satellite_number', time_field='timestamp'):
+    """ ES version of vault_db.build_query(): documents of specific
+        satellite or vessel IDs over a specified range of time
+    """
+    filters = list()
+    if ids is not None and len(ids) > 0:
+        filters.append({'terms': {id_field: list(ids)}})
+    if tmin is not None or tmax is not None:
+        filters.append(time_range(tmin, tmax, time_field))
+    return {'query': {'bool': {'filter': filters}}}
+
+
+def decode(values, kind):
+    """ Column of _source values as a typed array """
+    if kind == 'float':
+        return pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').astype(np.float64).values
+    if kind == 'int':
+        return pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').values
+    if kind == 'time':
+        return pd.to_datetime(pd.Series(values, dtype=object), utc=True)
+    return np.array([value if value is None else str(value) for value in values], dtype=object)
+
+
+class ESConnection:
+    """ Search cluster counterpart of vault_db.DBConnection, for loading AIS
+        and TLE data into HitFinder. Documents are read with a sliced scroll,
+        one slice per thread, projected to the needed fields and decoded
+        into typed DataFrame columns.
+        Inputs:
+            es [ElasticSearchWrapper]: Connection (see elastic_search_wrapper.py)
+            slices [int]: Parallel scroll slices (ideally a multiple of the shard count)
+            page_size [int]: Hits per scroll page
+    """
+    def __init__(self, es, slices=5, page_size=5000):
+        self.es = es
+        self.slices = slices
+        self.page_size = page_size
+
+    def __read_slice(self, index, query, fields, slice_id):
+        columns = {field: list() for field in fields}
+        for hit in self.es.scan_slice(index, query, slice_id=slice_id, slices=self.slices, page_size=self.page_size):
+            source = hit['_source']
+            for field, values in columns.items():
+                values.append(source.get(field))
+        return columns
+
+    def query(self, index, query, columns):
+        """ Every document matching query as a DataFrame.
+            Inputs:
+                index [str]: Index name
+                query [dict]: Query body, e.g. from build_query()
+                columns [dict]: Field name -> 'str', 'int', 'float' or 'time' (UTC)
+            Output:
+                df [pandas.DataFrame]: One row per document
+        """
+        query = dict(query)
+        query['_source'] = list(columns)
+        with ThreadPoolExecutor(max_workers=self.slices) as executor:
+            parts = list(executor.map(lambda i: self.__read_slice(index, query, columns, i), range(self.slices)))
+        return pd.DataFrame({field: decode([value for part in parts for value in part[field]], kind)
+                             for field, kind in columns.items()})
+
+    def get_ids(self, index, tmin=None, tmax=None, id_field='satellite_number', time_field='timestamp', limit=None):
+        """ ES version of vault_db.get_ids(): distinct IDs with data in [tmin, tmax],
+            in ID order
+        """
+        query = {'size': 0}
+        if tmin is not None or tmax is not None:
+            query['query'] = time_range(tmin, tmax, time_field)
+        if limit is not None:
+            query['aggs'] = {'ids': {'terms': {'field': id_field, 'size': limit, 'order': {'_key': 'asc'}}}}
+            return [bucket['key'] for bucket in self.es.aggregate(index, query)['ids']['buckets']]
+
+        # https://www.elastic.co/guide/en/elasticsearch/reference/7.x/search-aggregations-bucket-composite-aggregation.html
+        ids = list()
+        composite = {'size': 10000, 'sources': [{'id': {'terms': {'field': id_field}}}]}
+        query['aggs'] = {'ids': {'composite': composite}}
+        while True:
+            answer = self.es.aggregate(index, query)['ids']
+            ids.extend(bucket['key']['id'] for bucket in answer['buckets'])
+            if len(answer['buckets']) < composite['size']:
+                return ids
+            composite['after'] = answer['after_key']
@@ -1,25 +1,255 @@
-
+import os
+import time
+import threading
+import contextvars
 from datetime import datetime
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, Transport, ElasticsearchException, TransportError, ConnectionError, ConnectionTimeout
+from elasticsearch.helpers import streaming_bulk
+from search_cache import SearchCache
+from index_versions import IndexVersions, METRICS
+import metrics
+from resilience import Policy, CircuitBreaker, CircuitOpenError
+from single_flight import SingleFlight, AsyncSingleFlight
 
-class ElasticSearchWrapper:
-    def __init__(self):
+# cat = "https://search-vault-es-public-domain-5j637dz3uilvw5wvmx5zxo3axu.us-east-1.es.amazonaws.com/_cat/indices"
+# elasticEndpoint = "https://search-vault-es-public-domain-5j637dz3uilvw5wvmx5zxo3axu.us-east-1.es.amazonaws.com/tle/_search?q=*"
+
+url = os.environ.get('ES_URL', "https://search-vault-es-public-domain-5j637dz3uilvw5wvmx5zxo3axu.us-east-1.es.amazonaws.com")
+elasticUser = os.environ.get('ES_USER', "vaultuser")
+elasticPass = os.environ.get('ES_PASSWORD', "Vault_User_2020")
+
+# https://elasticsearch-py.readthedocs.io/en/7.x/connection.html
+# https://elasticsearch-py.readthedocs.io/en/7.x/api.html#elasticsearch
+clientOptions = {
+    # keep-alive connections kept per node, i.e. how many requests can be in flight at once
+    'maxsize': int(os.environ.get('ES_POOL_SIZE', 25)),
+    'timeout': float(os.environ.get('ES_TIMEOUT', 30)),
+    'retry_on_timeout': True,
+    # sniffing finds the other nodes of the cluster; off by default since
+    # the AWS domain is only reachable through its endpoint
+    'sniff_on_start': os.environ.get('ES_SNIFF', '') == 'true',
+    'sniff_on_connection_fail': os.environ.get('ES_SNIFF', '') == 'true',
+    'sniffer_timeout': float(os.environ.get('ES_SNIFF_INTERVAL', 60)) if os.environ.get('ES_SNIFF', '') == 'true' else None,
+}
+
+# Calls made under esPolicy are retried by it, with backoff, so the client's
+# own retries (max_retries, 3 by default) are turned off for them alone, see
+# single_attempt(). Other calls (bulk, index, stats, ...) keep them.
+clientRetries = contextvars.ContextVar('clientRetries', default=None)
+
+class RetriesOverride:
+    """ Transport mixin whose max_retries is clientRetries when that is set """
+
+    @property
+    def max_retries(self):
+        retries = clientRetries.get()
+        return self.maxRetries if retries is None else retries
+
+    @max_retries.setter
+    def max_retries(self, value):
+        self.maxRetries = value
+
+class PolicyTransport(RetriesOverride, Transport):
+    pass
+
+_sharedClient = None
+_sharedClientLock = threading.Lock()
+
+def shared_client():
+    """ The process wide Elasticsearch client. It is created on first use
+        (so that each forked worker process gets its own) and then reused,
+        keeping its connection pool and TLS connections alive across
+        requests. The client is thread safe.
+    """
+    global _sharedClient
+    if _sharedClient is None:
+        with _sharedClientLock:
+            if _sharedClient is None:
+                _sharedClient = Elasticsearch(hosts=[url], http_auth=(elasticUser, elasticPass),
+                                              transport_class=PolicyTransport, **clientOptions)
+    return _sharedClient
+
+# Search results are cached per process, see search_cache.py; ES_CACHE_TTL=0 turns it off.
+# written() only sees writes made by this process: after writes from other
+# workers, bulk_ingest.py or vaultwrite.py, searches may return results up to
+# ES_CACHE_TTL seconds old, hence the short default.
+searchCache = SearchCache(ttl=float(os.environ.get('ES_CACHE_TTL', 10)),
+                          max_bytes=int(os.environ.get('ES_CACHE_BYTES', 64*1024*1024)))
+# Index stats summaries and ETags, see index_versions.py
+indexVersions = IndexVersions(ttl=float(os.environ.get('ES_STATS_TTL', 10)))
+# Identical searches and stats calls running at the same time share one
+# request to Elasticsearch, see single_flight.py
+flights = SingleFlight()
+asyncFlights = AsyncSingleFlight()
+
+def retryable(error):
+    """ Errors that say the cluster is unreachable, slow or overloaded rather than that the request is wrong """
+    if isinstance(error, ConnectionError):
+        return True
+    return isinstance(error, TransportError) and error.status_code in (429, 502, 503, 504)
+
+# Timeouts, retries, hedging and circuit breaking of searches, see resilience.py
+# ES_REQUEST_TIMEOUT is seconds per call, ES_REQUEST_TIMEOUTS overrides it per operation, e.g. "search=5,aggregate=20"
+esPolicy = Policy(timeout=float(os.environ['ES_REQUEST_TIMEOUT']) if os.environ.get('ES_REQUEST_TIMEOUT') else None,
+                  timeouts={name.strip(): float(seconds) for name, seconds in
+                            (item.split('=') for item in os.environ.get('ES_REQUEST_TIMEOUTS', '').split(',') if item.strip())},
+                  retries=int(os.environ.get('ES_RETRIES', 2)),
+                  backoff=float(os.environ.get('ES_RETRY_BACKOFF', 0.1)),
+                  hedge=os.environ.get('ES_HEDGE', 'true') == 'true',
+                  hedge_quantile=float(os.environ.get('ES_HEDGE_QUANTILE', 0.95)),
+                  hedge_min_delay=float(os.environ.get('ES_HEDGE_MIN_DELAY', 0.05)),
+                  workers=int(os.environ.get('ES_HEDGE_WORKERS', 8)),
+                  breaker=CircuitBreaker(failures=int(os.environ.get('ES_BREAKER_FAILURES', 5)),
+                                         reset=float(os.environ.get('ES_BREAKER_RESET', 30))),
+                  retryable=retryable,
+                  is_timeout=lambda error: isinstance(error, ConnectionTimeout))
+
+def retry_after(error):
+    """ Seconds a client should wait before trying again when error says
+        Elasticsearch is unavailable (the breaker is open, the cluster is
+        unreachable or overloaded), None for errors a retry won't fix
+    """
+    if isinstance(error, CircuitOpenError):
+        return esPolicy.breaker.retry_after()
+    if retryable(error):
+        return 1
+    return None
+
+def single_attempt(call):
+    """ call, made without the client's own retries """
+    def attempt(**kwargs):
+        token = clientRetries.set(0)
+        try:
+            return call(**kwargs)
+        finally:
+            clientRetries.reset(token)
+    return attempt
+
+def single_attempt_async(call):
+    async def attempt(**kwargs):
+        token = clientRetries.set(0)
+        try:
+            return await call(**kwargs)
+        finally:
+            clientRetries.reset(token)
+    return attempt
+
+def timed(operation, call, **kwargs):
+    """ call(**kwargs), a request to Elasticsearch, made under esPolicy and
+        timed for metrics.py. Scrolls are not retried or hedged, a repeated
+        scroll call would skip a page or leave a scroll context open.
+    """
+    start = time.perf_counter()
+    try:
+        answer = esPolicy.call(operation, single_attempt(call), idempotent=operation != 'scan', **kwargs)
+    except Exception:
+        metrics.esErrors.inc(operation)
+        raise
+    metrics.es_call(operation, time.perf_counter() - start, answer.get('took'))
+    return answer
 
-        cat = "https://search-vault-es-public-domain-5j637dz3uilvw5wvmx5zxo3axu.us-east-1.es.amazonaws.com/_cat/indices"
+async def timed_async(operation, call, **kwargs):
+    start = time.perf_counter()
+    try:
+        answer = await esPolicy.call_async(operation, single_attempt_async(call), idempotent=operation != 'scan', **kwargs)
+    except Exception:
+        metrics.esErrors.inc(operation)
+        raise
+    metrics.es_call(operation, time.perf_counter() - start, answer.get('took'))
+    return answer
 
-        elasticEndpoint = "https://search-vault-es-public-domain-5j637dz3uilvw5wvmx5zxo3axu.us-east-1.es.amazonaws.com/tle/_search?q=*"
+def cache_metrics():
+    """ Search cache counters for /metrics """
+    stats = searchCache.stats()
+    gauges = list()
+    for name in ('entries', 'bytes', 'hits', 'misses', 'evictions', 'invalidations', 'stale_puts'):
+        gauge = metrics.Gauge('search_cache_' + name, 'Search response cache ' + name)
+        gauge.set(value=stats[name])
+        gauges.append(gauge)
+    return gauges
 
-        url = "https://search-vault-es-public-domain-5j637dz3uilvw5wvmx5zxo3axu.us-east-1.es.amazonaws.com"
-        elasticUser = "vaultuser"
-        elasticPass = "Vault_User_2020"
+metrics.COLLECTORS.append(cache_metrics)
 
-        self.es = Elasticsearch(hosts=[url], http_auth=(elasticUser, elasticPass))
+def written(index):
+    """ Forget what is cached about index after a write to it """
+    searchCache.invalidate(index)
+    indexVersions.invalidate(index)
+    flights.forget(index)
+    asyncFlights.forget(index)
+
+def set_shared_client(client):
+    """ Replace the process wide client, e.g. with one configured differently """
+    global _sharedClient
+    with _sharedClientLock:
+        _sharedClient = client
+
+_sharedAsyncClient = None
+
+def shared_async_client():
+    """ The process wide AsyncElasticsearch client, for async_main.py. Like
+        shared_client() it is created on first use, which has to happen in
+        the event loop that serves the requests. Needs aiohttp.
+    """
+    global _sharedAsyncClient
+    if _sharedAsyncClient is None:
+        # https://elasticsearch-py.readthedocs.io/en/7.x/async.html
+        from elasticsearch import AsyncElasticsearch, AsyncTransport
+
+        class AsyncPolicyTransport(RetriesOverride, AsyncTransport):
+            pass
+
+        _sharedAsyncClient = AsyncElasticsearch(hosts=[url], http_auth=(elasticUser, elasticPass),
+                                                transport_class=AsyncPolicyTransport, **clientOptions)
+    return _sharedAsyncClient
+
+def set_shared_async_client(client):
+    global _sharedAsyncClient
+    _sharedAsyncClient = client
+
+async def close_shared_async_client():
+    """ Close the async client's connections, when its event loop shuts down """
+    global _sharedAsyncClient
+    if _sharedAsyncClient is not None:
+        client, _sharedAsyncClient = _sharedAsyncClient, None
+        await client.close()
+
+def _after_fork():
+    """ A forked process (es_export.py workers, gunicorn --preload) must not
+        use the parent's client, whose pooled sockets the parent still
+        reads from, nor its threads, locks and calls in flight
+    """
+    global _sharedClient, _sharedClientLock, _sharedAsyncClient, flights, asyncFlights
+    _sharedClient = None
+    _sharedClientLock = threading.Lock()
+    _sharedAsyncClient = None
+    searchCache.lock = threading.Lock()
+    indexVersions.lock = threading.Lock()
+    flights = SingleFlight()
+    asyncFlights = AsyncSingleFlight()
+    esPolicy.after_fork()
+
+os.register_at_fork(after_in_child=_after_fork)
+
+def msearch_results(answer, missing, keys, results, generation=None):
+    """ Fill in results[i] for each i in missing from an _msearch answer, caching them """
+    for i, response in zip(missing, answer['responses']):
+        if 'error' in response:
+            raise TransportError(response.get('status', 'N/A'), 'msearch', response['error'])
+        results[i] = response['hits']['hits']
+        searchCache.put(keys[i], results[i], generation)
+
+
+class ElasticSearchWrapper:
+    def __init__(self, es=None):
+        # cheap to create: every wrapper shares the process wide client
+        self.es = es if es is not None else shared_client()
        
     def smoketest(self):
         index = 'smoke-index'
         doc_type="smoke-type"
         data = {"data": "smoketest", "timestamp": datetime.now()}
         id = 1
+        written(index)
         try:
             self.delete_index(index)
             done = self.es.index(index=index, doc_type=doc_type, id=id, body=data)
@@ -29,14 +259,20 @@ class ElasticSearchWrapper:
             res = self.es.get(index=index, doc_type=doc_type, id=id)
             return res, message
         
-    def search(self, index, query):
+    def search(self, index, query, version=None):
+        """ Hits of a search, from the response cache when they are there.
+            Pass the index_version() a response's ETag is made from as
+            `version`, so that the hits are cached per version and the body
+            never lags behind the ETag.
+        """
         try:
             print(query)
-            answer = self.es.search(index=index, body=query)
-            hits = answer['hits']['hits']
-           # print(hits)
-            return hits
-        except Elasticsearch.ElasticsearchException as esError:
+            key = searchCache.key(index, query, version)
+            hits = searchCache.get(key)
+            if hits is not None:
+                return hits
+            return flights.do((index, 'search') + key[1:], self.fetch_hits, index, query, key)
+        except ElasticsearchException as esError:
             raise  esError
             ## https://github.com/elastic/elasticsearch-py/blob/master/elasticsearch/exceptions.py
             ## https://elasticsearch-py.readthedocs.io/en/master/exceptions.html
@@ -44,10 +280,149 @@ class ElasticSearchWrapper:
             # res = [esError.error]
             # return res, esError.info
             
+    def fetch_hits(self, index, query, key):
+        generation = searchCache.generation(index)
+        answer = timed('search', self.es.search, index=index, body=query)
+        hits = answer['hits']['hits']
+        searchCache.put(key, hits, generation)
+        return hits
+
+    def search_page(self, index, query):
+        """ Hits of a search and the total matches as counted by track_total_hits
+            (None when not counted). Cached like search().
+            Output:
+                hits [list], total [dict]: {'value': ..., 'relation': 'eq' or 'gte'}
+        """
+        key = searchCache.key(index, query) + ('total',)
+        page = searchCache.get(key)
+        if page is None:
+            page = flights.do((index, 'search_page', key[1]), self.fetch_page, index, query, key)
+        return page['hits'], page['total']
+
+    def fetch_page(self, index, query, key):
+        generation = searchCache.generation(index)
+        answer = timed('search_page', self.es.search, index=index, body=query)
+        page = {'hits': answer['hits']['hits'], 'total': answer['hits'].get('total')}
+        searchCache.put(key, page, generation)
+        return page
+
+    def aggregate(self, index, query):
+        """ The aggregations of a search, usually one with size 0. Cached like search() """
+        key = searchCache.key(index, query)
+        aggregations = searchCache.get(key)
+        if aggregations is not None:
+            return aggregations
+        return flights.do((index, 'aggregate', key[1]), self.fetch_aggregations, index, query, key)
+
+    def fetch_aggregations(self, index, query, key):
+        generation = searchCache.generation(index)
+        answer = timed('aggregate', self.es.search, index=index, body=query)
+        aggregations = answer.get('aggregations', {})
+        searchCache.put(key, aggregations, generation)
+        return aggregations
+
+    def msearch(self, index, queries):
+        """ Hits of each query, as search() would return them, from a single
+            _msearch request. Queries found in the response cache are not sent.
+        """
+        # https://www.elastic.co/guide/en/elasticsearch/reference/7.x/search-multi-search.html
+        keys = [searchCache.key(index, query) for query in queries]
+        results = [searchCache.get(key) for key in keys]
+        missing = [i for i, hits in enumerate(results) if hits is None]
+        if missing:
+            generation = searchCache.generation(index)
+            body = list()
+            for i in missing:
+                body.append({})
+                body.append(queries[i])
+            answer = flights.do((index, 'msearch', tuple(keys[i][1] for i in missing)),
+                                timed, 'msearch', self.es.msearch, index=index, body=body)
+            msearch_results(answer, missing, keys, results, generation)
+        return results
+
+    def stream(self, index, query, sort, page_size=1000, search_after=None, keep_alive='1m', tiebreaker=()):
+        """ Generator over every hit of `query`, fetched a page at a time with
+            search_after against a point in time, so only one page is held in
+            memory and results are consistent while paging. Each hit carries
+            its 'sort' values; pass them back as `search_after` to resume.
+            Ties are broken by _shard_doc within the point in time. Clusters
+            without point in time support (before 7.10, Open Distro) are
+            paged with search_after alone, with the `tiebreaker` sort (doc
+            values fields such as mmsi, not _id, which needs fielddata).
+        """
+        # https://www.elastic.co/guide/en/elasticsearch/reference/7.x/paginate-search-results.html#search-after
+        body = dict(query)
+        body.pop('from', None)
+        body['size'] = page_size
+
+        try:
+            pit = self.es.open_point_in_time(index=index, keep_alive=keep_alive)['id']
+            body['sort'] = sort + [{'_shard_doc': 'asc'}]
+        except TransportError:
+            pit = None
+            body['sort'] = sort + list(tiebreaker)
+
+        try:
+            while True:
+                if search_after is not None:
+                    body['search_after'] = search_after
+                if pit is not None:
+                    body['pit'] = {'id': pit, 'keep_alive': keep_alive}
+                    answer = timed('stream', self.es.search, body=body)
+                    pit = answer.get('pit_id', pit)
+                else:
+                    answer = timed('stream', self.es.search, index=index, body=body)
+
+                hits = answer['hits']['hits']
+                for hit in hits:
+                    yield hit
+                if len(hits) < page_size:
+                    break
+                search_after = hits[-1]['sort']
+        finally:
+            if pit is not None:
+                try:
+                    self.es.close_point_in_time(body={'id': pit})
+                except TransportError:
+                    pass
+            
+    def scan_slice(self, index, query, slice_id=0, slices=1, page_size=1000, scroll='2m'):
+        """ Generator over the hits of one slice of a sliced scroll. Run one
+            slice per thread (slice_id 0 .. slices-1) to read an index in
+            parallel; together the slices cover every hit of `query` once.
+        """
+        # https://www.elastic.co/guide/en/elasticsearch/reference/7.x/paginate-search-results.html#slice-scroll
+        body = dict(query)
+        body.pop('from', None)
+        body['size'] = page_size
+        body.setdefault('sort', ['_doc'])
+        if slices > 1:
+            body['slice'] = {'id': slice_id, 'max': slices}
+
+        answer = timed('scan', self.es.search, index=index, body=body, scroll=scroll)
+        scroll_id = answer.get('_scroll_id')
+        try:
+            while answer['hits']['hits']:
+                for hit in answer['hits']['hits']:
+                    yield hit
+                answer = timed('scan', self.es.scroll, scroll_id=scroll_id, scroll=scroll)
+                scroll_id = answer.get('_scroll_id', scroll_id)
+        finally:
+            if scroll_id is not None:
+                try:
+                    self.es.clear_scroll(scroll_id=scroll_id)
+                except TransportError:
+                    pass
+
+    def cache_stats(self):
+        return searchCache.stats()
+
     def create_index(self, index):
+        written(index)
         return self.es.indices.create(index=index, ignore=400)  # ignore if exist
     
     def delete_index(self, index):
+        written(index)
         try:
             self.es.indices.delete(index=index, ignore=[400, 404])
         except:
@@ -56,22 +431,187 @@ class ElasticSearchWrapper:
     def add_item(self, index, id, data):
         #print(data)
         res = self.es.index(index=index, id=id,  body=data)
+        written(index)
         ## # print(res)
         return res
 
     def delete_item(self, index, id):
         res = self.es.index(index=index, id=id)
+        written(index)
         # # print(res)
         return res
 
     def delete_by_ids(self, index, ids):
         query = {"query": {"terms": {"_id": ids}}}
         res = self.es.delete_by_query(index=index, body=query)
+        written(index)
         # # print(res)
         return res
 
+    def bulk(self, index, documents, max_retries=3, initial_backoff=2):
+        """ Index documents ({'_id': ..., '_source': ...} or plain dicts) with
+            one or more _bulk requests. Documents rejected with 429 (queue
+            full) are retried with exponential backoff; other failures are
+            returned.
+            Output:
+                indexed [int], errors [list]: Count of documents indexed and the failed items
+        """
+        # https://elasticsearch-py.readthedocs.io/en/7.x/helpers.html#elasticsearch.helpers.streaming_bulk
+        actions = [document if '_source' in document else {'_source': document} for document in documents]
+        indexed = 0
+        errors = list()
+        for ok, item in streaming_bulk(self.es, actions, index=index, chunk_size=max(len(actions), 1),
+                                       max_retries=max_retries, initial_backoff=initial_backoff,
+                                       raise_on_error=False, raise_on_exception=False):
+            if ok:
+                indexed += 1
+            else:
+                errors.append(item)
+        written(index)
+        return indexed, errors
+
+    def index_settings(self, index):
+        res = self.es.indices.get_settings(index=index)
+        # keyed by the concrete index name, which differs from index for an alias
+        return next(iter(res.values()))['settings']['index']
+
+    def put_index_settings(self, index, settings):
+        return self.es.indices.put_settings(index=index, body={'index': settings})
+
+    def refresh(self, index):
+        written(index)
+        return self.es.indices.refresh(index=index)
+
     def stats(self, index):
-        res = self.es.indices.stats(index=index)
+        res = flights.do((index, 'stats', ''), self.es.indices.stats, index=index)
         # # print(res)
         return res
-        
\ No newline at end of file
+
+    def index_version(self, index):
+        """ Summary and ETag of index, from a stats call at most every ES_STATS_TTL seconds """
+        version = indexVersions.get(index)
+        if version is None:
+            version = flights.do((index, 'index_version', ''), self.fetch_version, index)
+        return version
+
+    def fetch_version(self, index):
+        return indexVersions.put(index, self.es.indices.stats(index=index, metric=METRICS))
+        
+
+
+class AsyncElasticSearchWrapper:
+    """ asyncio version of the read side of ElasticSearchWrapper, used by
+        async_main.py. Searches go through the same response cache.
+    """
+    def __init__(self, es=None):
+        self.es = es if es is not None else shared_async_client()
+
+    async def search(self, index, query, version=None):
+        key = searchCache.key(index, query, version)
+        hits = searchCache.get(key)
+        if hits is not None:
+            return hits
+        return await asyncFlights.do((index, 'search') + key[1:], self.fetch_hits, index, query, key)
+
+    async def fetch_hits(self, index, query, key):
+        generation = searchCache.generation(index)
+        answer = await timed_async('search', self.es.search, index=index, body=query)
+        hits = answer['hits']['hits']
+        searchCache.put(key, hits, generation)
+        return hits
+
+    async def search_page(self, index, query):
+        key = searchCache.key(index, query) + ('total',)
+        page = searchCache.get(key)
+        if page is None:
+            page = await asyncFlights.do((index, 'search_page', key[1]), self.fetch_page, index, query, key)
+        return page['hits'], page['total']
+
+    async def fetch_page(self, index, query, key):
+        generation = searchCache.generation(index)
+        answer = await timed_async('search_page', self.es.search, index=index, body=query)
+        page = {'hits': answer['hits']['hits'], 'total': answer['hits'].get('total')}
+        searchCache.put(key, page, generation)
+        return page
+
+    async def aggregate(self, index, query):
+        key = searchCache.key(index, query)
+        aggregations = searchCache.get(key)
+        if aggregations is not None:
+            return aggregations
+        return await asyncFlights.do((index, 'aggregate', key[1]), self.fetch_aggregations, index, query, key)
+
+    async def fetch_aggregations(self, index, query, key):
+        generation = searchCache.generation(index)
+        answer = await timed_async('aggregate', self.es.search, index=index, body=query)
+        aggregations = answer.get('aggregations', {})
+        searchCache.put(key, aggregations, generation)
+        return aggregations
+
+    async def msearch(self, index, queries):
+        """ Async version of ElasticSearchWrapper.msearch() """
+        keys = [searchCache.key(index, query) for query in queries]
+        results = [searchCache.get(key) for key in keys]
+        missing = [i for i, hits in enumerate(results) if hits is None]
+        if missing:
+            generation = searchCache.generation(index)
+            body = list()
+            for i in missing:
+                body.append({})
+                body.append(queries[i])
+            answer = await asyncFlights.do((index, 'msearch', tuple(keys[i][1] for i in missing)),
+                                           timed_async, 'msearch', self.es.msearch, index=index, body=body)
+            msearch_results(answer, missing, keys, results, generation)
+        return results
+
+    async def stream(self, index, query, sort, page_size=1000, search_after=None, keep_alive='1m', tiebreaker=()):
+        """ Async generator version of ElasticSearchWrapper.stream() """
+        body = dict(query)
+        body.pop('from', None)
+        body['size'] = page_size
+
+        try:
+            pit = (await self.es.open_point_in_time(index=index, keep_alive=keep_alive))['id']
+            body['sort'] = sort + [{'_shard_doc': 'asc'}]
+        except TransportError:
+            pit = None
+            body['sort'] = sort + list(tiebreaker)
+
+        try:
+            while True:
+                if search_after is not None:
+                    body['search_after'] = search_after
+                if pit is not None:
+                    body['pit'] = {'id': pit, 'keep_alive': keep_alive}
+                    answer = await timed_async('stream', self.es.search, body=body)
+                    pit = answer.get('pit_id', pit)
+                else:
+                    answer = await timed_async('stream', self.es.search, index=index, body=body)
+
+                hits = answer['hits']['hits']
+                for hit in hits:
+                    yield hit
+                if len(hits) < page_size:
+                    break
+                search_after = hits[-1]['sort']
+        finally:
+            if pit is not None:
+                try:
+                    await self.es.close_point_in_time(body={'id': pit})
+                except TransportError:
+                    pass
+
+    def cache_stats(self):
+        return searchCache.stats()
+
+    async def stats(self, index):
+        return await asyncFlights.do((index, 'stats', ''), self.es.indices.stats, index=index)
+
+    async def index_version(self, index):
+        version = indexVersions.get(index)
+        if version is None:
+            version = await asyncFlights.do((index, 'index_version', ''), self.fetch_version, index)
+        return version
+
+    async def fetch_version(self, index):
+        return indexVersions.put(index, await self.es.indices.stats(index=index, metric=METRICS))
@@ -0,0 +1,235 @@
+import os
+import sys
+import json
+import glob
+import zlib
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from elastic_search_wrapper import ElasticSearchWrapper
+
+# the column types HitFinder reads the indices with, from calc_position/vault_es.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calc_position'))
+from vault_es import AIS_COLUMNS, TLE_COLUMNS
+
+# Export of an index to Parquet files for offline analysis, partitioned by
+# day and by a hash of the satellite/vessel id:
+#
+#   <out>/<index>/day=2015-01-01/bucket=03/slice-02-part-00000.parquet
+#
+#   python es_export.py ais_full /data/export --slices 8 --workers 8
+#
+# The index is read with a sliced scroll, one slice per task. A slice that
+# finishes writes a checkpoint under <out>/<index>/_checkpoints; running the
+# same export again skips finished slices and redoes the others (a scroll
+# cannot be resumed part way, so their partial files are removed first).
+# Every file has the same schema, built from the index's columns (see
+# vault_es.py; --columns for other indices), so the dataset reads back as
+# one table.
+# Needs pyarrow (pip install pyarrow).
+#
+# https://www.elastic.co/guide/en/elasticsearch/reference/7.x/paginate-search-results.html#slice-scroll
+# https://arrow.apache.org/docs/python/parquet.html
+
+# time field, id field and columns of the known indices
+INDICES = {
+    'ais': ('base_date_time', 'mmsi', AIS_COLUMNS),
+    'ais_full': ('base_date_time', 'mmsi', AIS_COLUMNS),
+    'tle': ('timestamp', 'satellite_number', TLE_COLUMNS),
+    'tle_full': ('timestamp', 'satellite_number', TLE_COLUMNS),
+}
+
+# Arrow types of the vault_es column kinds
+ARROW_TYPES = {
+    'str': pa.string(),
+    'time': pa.timestamp('ms', tz='UTC'),
+    'float': pa.float64(),
+    'int': pa.int64(),
+}
+
+
+def bucket_of(value, buckets):
+    """ Stable hash partition of an id (the same in every process and run) """
+    return zlib.crc32(str(value).encode('utf-8')) % buckets
+
+
+def schema_of(columns, fields=None):
+    """ Arrow schema of an index from its {name: kind} columns (kinds as in
+        vault_es.py), limited to `fields` when only some are exported
+    """
+    return pa.schema([(name, ARROW_TYPES[kind]) for name, kind in sorted(columns.items())
+                      if fields is None or name in fields])
+
+
+def text(value):
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return None
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+def to_table(df, schema):
+    """ Rows as an Arrow table of exactly `schema`, whatever the types in
+        this batch: a column missing from the batch or with no values is all
+        nulls, numbers that do not parse are nulls. Fields that are not in
+        the schema are dropped.
+    """
+    columns = dict()
+    for field in schema:
+        values = df[field.name] if field.name in df.columns else pd.Series([None] * len(df), dtype=object)
+        if pa.types.is_timestamp(field.type):
+            values = pd.to_datetime(values, utc=True, errors='coerce')
+        elif pa.types.is_floating(field.type):
+            values = pd.to_numeric(values, errors='coerce').astype('float64')
+        elif pa.types.is_integer(field.type):
+            values = pd.to_numeric(values, errors='coerce').astype('Int64')
+        else:
+            values = values.map(text).astype(object)
+        columns[field.name] = values
+    return pa.Table.from_pandas(pd.DataFrame(columns, index=df.index), schema=schema, preserve_index=False)
+
+
+class Exporter:
+    """ Writes the hits of one slice to partitioned Parquet files, a batch at a time """
+    def __init__(self, root, slice_id, time_field, id_field, schema, buckets):
+        self.root = root
+        self.slice_id = slice_id
+        self.time_field = time_field
+        self.id_field = id_field
+        self.schema = schema
+        self.buckets = buckets
+        self.parts = 0
+        self.rows = 0
+
+    def write(self, sources):
+        df = pd.DataFrame(sources)
+        times = pd.to_datetime(df[self.time_field], utc=True)
+        days = times.dt.strftime('%Y-%m-%d')
+        buckets = df[self.id_field].map(lambda x: bucket_of(x, self.buckets))
+        for (day, bucket), part in df.groupby([days, buckets], sort=False):
+            directory = os.path.join(self.root, 'day={}'.format(day), 'bucket={:02d}'.format(bucket))
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, 'slice-{:02d}-part-{:05d}.parquet'.format(self.slice_id, self.parts))
+            pq.write_table(to_table(part, self.schema), path, compression='snappy')
+            self.parts += 1
+        self.rows += len(df)
+
+
+def checkpoint_path(root, slice_id):
+    return os.path.join(root, '_checkpoints', 'slice-{:02d}.json'.format(slice_id))
+
+
+def export_slice(index, root, slice_id, slices, query, time_field, id_field, columns, buckets, batch_size, page_size):
+    """ Export one slice of index, unless its checkpoint says it is done.
+        Runs in a worker process.
+    """
+    checkpoint = checkpoint_path(root, slice_id)
+    if os.path.exists(checkpoint):
+        with open(checkpoint) as file:
+            return dict(json.load(file), skipped=True)
+
+    # Files of an earlier, unfinished run of this slice
+    for path in glob.glob(os.path.join(root, 'day=*', 'bucket=*', 'slice-{:02d}-part-*.parquet'.format(slice_id))):
+        os.remove(path)
+
+    start = time.monotonic()
+    es = ElasticSearchWrapper()
+    fields = query.get('_source') if isinstance(query.get('_source'), list) else None
+    exporter = Exporter(root, slice_id, time_field, id_field, schema_of(columns, fields), buckets)
+    batch = list()
+    for hit in es.scan_slice(index, query, slice_id=slice_id, slices=slices, page_size=page_size):
+        batch.append(hit['_source'])
+        if len(batch) >= batch_size:
+            exporter.write(batch)
+            batch = list()
+    if batch:
+        exporter.write(batch)
+
+    result = {'slice': slice_id, 'rows': exporter.rows, 'files': exporter.parts,
+              'seconds': time.monotonic() - start}
+    os.makedirs(os.path.dirname(checkpoint), exist_ok=True)
+    # Write then rename, so that a checkpoint is never partial
+    with open(checkpoint + '.tmp', 'w') as file:
+        json.dump(result, file)
+    os.replace(checkpoint + '.tmp', checkpoint)
+    return result
+
+
+def export(index, out, slices=8, workers=None, query=None, time_field=None, id_field=None, columns=None,
+           buckets=16, batch_size=50000, page_size=5000):
+    """ Export index to Parquet under out/index.
+        Inputs:
+            index [str]: Index to export
+            out [str]: Output directory
+            slices [int]: Scroll slices, i.e. export tasks (ideally a multiple of the shard count)
+            workers [int]: Worker processes (defaults to slices)
+            query [dict]: Query selecting the documents (all by default), may include _source
+            time_field, id_field [str]: Partition fields, defaults from INDICES
+            columns [dict]: {name: kind} of the exported columns, kinds as in vault_es.py; defaults from INDICES
+            buckets [int]: Id hash partitions per day
+            batch_size [int]: Hits held per slice before writing files
+            page_size [int]: Hits per scroll page
+        Output:
+            report [dict]: rows, files, seconds and per slice results
+    """
+    default_time_field, default_id_field, default_columns = INDICES.get(index, (None, None, None))
+    time_field = time_field or default_time_field
+    id_field = id_field or default_id_field
+    columns = columns or default_columns
+    if time_field is None or id_field is None or columns is None:
+        raise ValueError("time_field, id_field and columns are needed for index {}".format(index))
+
+    root = os.path.join(out, index)
+    query = query or {"query": {"match_all": {}}}
+    start = time.monotonic()
+    results = list()
+    with ProcessPoolExecutor(max_workers=workers or slices) as executor:
+        futures = [executor.submit(export_slice, index, root, slice_id, slices, query,
+                                   time_field, id_field, columns, buckets, batch_size, page_size)
+                   for slice_id in range(slices)]
+        for future in as_completed(futures):
+            result = future.result()
+            print("{} slice {}: {} rows{}".format(index, result['slice'], result['rows'],
+                                                  ' (already exported)' if result.get('skipped') else ''))
+            results.append(result)
+
+    return {'index': index,
+            'rows': sum(result['rows'] for result in results),
+            'files': sum(result['files'] for result in results),
+            'seconds': time.monotonic() - start,
+            'slices': sorted(results, key=lambda result: result['slice'])}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export an Elasticsearch index to Parquet partitioned by day and id hash')
+    parser.add_argument('index')
+    parser.add_argument('out')
+    parser.add_argument('--slices', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--buckets', type=int, default=16)
+    parser.add_argument('--batch-size', type=int, default=50000)
+    parser.add_argument('--page-size', type=int, default=5000)
+    parser.add_argument('--time-field', default=None)
+    parser.add_argument('--id-field', default=None)
+    parser.add_argument('--fields', default=None, help='comma separated fields to export (all by default)')
+    parser.add_argument('--columns', default=None, help='JSON {name: kind} of the columns, kinds str/time/float/int (for indices not in INDICES)')
+    args = parser.parse_args(argv)
+
+    query = {"query": {"match_all": {}}}
+    if args.fields:
+        query['_source'] = args.fields.split(',')
+
+    report = export(args.index, args.out, slices=args.slices, workers=args.workers, query=query,
+                    time_field=args.time_field, id_field=args.id_field,
+                    columns=json.loads(args.columns) if args.columns else None, buckets=args.buckets,
+                    batch_size=args.batch_size, page_size=args.page_size)
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
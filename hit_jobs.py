@@ -0,0 +1,179 @@
+import os
+import sys
+import uuid
+import threading
+import tempfile
+import collections
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import Future, ProcessPoolExecutor
+
+# HitFinder lives in calc_position, whose modules import each other as top level modules
+CALC_POSITION = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calc_position')
+
+# MySQL connection settings; there are no defaults, they must come from the environment
+DB_HOST = os.environ.get('VAULT_DB_HOST')
+DB_USER = os.environ.get('VAULT_DB_USER')
+DB_PASSWORD = os.environ.get('VAULT_DB_PASSWORD')
+
+# AIS/TLE data is loaded from MySQL, or from the search cluster with HIT_DATA_SOURCE=es
+DATA_SOURCE = os.environ.get('HIT_DATA_SOURCE', 'mysql')
+AIS_INDEX = os.environ.get('HIT_AIS_INDEX', 'ais')
+TLE_INDEX = os.environ.get('HIT_TLE_INDEX', 'tle')
+
+# Results are cached by request and data version. With HIT_DATA_SOURCE=es the
+# version follows the ETags of the AIS/TLE indices; MySQL data carries no
+# version, so change HIT_DATA_VERSION when it is reloaded. Either way results
+# are recomputed after HIT_CACHE_TTL seconds (0 keeps them until evicted).
+DATA_VERSION = os.environ.get('HIT_DATA_VERSION', '')
+CACHE_TTL = float(os.environ.get('HIT_CACHE_TTL', 3600))
+CACHE_DIR = os.environ.get('HIT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'vault-hit-cache'))
+CACHE_BYTES = int(os.environ.get('HIT_CACHE_BYTES', 512*1024*1024))
+
+
+def use_calc_position():
+    if CALC_POSITION not in sys.path:
+        sys.path.append(CALC_POSITION)
+
+
+def check_db_settings():
+    """ Fail early when the MySQL data source is used without its settings """
+    if DATA_SOURCE != 'mysql':
+        return
+    missing = [name for name, value in (('VAULT_DB_HOST', DB_HOST), ('VAULT_DB_USER', DB_USER),
+                                        ('VAULT_DB_PASSWORD', DB_PASSWORD)) if not value]
+    if missing:
+        raise RuntimeError("HIT_DATA_SOURCE=mysql needs {} to be set".format(', '.join(missing)))
+
+
+def find_hits(params):
+    """ Run a HitFinder for a parse_params style request, the way
+        calc_position/vault.py does as __main__. Runs in a worker process.
+    """
+    use_calc_position()
+    from vault import HitFinder
+
+    hitFinder = HitFinder(dict(params))
+    if DATA_SOURCE == 'es':
+        from elastic_search_wrapper import ElasticSearchWrapper
+        hitFinder.open_es_connection(ElasticSearchWrapper(), ais_index=AIS_INDEX, tle_index=TLE_INDEX)
+    else:
+        check_db_settings()
+        hitFinder.open_db_connection(host=DB_HOST, user=DB_USER, password=DB_PASSWORD)
+    hitFinder.load_ais_data()
+    hitFinder.load_tle_data()
+    return hitFinder.find_all_hits(json=False)
+
+
+def data_version():
+    """ Version of the AIS/TLE data that a request submitted now would read """
+    if DATA_SOURCE != 'es':
+        return DATA_VERSION
+    # results computed from the search cluster are cached apart from MySQL
+    # ones, and change with the indices
+    from elastic_search_wrapper import ElasticSearchWrapper
+    es = ElasticSearchWrapper()
+    return '{}:{}:{}:{}:{}:{}'.format(DATA_SOURCE, AIS_INDEX, es.index_version(AIS_INDEX)['etag'],
+                                      TLE_INDEX, es.index_version(TLE_INDEX)['etag'], DATA_VERSION)
+
+
+class HitJobQueue:
+    """ Runs HitFinder requests on a pool of worker processes so that long
+        computations do not hold up the web server; clients poll for the
+        result by job id. Only the most recent `max_jobs` jobs are kept.
+
+        Finished results go into a result_cache.ResultCache, and a request
+        that is already cached completes as soon as it is submitted.
+    """
+
+    def __init__(self, workers=2, max_jobs=100, cache_dir=None, cache_bytes=512*1024*1024, cache_ttl=None):
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.cache_dir = cache_dir
+        self.cache_bytes = cache_bytes
+        self.cache_ttl = cache_ttl
+        self.executor = None
+        self.cache = None
+        self.jobs = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, params):
+        if not params.get('times'):
+            raise ValueError("'times' must be a non-empty list of times")
+        check_db_settings()
+
+        hitFinder = self.hit_finder(params)
+        hits = hitFinder.cached_hits(json=False)
+        key = hitFinder.cache_key()
+
+        with self.lock:
+            if hits is not None:
+                future = Future()
+                future.set_result(hits)
+            else:
+                # Created on first use so that importing the API does not start workers.
+                # Spawned rather than forked: by now this process holds an Elasticsearch
+                # client and threads that a forked child would inherit in a broken state
+                if self.executor is None:
+                    self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                        mp_context=multiprocessing.get_context('spawn'))
+                future = self.executor.submit(find_hits, params)
+                future.add_done_callback(lambda done: self.__store(key, done))
+            job_id = uuid.uuid4().hex
+            self.jobs[job_id] = {
+                'job_id': job_id,
+                'submitted': datetime.utcnow().isoformat(),
+                'future': future,
+            }
+            while len(self.jobs) > self.max_jobs:
+                _, job = self.jobs.popitem(last=False)
+                job['future'].cancel()
+        return self.summary(job_id)
+
+    def hit_finder(self, params):
+        """ HitFinder (without data) for a request, used for result cache lookups """
+        use_calc_position()
+        from vault import HitFinder
+        from result_cache import ResultCache
+
+        if self.cache is None:
+            self.cache = ResultCache(path=self.cache_dir, max_bytes=self.cache_bytes, ttl=self.cache_ttl)
+        return HitFinder(dict(params), result_cache=self.cache, data_version=data_version())
+
+    def __store(self, key, future):
+        if not future.cancelled() and future.exception() is None:
+            self.cache.put(key, future.result())
+
+    def cache_stats(self):
+        if self.cache is None:
+            return {}
+        return self.cache.stats()
+
+    def summary(self, job_id):
+        """ Job id, submission time and status: pending, running, success or error """
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            return None
+
+        future = job['future']
+        if future.done():
+            status = 'error' if future.cancelled() or future.exception() is not None else 'success'
+        elif future.running():
+            status = 'running'
+        else:
+            status = 'pending'
+        return {'job_id': job_id, 'submitted': job['submitted'], 'status': status}
+
+    def result(self, job_id):
+        """ Hits of a finished job; raises the job's exception if it failed """
+        with self.lock:
+            job = self.jobs[job_id]
+        return job['future'].result(timeout=0)
+
+
+hit_jobs = HitJobQueue(workers=int(os.environ.get('HIT_WORKERS', 2)),
+                       max_jobs=int(os.environ.get('HIT_MAX_JOBS', 100)),
+                       cache_dir=CACHE_DIR,
+                       cache_bytes=CACHE_BYTES,
+                       cache_ttl=CACHE_TTL or None)
@@ -0,0 +1,126 @@
+import json
+import time
+import hashlib
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+
+from search_cache import overlaps
+
+# Versions of indices for conditional GETs (ETag / Last-Modified / 304).
+#
+# The version of an index is a short summary of its stats: document counts,
+# size and the index/delete operation totals of the primaries. Any write
+# changes one of them, so the summary doubles as the ETag. Summaries are
+# kept for `ttl` seconds, and dropped as soon as this process writes to the
+# index (see ElasticSearchWrapper), so polling clients cost one stats call
+# per ttl rather than one per request.
+#
+# https://developer.mozilla.org/en-US/docs/Web/HTTP/Conditional_requests
+# https://www.elastic.co/guide/en/elasticsearch/reference/7.x/indices-stats.html
+
+# Index stats metrics the summary is made from
+METRICS = 'docs,store,indexing'
+
+
+def summarize(stats):
+    """ Per index summary of an indices.stats() response (primaries only,
+        so replica moves and recoveries do not change it)
+    """
+    summary = dict()
+    for name, index in sorted(stats.get('indices', {}).items()):
+        primaries = index.get('primaries', {})
+        docs = primaries.get('docs', {})
+        indexing = primaries.get('indexing', {})
+        summary[name] = {
+            'docs': docs.get('count', 0),
+            'deleted': docs.get('deleted', 0),
+            'store_bytes': primaries.get('store', {}).get('size_in_bytes', 0),
+            'index_total': indexing.get('index_total', 0),
+            'delete_total': indexing.get('delete_total', 0),
+        }
+    return summary
+
+
+def etag(*parts):
+    """ Weak ETag of JSON serializable parts (weak, as the body may be
+        sent compressed or not)
+    """
+    text = json.dumps(parts, sort_keys=True, separators=(',', ':'), default=str)
+    return 'W/"{}"'.format(hashlib.sha1(text.encode('utf-8')).hexdigest()[:20])
+
+
+class IndexVersions:
+    """ Process wide cache of index summaries and their ETags.
+        An entry is {'summary': ..., 'etag': ..., 'last_modified': ...},
+        where last_modified is when this process first saw that version.
+    """
+
+    def __init__(self, ttl=10):
+        self.ttl = ttl
+        self.entries = dict()
+        self.seen = dict()
+        self.lock = threading.Lock()
+
+    def get(self, index):
+        """ Cached version of index, or None """
+        with self.lock:
+            entry = self.entries.get(index)
+            if entry is not None and entry['expires'] >= time.monotonic():
+                return entry
+            return None
+
+    def put(self, index, stats):
+        """ Version of index from a fresh indices.stats() response """
+        summary = summarize(stats)
+        tag = etag(summary)
+        with self.lock:
+            # keep the first time a version was seen, for Last-Modified
+            previous = self.seen.get(index)
+            last_modified = previous[1] if previous is not None and previous[0] == tag else time.time()
+            self.seen[index] = (tag, last_modified)
+            entry = {'summary': summary, 'etag': tag, 'last_modified': last_modified,
+                     'expires': time.monotonic() + self.ttl}
+            self.entries[index] = entry
+        return entry
+
+    def invalidate(self, index):
+        """ Drop the versions of `index`; comma lists and wildcards as in SearchCache.invalidate() """
+        with self.lock:
+            for key in [key for key in self.entries if overlaps(key, index)]:
+                del self.entries[key]
+
+
+def validators(tag, last_modified):
+    """ Response headers for a version """
+    return {'ETag': tag,
+            'Last-Modified': formatdate(last_modified, usegmt=True),
+            'Cache-Control': 'no-cache'}
+
+
+def not_modified(headers, tag, last_modified):
+    """ True when the request's If-None-Match (or, without it, If-Modified-Since)
+        says the client already has this version
+    """
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match is not None:
+        # weak comparison: W/"x" matches "x"
+        tags = [value.strip() for value in if_none_match.split(',')]
+        return '*' in tags or tag.replace('W/', '') in [value.replace('W/', '') for value in tags]
+
+    if_modified_since = headers.get('If-Modified-Since')
+    if if_modified_since is not None:
+        try:
+            return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def conditional(request_headers, version, *parts):
+    """ Conditional GET of a response made from an index version and other
+        parts (query body, fields, ...) that it depends on.
+        Output:
+            (not_modified [bool], headers [dict]): headers are ETag and Last-Modified for the response
+    """
+    tag = etag(version['etag'], *parts) if parts else version['etag']
+    return not_modified(request_headers, tag, version['last_modified']), validators(tag, version['last_modified'])
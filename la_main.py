@@ -6,8 +6,17 @@ from flask import Flask, jsonify, render_template, request, url_for
 from flask_restplus import Api, Resource, fields, reqparse
 from flask_cors import CORS,cross_origin
 
-from elastic_search_wrapper import ElasticSearchWrapper
+if os.environ.get('LA_SEARCH_BACKEND') == 'sqlite':
+    # embedded full-text index instead of the cluster, see sqlite_search_backend.py
+    from sqlite_search_backend import SQLiteSearchWrapper as ElasticSearchWrapper, retry_after
+else:
+    from elastic_search_wrapper import ElasticSearchWrapper, retry_after
 from payload_wrapper import PayloadWrapper
+import response_pipeline
+import metrics
+import index_versions
+import search_queries
+from source_fields import SENTENCE_FIELDS, FIELDS_HELP, source_filter, with_field
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'the quick brown fox jumps over the lazy   dog'
@@ -37,6 +46,8 @@ api = Api(app,
         title='Value Search API',
         description='Elastic Search for Vault ',
         )
+response_pipeline.register(api)
+metrics.instrument(app, 'valuesearch')
 ns = api.namespace('valuesearch/api/v1', description='Search for value data')
 
 @ns.route('/')
@@ -75,8 +86,7 @@ class Stats(Resource):
             return res, 200, pw.headers()
 
         except Exception as message:
-            res = pw.error(message)
-            return res, 400, pw.headers()
+            return pw.failure(message, retry_after(message))
 
 @ns.route('/stats/<string:indexName>')
 class Stats(Resource):
@@ -85,20 +95,43 @@ class Stats(Resource):
         pw = PayloadWrapper()
         return "OK", 200, pw.headers()
 
-    @ns.doc('query about an index in the catalog')
+    @ns.doc('query about an index in the catalog', params={'full': 'true for the complete index stats instead of the cached summary'})
     def get(self, indexName):
         pw = PayloadWrapper()
         try:
 
             es = ElasticSearchWrapper()
-            hits = es.stats(indexName)
-            res = pw.success([hits])
-            return res, 200, pw.headers()
+            if request.args.get('full') == 'true':
+                hits = es.stats(indexName)
+                res = pw.success([hits])
+                return res, 200, pw.headers()
+
+            version = es.index_version(indexName)
+            unchanged, validators = index_versions.conditional(request.headers, version)
+            headers = dict(pw.headers(), **validators)
+            if unchanged:
+                return None, 304, headers
+
+            res = pw.success([version['summary']])
+            return res, 200, headers
 
         except Exception as message:
             # print(message)
-            res = pw.error(message)
-            return res, 400, pw.headers()
+            return pw.failure(message, retry_after(message))
+
+@ns.route('/cache')
+class SearchCacheStats(Resource):
+    @api.hide
+    def options(self):
+        pw = PayloadWrapper()
+        return "OK", 200, pw.headers()
+
+    @ns.doc('hit rates of the search response cache')
+    def get(self):
+        pw = PayloadWrapper()
+        es = ElasticSearchWrapper()
+        res = pw.success([es.cache_stats()])
+        return res, 200, pw.headers()
 
 @ns.route('/case/<string:caseid>')  
 class QueryCase(Resource):
@@ -107,7 +140,7 @@ class QueryCase(Resource):
         pw = PayloadWrapper()
         return "OK", 200, pw.headers()
 
-    @ns.doc('search for a case with caseID')
+    @ns.doc('search for a case with caseID', params={'fields': FIELDS_HELP})
     def get(self, caseid):
         pw = PayloadWrapper()
 
@@ -117,16 +150,9 @@ class QueryCase(Resource):
       
             indexName = 'la-document'
 
-            queryBody = {
-                "from" : 0, "size" : 1000,
-                "query": {
-                    "match": {
-                        "caseID": {
-                            "query": caseid
-                            }
-                        }
-                    }
-                }
+            queryBody = search_queries.case(caseid)
+
+            queryBody['_source'] = source_filter(request.args.get('fields'))
 
             hits = es.search(indexName, queryBody)
 
@@ -135,8 +161,24 @@ class QueryCase(Resource):
 
         except Exception as message:
             print(message)
-            res = pw.error(message)
-            return res, 400, pw.headers()
+            return pw.failure(message, retry_after(message))
+
+# paging of /query and /search, see search_queries.sentence_page()
+PAGE_PARAMS = {'page_size': 'sentences per page (default 50, at most 1000)',
+               'after': 'cursor of the previous page',
+               'total': 'true to count every match, false not to count, or a count to stop at (default 1000)',
+               'highlight': 'true for the matched fragments of text in highlight',
+               'with_context': 'true to add the other sentences of each paragraph to its hit, as paragraph'}
+
+
+def attach_context(es, hits, source):
+    """ Sentence hits with their paragraphs, looked up with an _msearch per BATCH_LIMIT contexts """
+    keys, results = list(), list()
+    for batchKeys, queries in search_queries.context_batches(hits, source):
+        keys.extend(batchKeys)
+        results.extend(es.msearch('la-sentence', queries))
+    return search_queries.with_paragraphs(hits, keys, results)
+
 
 general = api.model('general', {
     'rhetclass': fields.String(example=' ', required=False, description='The RhetRule as a filter, like FindingSentence EvidenceSentence'),
@@ -155,7 +197,7 @@ class QuerySentence(Resource):
         pw = PayloadWrapper()
         return "OK", 200, pw.headers()
 
-    @ns.doc('compound search for a sentence containing')
+    @ns.doc('compound search for a sentence containing', params=dict(PAGE_PARAMS, fields=FIELDS_HELP))
     # @cross_origin(origin='localhost',headers=['Content- Type','Authorization'])
     @ns.expect(general)
     def post(self):
@@ -180,88 +222,25 @@ class QuerySentence(Resource):
             es = ElasticSearchWrapper()
             indexName = 'la-sentence'
 
-            mustPhrase = []
-            if (len(includeany.strip()) > 0):
-                q = {
-                    "match": {
-                        "text": {
-                            "query": includeany,
-                            "operator": 'or'
-                        }
-                    }
-                }
-                mustPhrase.append(q)
-
-            if (len(includeall.strip()) > 0):
-                q = {
-                    "match": {
-                        "text": {
-                            "query": includeall,
-                            "operator": 'and'
-                        }
-                    }
-                }
-                mustPhrase.append(q)
-
-            if (len(exactphrase.strip()) > 0):
-                q = {
-                    "match_phrase": {
-                        "text": {
-                            "query": exactphrase,
-                        }
-                    }
-                }
-                mustPhrase.append(q)   
-
-            filterPhrase = {}
-            print(rhetclass)
-            if rhetclass.find("Sentence") > -1:
-                filterPhrase =  {
-                            "match": {
-                                "rhetClass": {
-                                    "query" : rhetclass
-                                }
-                            }
-                        }
-
-            must_notPhrase = {}
-            if (len(excludeany.strip()) > 0):
-                must_notPhrase =  {
-                            "match": {
-                                "text": {
-                                    "query" : excludeany
-                                }
-                            }
-                        }
-
-            boolPhrase = {}
-            if (len(mustPhrase) > 0):
-                boolPhrase['must'] = mustPhrase
-
-            if (len(filterPhrase) > 0):
-                boolPhrase['filter'] = filterPhrase
-
-            if (len(must_notPhrase) > 0):
-                boolPhrase['must_not'] = must_notPhrase
-
-            queryBody = {
-                    "from" : 0, "size" : 1000,
-                    "query": {
-                        "bool": boolPhrase
-                    }
-                }
-
-            # print(queryBody)
-                
-           
-            hits = es.search(indexName, queryBody)
+            queryBody = search_queries.compound_sentences(rhetclass, includeany, includeall, exactphrase, excludeany)
+
+            source = source_filter(request.args.get('fields'), SENTENCE_FIELDS)
+            withContext = request.args.get('with_context') == 'true'
+            # the paragraph of a hit is found by its context
+            queryBody['_source'] = with_field(source, 'context') if withContext else source
+            queryBody = search_queries.sentence_page(queryBody, request.args)
+
+            hits, total = es.search_page(indexName, queryBody)
+            if withContext:
+                hits = attach_context(es, hits, source)
 
             res = pw.success(hits)
+            res['total'] = total
+            res['cursor'] = search_queries.page_cursor(hits, queryBody)
             return res, 200, pw.headers()
 
         except Exception as message:
-            res = pw.error(message)
-            return res, 400, pw.headers()
+            return pw.failure(message, retry_after(message))
 
 simple = api.model('simple', {
     'rhetclass': fields.String(example=' ', required=False,description='The RhetRule as a filter'),
@@ -276,6 +255,7 @@ class SearchSentence(Resource):
         pw = PayloadWrapper()
         return "OK", 200, pw.headers()
 
+    @ns.doc(params=dict(PAGE_PARAMS, fields=FIELDS_HELP))
     @ns.expect(simple)
     # @cross_origin(origin='localhost',headers=['Content- Type','Authorization'])
     def post(self):
@@ -293,57 +273,65 @@ class SearchSentence(Resource):
             rhetclass = args['rhetclass']
             text = args['text']
             queryrule = args['queryrule']
-            if (len(queryrule.strip()) == 0):
-                queryrule = 'or'
-
             es = ElasticSearchWrapper()
             indexName = 'la-sentence'
 
-            queryBody = {
-                "from" : 0, "size" : 1000,
-                "query": {
-                    "match": {
-                        "text": {
-                            "query": text,
-                            "operator": queryrule
-                            }
-                        }
-                    }
-                }
-
-            if rhetclass.find("Sentence") > -1:
-                queryBody['query'] = {
-                    "bool": {
-                        "must": [
-                                {
-                                    "match":{
-                                        "rhetClass": {
-                                            "query" : rhetclass
-                                        }
-                                    }
-                                },{
-                                    "match": {
-                                        "text": {
-                                            "query": text,
-                                             "operator": queryrule
-                                        }
-                                    }
-                                }
-                                ]
-                            }
-                    }
-                
+            queryBody = search_queries.simple_sentences(rhetclass, text, queryrule)
+
             print(queryBody)
 
-            hits = es.search(indexName, queryBody)
-            # print(hits)
+            source = source_filter(request.args.get('fields'), SENTENCE_FIELDS)
+            withContext = request.args.get('with_context') == 'true'
+            # the paragraph of a hit is found by its context
+            queryBody['_source'] = with_field(source, 'context') if withContext else source
+            queryBody = search_queries.sentence_page(queryBody, request.args)
+
+            hits, total = es.search_page(indexName, queryBody)
+            if withContext:
+                hits = attach_context(es, hits, source)
 
             res = pw.success(hits)
+            res['total'] = total
+            res['cursor'] = search_queries.page_cursor(hits, queryBody)
+            return res, 200, pw.headers()
+
+        except Exception as message:
+            return pw.failure(message, retry_after(message))
+
+context_batch = api.model('context_batch', {
+    'contexts': fields.List(fields.String, required=True, description='Contexts, each looked up as /context/<context> does'),
+ })
+
+@ns.route('/contexts')
+class BatchContexts(Resource):
+    @api.hide
+    def options(self):
+        pw = PayloadWrapper()
+        return "OK", 200, pw.headers()
+
+    @ns.doc('the sentences of many paragraphs with one search; results are keyed by context', params={'fields': FIELDS_HELP})
+    @ns.expect(context_batch)
+    def post(self):
+        pw = PayloadWrapper()
+
+        try:
+            args = request.get_json(force=True)
+            es = ElasticSearchWrapper()
+
+            indexName = 'la-sentence'
+
+            keys, queries = search_queries.batch({
+                'contexts': (args.get('contexts'), search_queries.context_sentences),
+            }, source_filter(request.args.get('fields'), SENTENCE_FIELDS))
+
+            hits = es.msearch(indexName, queries)
+
+            res = pw.success([search_queries.keyed(keys, hits)])
             return res, 200, pw.headers()
 
         except Exception as message:
-            res = pw.error(message)
-            return res, 400, pw.headers()
+            print(message)
+            return pw.failure(message, retry_after(message))
 
 @ns.route('/context/<string:context>')  
 class SentencesWithContext(Resource):
@@ -352,7 +340,7 @@ class SentencesWithContext(Resource):
         pw = PayloadWrapper()
         return "OK", 200, pw.headers()
 
-    @ns.doc('search for other sentences in the same document and paragraph')
+    @ns.doc('search for other sentences in the same document and paragraph', params={'fields': FIELDS_HELP})
     def get(self, context):
         pw = PayloadWrapper()
         try:
@@ -360,17 +348,9 @@ class SentencesWithContext(Resource):
             es = ElasticSearchWrapper()
             indexName = 'la-sentence'
 
-            # https://stackoverflow.com/questions/37709100/how-do-i-do-a-partial-match-in-elasticsearch
-            queryBody = {
-                "from" : 0, "size" : 100,
-                "query": {
-                    "match": {
-                        "context": {
-                            "query": context
-                            }
-                        }
-                    }
-                }
+            queryBody = search_queries.context_sentences(context)
+
+            queryBody['_source'] = source_filter(request.args.get('fields'), SENTENCE_FIELDS)
 
             hits = es.search(indexName, queryBody)
 
@@ -378,8 +358,7 @@ class SentencesWithContext(Resource):
             return res, 200, pw.headers()
 
         except Exception as message:
-            res = pw.error(message)
-            return res, 400, pw.headers()
+            return pw.failure(message, retry_after(message))
 
 
 def startup():
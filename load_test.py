@@ -0,0 +1,289 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import contextlib
+import threading
+import http.client
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from elasticsearch import TransportError
+from werkzeug.serving import make_server
+
+import elastic_search_wrapper
+
+# Load test of the vault and valuesearch APIs against an in-process fake
+# Elasticsearch that answers with the canned hits in data/vault, so request
+# rates and latency percentiles can be compared between commits offline.
+#
+#   python load_test.py --duration 30 --concurrency 16 --mix ships=1,ship=4,satellite=4,search=2
+#   python load_test.py --es-latency 20 --no-cache --json report.json --max-p99 250
+#   python load_test.py --target http://localhost:8000 --mix ship=1     (a running server instead)
+#
+# The apps are served by werkzeug's threaded server on free local ports.
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'vault')
+
+# name -> (api, method, path, JSON body); {n} is replaced by a number below --distinct
+ENDPOINTS = {
+    'ships': ('vault', 'GET', '/vault/api/v1/ships', None),
+    'ship': ('vault', 'GET', '/vault/api/v1/ship/VESSEL{n}', None),
+    'satellite': ('vault', 'GET', '/vault/api/v1/satellites/78068{n}', None),
+    'search': ('valuesearch', 'POST', '/valuesearch/api/v1/search?page_size=20',
+               {'rhetclass': '', 'text': 'service vietnam {n}', 'queryrule': 'or'}),
+    'query': ('valuesearch', 'POST', '/valuesearch/api/v1/query?page_size=20',
+              {'rhetclass': 'FindingSentence', 'includeany': 'knee {n}', 'includeall': '', 'exactphrase': '', 'excludeany': 'shoulder'}),
+    'stats': ('vault', 'GET', '/vault/api/v1/stats/ais', None),
+}
+DEFAULT_MIX = 'ships=1,ship=4,satellite=4,search=2'
+
+
+def canned_hits(filename):
+    with open(os.path.join(DATA, filename)) as file:
+        return json.load(file)['payload']
+
+
+def sentence_hits(count=2000):
+    random.seed(7)
+    words = 'service vietnam veteran knee back hearing loss tinnitus ptsd board finds evidence record exam claim'.split()
+    return [{'_index': 'la-sentence', '_id': str(i), '_score': 1.0,
+             '_source': {'text': ' '.join(random.choice(words) for _ in range(20)),
+                         'rhetClass': random.choice(['FindingSentence', 'EvidenceSentence', 'ReasoningSentence']),
+                         'context': 'doc{}_p{}'.format(i // 40, (i // 8) % 5), 'caseID': 'case{}'.format(i // 40)}}
+            for i in range(count)]
+
+
+class FakeIndices:
+    def __init__(self, es):
+        self.es = es
+
+    def stats(self, index=None, **kwargs):
+        docs = len(self.es.hits.get(index, []))
+        primaries = {'docs': {'count': docs, 'deleted': 0}, 'store': {'size_in_bytes': docs * 600},
+                     'indexing': {'index_total': docs, 'delete_total': 0}}
+        return {'_all': {'primaries': primaries, 'total': primaries},
+                'indices': {index: {'primaries': primaries, 'total': primaries}}}
+
+
+class FakeElasticsearch:
+    """ Stand-in for the elasticsearch client that answers every search of an
+        index with (a page of) its canned hits, after `latency` seconds
+    """
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.indices = FakeIndices(self)
+        self.hits = {'ais': canned_hits('shipALASKASPIRIT.json'),
+                     'tle': canned_hits('sat78068B.json'),
+                     'la-sentence': sentence_hits(),
+                     'la-document': []}
+
+    def search(self, index=None, body=None, **kwargs):
+        time.sleep(self.latency)
+        body = body or {}
+        hits = self.hits.get(index, [])
+        size = body.get('size', 10)
+        page = hits[body.get('from', 0):body.get('from', 0) + size]
+        source = body.get('_source', True)
+        if isinstance(source, list):
+            page = [dict(hit, _source={field: hit['_source'][field] for field in source if field in hit['_source']}) for hit in page]
+        if body.get('sort'):
+            page = [dict(hit, sort=[hit.get('_score') or 1.0, hit['_id']]) for hit in page]
+        answer = {'took': int(self.latency * 1000), 'timed_out': False,
+                  'hits': {'total': {'value': len(hits), 'relation': 'eq'}, 'hits': page}}
+        if 'aggs' in body:
+            answer['aggregations'] = {}
+        return answer
+
+    def msearch(self, index=None, body=None, **kwargs):
+        time.sleep(self.latency)
+        responses = [self.search(index=header.get('index', index), body=query) for header, query in zip(body[0::2], body[1::2])]
+        return {'took': int(self.latency * 1000), 'responses': responses}
+
+    def open_point_in_time(self, **kwargs):
+        raise TransportError(400, 'point in time is not supported by the fake')
+
+
+def serve(app):
+    """ Serve a WSGI app on a free local port in a daemon thread; returns the base URL """
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:{}'.format(server.server_port), server
+
+
+def start_apps(latency=0.0, cache=True):
+    elastic_search_wrapper.set_shared_client(FakeElasticsearch(latency))
+    if not cache:
+        elastic_search_wrapper.searchCache.ttl = 0
+    import main
+    import la_main
+    vault, vaultServer = serve(main.app)
+    valuesearch, valuesearchServer = serve(la_main.app)
+    return {'vault': vault, 'valuesearch': valuesearch}, [vaultServer, valuesearchServer]
+
+
+def parse_mix(mix):
+    weights = dict()
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        if name not in ENDPOINTS:
+            raise ValueError("unknown endpoint {}: expected one of {}".format(name, ', '.join(ENDPOINTS)))
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def request(connections, bases, name, n, gzip=False):
+    """ Send one request of an endpoint; returns (status, body bytes) """
+    api, method, path, body = ENDPOINTS[name]
+    url = urllib.parse.urlsplit(bases[api])
+    path = path.replace('{n}', str(n))
+    headers = {'Accept': 'application/json'}
+    if gzip:
+        headers['Accept-Encoding'] = 'gzip'
+    data = None
+    if body is not None:
+        data = json.dumps({key: value.replace('{n}', str(n)) for key, value in body.items()}).encode('utf-8')
+        headers['Content-Type'] = 'application/json'
+
+    connection = connections.get(url.netloc)
+    if connection is None:
+        connection = connections[url.netloc] = http.client.HTTPConnection(url.hostname, url.port, timeout=60)
+    try:
+        connection.request(method, path, body=data, headers=headers)
+        response = connection.getresponse()
+        payload = response.read()
+        if response.getheader('Connection', '').lower() == 'close' or response.version == 10:
+            connection.close()
+            del connections[url.netloc]
+        return response.status, payload
+    except (http.client.HTTPException, OSError):
+        connection.close()
+        connections.pop(url.netloc, None)
+        raise
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def summary(latencies, errors, seconds, size):
+    return {'requests': len(latencies),
+            'errors': errors,
+            'rps': round(len(latencies) / seconds, 1) if seconds > 0 else 0.0,
+            'mean_ms': round(sum(latencies) / len(latencies), 2) if latencies else 0.0,
+            'p50_ms': round(percentile(latencies, 50), 2),
+            'p90_ms': round(percentile(latencies, 90), 2),
+            'p95_ms': round(percentile(latencies, 95), 2),
+            'p99_ms': round(percentile(latencies, 99), 2),
+            'max_ms': round(max(latencies), 2) if latencies else 0.0,
+            'mean_bytes': int(size / len(latencies)) if latencies else 0}
+
+
+def run(bases, mix, concurrency=8, duration=10.0, rps=None, distinct=50, gzip=False, seed=1):
+    """ Send requests from `concurrency` threads for `duration` seconds, each
+        picking an endpoint by the `mix` weights; at most `rps` per second
+        in total when given.
+        Output:
+            report [dict]: summary() of every endpoint and of all of them
+    """
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    results = {name: {'latencies': [], 'errors': 0, 'bytes': 0} for name in names}
+    lock = threading.Lock()
+    start = time.monotonic()
+    stop = start + duration
+    interval = concurrency / rps if rps else 0.0
+
+    def worker(number):
+        chooser = random.Random(seed + number)
+        connections = dict()
+        due = time.monotonic()
+        while True:
+            if interval:
+                due += interval
+                time.sleep(max(0.0, due - time.monotonic()))
+            if time.monotonic() >= stop:
+                break
+            name = chooser.choices(names, weights)[0]
+            sent = time.perf_counter()
+            try:
+                status, payload = request(connections, bases, name, chooser.randrange(distinct), gzip)
+                failed = status >= 400
+            except Exception:
+                payload = b''
+                failed = True
+            elapsed = (time.perf_counter() - sent) * 1000
+            with lock:
+                result = results[name]
+                result['latencies'].append(elapsed)
+                result['bytes'] += len(payload)
+                result['errors'] += failed
+        for connection in connections.values():
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, range(concurrency)))
+    seconds = time.monotonic() - start
+
+    report = {name: summary(result['latencies'], result['errors'], seconds, result['bytes'])
+              for name, result in results.items()}
+    report['all'] = summary([value for result in results.values() for value in result['latencies']],
+                            sum(result['errors'] for result in results.values()), seconds,
+                            sum(result['bytes'] for result in results.values()))
+    return report
+
+
+def print_report(report):
+    columns = ['requests', 'errors', 'rps', 'mean_ms', 'p50_ms', 'p90_ms', 'p95_ms', 'p99_ms', 'max_ms', 'mean_bytes']
+    print('{:<10}'.format('endpoint') + ''.join('{:>11}'.format(column) for column in columns))
+    for name, row in report.items():
+        print('{:<10}'.format(name) + ''.join('{:>11}'.format(row[column]) for column in columns))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the search APIs against a fake Elasticsearch')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='endpoint=weight,... from: {}'.format(', '.join(ENDPOINTS)))
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds')
+    parser.add_argument('--rps', type=float, default=None, help='target requests per second (as fast as possible by default)')
+    parser.add_argument('--distinct', type=int, default=50, help='distinct names/texts per endpoint; fewer means more cache hits')
+    parser.add_argument('--es-latency', type=float, default=0.0, help='milliseconds the fake Elasticsearch takes per request')
+    parser.add_argument('--no-cache', action='store_true', help='turn off the search response cache')
+    parser.add_argument('--gzip', action='store_true', help='ask for gzip responses')
+    parser.add_argument('--target', default=None, help='base URL of a running server to test instead (serving both APIs)')
+    parser.add_argument('--json', default=None, help='also write the report to this file')
+    parser.add_argument('--max-p99', type=float, default=None, help='exit with 1 if the overall p99 is above this many ms')
+    args = parser.parse_args(argv)
+
+    mix = parse_mix(args.mix)
+    if args.target:
+        bases = {'vault': args.target, 'valuesearch': args.target}
+    else:
+        bases, servers = start_apps(args.es_latency / 1000.0, cache=not args.no_cache)
+
+    # the handlers print every query; keep that out of the report
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        # warm up: first requests build routes, swagger models and connections
+        run(bases, mix, concurrency=1, duration=0.5, distinct=args.distinct, gzip=args.gzip)
+        report = run(bases, mix, concurrency=args.concurrency, duration=args.duration, rps=args.rps,
+                     distinct=args.distinct, gzip=args.gzip)
+    print_report(report)
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(dict(report, settings=vars(args)), file, indent=2)
+    if args.max_p99 is not None and report['all']['p99_ms'] > args.max_p99:
+        print("p99 {} ms is above {} ms".format(report['all']['p99_ms'], args.max_p99))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
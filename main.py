@@ -2,12 +2,18 @@ import os
 import json
 import logging
 
-from flask import Flask, jsonify, render_template, request, url_for
+from flask import Flask, Response, jsonify, render_template, request, stream_with_context, url_for
 from flask_restplus import Api, Resource, fields, reqparse
 from flask_cors import CORS,cross_origin
 
-from elastic_search_wrapper import ElasticSearchWrapper
+from elastic_search_wrapper import ElasticSearchWrapper, retry_after
 from payload_wrapper import PayloadWrapper
+import response_pipeline
+import metrics
+import index_versions
+import search_queries
+from source_fields import AIS_FIELDS, TLE_FIELDS, FIELDS_HELP, source_filter
+from hit_jobs import hit_jobs
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'the quick brown fox jumps over the lazy   dog'
@@ -49,6 +55,8 @@ api = Api(app,
         title='SAIC Vault Search API',
         description='Elastic Search for Vault ',
         )
+response_pipeline.register(api)
+metrics.instrument(app, 'vault')
 ns = api.namespace('vault/api/v1', description='Search for vault data')
 
 @ns.route('/')
@@ -87,8 +95,7 @@ class Stats(Resource):
             return res, 200, pw.headers()
 
         except Exception as message:
-            res = pw.error(message)
-            return res, 400, pw.headers()
+            return pw.failure(message, retry_after(message))
 
 
 # green open ais                             4K3IfR0WSOujlJhheKKGRQ 5 1   669895 0 284.5mb 142.2mb
@@ -103,20 +110,43 @@ class Stats(Resource):
         pw = PayloadWrapper()
         return "OK", 200, pw.headers()
 
-    @ns.doc('query about an index in the catalog')
+    @ns.doc('query about an index in the catalog', params={'full': 'true for the complete index stats instead of the cached summary'})
     def get(self, indexName):
         pw = PayloadWrapper()
         try:
 
             es = ElasticSearchWrapper()
-            hits = es.stats(indexName)
-            res = pw.success([hits])
-            return res, 200, pw.headers()
+            if request.args.get('full') == 'true':
+                hits = es.stats(indexName)
+                res = pw.success([hits])
+                return res, 200, pw.headers()
+
+            version = es.index_version(indexName)
+            unchanged, validators = index_versions.conditional(request.headers, version)
+            headers = dict(pw.headers(), **validators)
+            if unchanged:
+                return None, 304, headers
+
+            res = pw.success([version['summary']])
+            return res, 200, headers
 
         except Exception as message:
             # print(message)
-            res = pw.error(message)
-            return res, 400, pw.headers()
+            return pw.failure(message, retry_after(message))
+
+@ns.route('/cache')
+class SearchCacheStats(Resource):
+    @api.hide
+    def options(self):
+        pw = PayloadWrapper()
+        return "OK", 200, pw.headers()
+
+    @ns.doc('hit rates of the search response cache')
+    def get(self):
+        pw = PayloadWrapper()
+        es = ElasticSearchWrapper()
+        res = pw.success([es.cache_stats()])
+        return res, 200, pw.headers()
 
 @ns.route('/ships')  
 class QueryAllShips(Resource):
@@ -125,7 +155,7 @@ class QueryAllShips(Resource):
         pw = PayloadWrapper()
         return "OK", 200, pw.headers()
 
-    @ns.doc('search for all ships')
+    @ns.doc('search for all ships', params={'fields': FIELDS_HELP})
     def get(self):
         pw = PayloadWrapper()
 
@@ -135,12 +165,9 @@ class QueryAllShips(Resource):
       
             indexName = 'ais'
 
-            queryBody = {
-                "from": 0, "size": 5000,
-                "query": {
-                    "match_all": {}
-                }
-            }
+            queryBody = search_queries.all_ships()
+
+            queryBody['_source'] = source_filter(request.args.get('fields'), AIS_FIELDS)
 
             hits = es.search(indexName, queryBody)
 
@@ -149,8 +176,102 @@ class QueryAllShips(Resource):
 
         except Exception as message:
             print(message)
-            res = pw.error(message)
-            return res, 400, pw.headers()
+            return pw.failure(message, retry_after(message))
+
+
+@ns.route('/ships/heatmap')
+class ShipHeatmap(Resource):
+    @api.hide
+    def options(self):
+        pw = PayloadWrapper()
+        return "OK", 200, pw.headers()
+
+    @ns.doc('AIS position counts and centroids per map cell, computed in the cluster',
+            params={'grid': 'geotile (default) or geohash', 'precision': 'zoom level for geotile (default 7), length for geohash (default 5)',
+                    'bbox': 'min_lon,min_lat,max_lon,max_lat', 'start': 'earliest base_date_time', 'end': 'latest base_date_time',
+                    'vessel_name': 'Only count this vessel', 'size': 'most cells returned (default 10000)'})
+    def get(self):
+        pw = PayloadWrapper()
+
+        try:
+            es = ElasticSearchWrapper()
+
+            indexName = 'ais'
+
+            queryBody = search_queries.ship_heatmap(request.args)
+
+            aggregations = es.aggregate(indexName, queryBody)
+
+            res = pw.success(search_queries.heatmap_cells(aggregations))
+            return res, 200, pw.headers()
+
+        except Exception as message:
+            print(message)
+            return pw.failure(message, retry_after(message))
+
+
+@ns.route('/ships/latest')
+class LatestShips(Resource):
+    @api.hide
+    def options(self):
+        pw = PayloadWrapper()
+        return "OK", 200, pw.headers()
+
+    @ns.doc('the latest record of every vessel, a page of vessels at a time; pass cursor back as after for the next page',
+            params={'index': 'ais (default) or ais_full', 'bbox': 'min_lon,min_lat,max_lon,max_lat', 'start': 'earliest base_date_time',
+                    'end': 'latest base_date_time', 'vessel_name': 'Only this vessel', 'page_size': 'vessels per page (default 1000)',
+                    'after': 'cursor of the previous page', 'fields': FIELDS_HELP})
+    def get(self):
+        pw = PayloadWrapper()
+
+        try:
+            es = ElasticSearchWrapper()
+
+            indexName = search_queries.index_arg(request.args, search_queries.AIS_INDICES)
+
+            queryBody = search_queries.latest_ships(request.args, source_filter(request.args.get('fields'), AIS_FIELDS))
+
+            aggregations = es.aggregate(indexName, queryBody)
+            hits, cursor = search_queries.latest_hits(aggregations, queryBody)
+
+            res = pw.success(hits)
+            res['cursor'] = cursor
+            return res, 200, pw.headers()
+
+        except Exception as message:
+            print(message)
+            return pw.failure(message, retry_after(message))
+
+
+@ns.route('/ships/histogram')
+class ShipHistogram(Resource):
+    @api.hide
+    def options(self):
+        pw = PayloadWrapper()
+        return "OK", 200, pw.headers()
+
+    @ns.doc('AIS records and distinct vessels per time bucket',
+            params={'index': 'ais (default) or ais_full', 'interval': 'calendar (1h, 1d, 1w, 1M) or fixed (6h, 30m) bucket size, default 1d',
+                    'start': 'earliest base_date_time', 'end': 'latest base_date_time', 'bbox': 'min_lon,min_lat,max_lon,max_lat',
+                    'vessel_name': 'Only count this vessel', 'split': 'true for counts per mmsi', 'top': 'most vessels per bucket when split (default 10)'})
+    def get(self):
+        pw = PayloadWrapper()
+
+        try:
+            es = ElasticSearchWrapper()
+
+            indexName = search_queries.index_arg(request.args, search_queries.AIS_INDICES)
+
+            queryBody = search_queries.activity_histogram(request.args, search_queries.ais_filters(request.args), 'base_date_time', search_queries.MMSI_FIELD)
+
+            aggregations = es.aggregate(indexName, queryBody)
+
+            res = pw.success(search_queries.histogram_buckets(aggregations))
+            return res, 200, pw.headers()
+
+        except Exception as message:
+            print(message)
+            return pw.failure(message, retry_after(message))
 
 
 @ns.route('/ship/<string:vessel_name>')  
@@ -160,7 +281,7 @@ class QueryShip(Resource):
         pw = PayloadWrapper()
         return "OK", 200, pw.headers()
 
-    @ns.doc('search for a ships with vessel_name')
+    @ns.doc('search for a ships with vessel_name', params={'fields': FIELDS_HELP})
     def get(self, vessel_name):
         pw = PayloadWrapper()
 
@@ -170,16 +291,9 @@ class QueryShip(Resource):
       
             indexName = 'ais'
 
-            queryBody = {
-                "from": 0, "size": 1000,
-                "query": {
-                    "match": {
-                        "vessel_name": {
-                            "query": vessel_name
-                            }
-                        }
-                    }
-                }
+            queryBody = search_queries.ship(vessel_name)
+
+            queryBody['_source'] = source_filter(request.args.get('fields'), AIS_FIELDS)
 
             hits = es.search(indexName, queryBody)
 
@@ -188,8 +302,45 @@ class QueryShip(Resource):
 
         except Exception as message:
             print(message)
-            res = pw.error(message)
-            return res, 400, pw.headers()
+            return pw.failure(message, retry_after(message))
+
+
+ship_batch = api.model('ship_batch', {
+    'vessel_names': fields.List(fields.String, example=['ALASKA SPIRIT'], required=False, description='Vessel names, each looked up as /ship/<vessel_name> does'),
+    'mmsis': fields.List(fields.String, required=False, description='Vessel MMSIs'),
+ })
+
+@ns.route('/ships/batch')
+class BatchShips(Resource):
+    @api.hide
+    def options(self):
+        pw = PayloadWrapper()
+        return "OK", 200, pw.headers()
+
+    @ns.doc('look up many ships with one search; results are keyed by vessel name and MMSI', params={'fields': FIELDS_HELP})
+    @ns.expect(ship_batch)
+    def post(self):
+        pw = PayloadWrapper()
+
+        try:
+            args = request.get_json(force=True)
+            es = ElasticSearchWrapper()
+
+            indexName = 'ais'
+
+            keys, queries = search_queries.batch({
+                'vessel_names': (args.get('vessel_names'), search_queries.ship),
+                'mmsis': (args.get('mmsis'), search_queries.mmsi),
+            }, source_filter(request.args.get('fields'), AIS_FIELDS))
+
+            hits = es.msearch(indexName, queries)
+
+            res = pw.success([search_queries.keyed(keys, hits)])
+            return res, 200, pw.headers()
+
+        except Exception as message:
+            print(message)
+            return pw.failure(message, retry_after(message))
 
 
 @ns.route('/satellites')  
@@ -199,7 +350,7 @@ class QueryAllSatellites(Resource):
         pw = PayloadWrapper()
         return "OK", 200, pw.headers()
 
-    @ns.doc('search for all satellites')
+    @ns.doc('search for all satellites', params={'fields': FIELDS_HELP})
     def get(self):
         pw = PayloadWrapper()
 
@@ -209,22 +360,93 @@ class QueryAllSatellites(Resource):
       
             indexName = 'tle'
 
-            queryBody = {
-                "from": 0, "size": 1000,
-                "query": {
-                    "match_all": {}
-                }
-            }
+            queryBody = search_queries.all_satellites()
 
-            hits = es.search(indexName, queryBody)
+            queryBody['_source'] = source_filter(request.args.get('fields'), TLE_FIELDS)
+
+            # the catalog only changes when tle is written: answer 304 without searching
+            # the body is searched (or cached) for the same version the ETag is made from
+            version = es.index_version(indexName)
+            unchanged, validators = index_versions.conditional(request.headers, version, queryBody)
+            headers = dict(pw.headers(), **validators)
+            if unchanged:
+                return None, 304, headers
+
+            hits = es.search(indexName, queryBody, version)
 
             res = pw.success(hits)
+            return res, 200, headers
+
+        except Exception as message:
+            print(message)
+            return pw.failure(message, retry_after(message))
+
+
+satellite_batch = api.model('satellite_batch', {
+    'designators': fields.List(fields.String, example=['98067A'], required=True, description='International designators, each looked up as /satellites/<designator> does'),
+ })
+
+@ns.route('/satellites/histogram')
+class SatelliteHistogram(Resource):
+    @api.hide
+    def options(self):
+        pw = PayloadWrapper()
+        return "OK", 200, pw.headers()
+
+    @ns.doc('TLE records and distinct satellites per time bucket',
+            params={'index': 'tle (default) or tle_full', 'interval': 'calendar (1h, 1d, 1w, 1M) or fixed (6h, 30m) bucket size, default 1d',
+                    'start': 'earliest timestamp', 'end': 'latest timestamp', 'designator': 'Only count this international designator',
+                    'split': 'true for counts per satellite_number', 'top': 'most satellites per bucket when split (default 10)'})
+    def get(self):
+        pw = PayloadWrapper()
+
+        try:
+            es = ElasticSearchWrapper()
+
+            indexName = search_queries.index_arg(request.args, search_queries.TLE_INDICES)
+
+            queryBody = search_queries.activity_histogram(request.args, search_queries.tle_filters(request.args), 'timestamp', 'satellite_number')
+
+            aggregations = es.aggregate(indexName, queryBody)
+
+            res = pw.success(search_queries.histogram_buckets(aggregations))
             return res, 200, pw.headers()
 
         except Exception as message:
             print(message)
-            res = pw.error(message)
-            return res, 400, pw.headers()
+            return pw.failure(message, retry_after(message))
+
+
+@ns.route('/satellites/batch')
+class BatchSatellites(Resource):
+    @api.hide
+    def options(self):
+        pw = PayloadWrapper()
+        return "OK", 200, pw.headers()
+
+    @ns.doc('look up many satellites with one search; results are keyed by designator', params={'fields': FIELDS_HELP})
+    @ns.expect(satellite_batch)
+    def post(self):
+        pw = PayloadWrapper()
+
+        try:
+            args = request.get_json(force=True)
+            es = ElasticSearchWrapper()
+
+            indexName = 'tle'
+
+            keys, queries = search_queries.batch({
+                'designators': (args.get('designators'), search_queries.satellite),
+            }, source_filter(request.args.get('fields'), TLE_FIELDS))
+
+            hits = es.msearch(indexName, queries)
+
+            res = pw.success([search_queries.keyed(keys, hits)])
+            return res, 200, pw.headers()
+
+        except Exception as message:
+            print(message)
+            return pw.failure(message, retry_after(message))
 
 
 @ns.route('/satellites/<string:designator>')  
@@ -234,7 +456,7 @@ class QuerySatellite(Resource):
         pw = PayloadWrapper()
         return "OK", 200, pw.headers()
 
-    @ns.doc('search for satellite with designator')
+    @ns.doc('search for satellite with designator', params={'fields': FIELDS_HELP})
     def get(self, designator):
         pw = PayloadWrapper()
 
@@ -244,16 +466,9 @@ class QuerySatellite(Resource):
       
             indexName = 'tle'
 
-            queryBody = {
-                "from": 0, "size": 1000,
-                "query": {
-                    "match": {
-                        "international_designator": {
-                            "query": designator
-                            }
-                        }
-                    }
-                }
+            queryBody = search_queries.satellite(designator)
+
+            queryBody['_source'] = source_filter(request.args.get('fields'), TLE_FIELDS)
 
             hits = es.search(indexName, queryBody)
 
@@ -262,10 +477,151 @@ class QuerySatellite(Resource):
 
         except Exception as message:
             print(message)
-            res = pw.error(message)
-            return res, 400, pw.headers()
+            return pw.failure(message, retry_after(message))
+
+
+def stream_hits(indexName, queryBody, sort, tiebreaker=()):
+    """ Stream every hit of a query as NDJSON, one hit per line, paging
+        through the index with point in time + search_after. Query args:
+        page_size (hits per ES request) and after (the JSON 'sort' value of
+        the last hit received, to resume a stream).
+    """
+    pw = PayloadWrapper()
+    try:
+        pageSize = min(request.args.get('page_size', 1000, type=int), 10000)
+        after = request.args.get('after')
+        if after is not None:
+            after = json.loads(after)
+    except Exception as message:
+        return pw.failure(message, retry_after(message))
+
+    es = ElasticSearchWrapper()
+
+    def generate():
+        try:
+            for hit in es.stream(indexName, queryBody, sort, page_size=pageSize, search_after=after, tiebreaker=tiebreaker):
+                yield response_pipeline.dumps(hit) + b'\n'
+        except Exception as message:
+            # the status line has gone out already, so report the error in-band
+            print(message)
+            yield response_pipeline.dumps(pw.error(message)) + b'\n'
+
+    headers = pw.headers()
+    headers['Content-Type'] = 'application/x-ndjson'
+    return Response(stream_with_context(generate()), headers=headers)
+
+
+@ns.route('/ships/stream')
+class StreamShips(Resource):
+    @api.hide
+    def options(self):
+        pw = PayloadWrapper()
+        return "OK", 200, pw.headers()
+
+    @ns.doc('stream all ships, or the ships with vessel_name, as NDJSON',
+            params={'vessel_name': 'Only stream this vessel', 'page_size': 'Hits per page (default 1000)', 'after': 'sort value of the last hit received', 'fields': FIELDS_HELP})
+    def get(self):
+        indexName = 'ais'
+
+        queryBody = search_queries.ship_stream(request.args.get('vessel_name'))
+        queryBody['_source'] = source_filter(request.args.get('fields'), AIS_FIELDS)
+        return stream_hits(indexName, queryBody, [{"base_date_time": "asc"}], search_queries.AIS_TIEBREAKER)
+
+
+@ns.route('/satellites/stream')
+class StreamSatellites(Resource):
+    @api.hide
+    def options(self):
+        pw = PayloadWrapper()
+        return "OK", 200, pw.headers()
+
+    @ns.doc('stream all satellites, or the satellites with designator, as NDJSON',
+            params={'designator': 'Only stream this international designator', 'page_size': 'Hits per page (default 1000)', 'after': 'sort value of the last hit received', 'fields': FIELDS_HELP})
+    def get(self):
+        indexName = 'tle'
+
+        queryBody = search_queries.satellite_stream(request.args.get('designator'))
+        queryBody['_source'] = source_filter(request.args.get('fields'), TLE_FIELDS)
+        return stream_hits(indexName, queryBody, [{"timestamp": "asc"}], search_queries.TLE_TIEBREAKER)
+
+
+hit_request = api.model('hits', {
+    'times': fields.List(fields.String, example=['2004-05-01T00:00:00'], required=True, description='Times of interest (UTC)'),
+    'sat_ids': fields.List(fields.Integer, required=False, description='Satellite numbers, defaults to the first sat_limit satellites with data'),
+    'vessel_ids': fields.List(fields.String, required=False, description='Vessel MMSIs, defaults to the first vessel_limit vessels with data'),
+    'altitude_min': fields.Float(example=5.0, required=False, description='Minimum degrees above the horizon to count as a hit'),
+    'search_window': fields.Float(example=7, required=False, description='Window in days around the times to search for AIS/TLE data'),
+    'sat_limit': fields.Integer(example=10, required=False),
+    'vessel_limit': fields.Integer(example=10, required=False),
+ })
+
+@ns.route('/hits')
+class SubmitHits(Resource):
+    @api.hide
+    def options(self):
+        pw = PayloadWrapper()
+        return "OK", 200, pw.headers()
+
+    @ns.doc('submit a satellite/vessel hit computation')
+    @ns.expect(hit_request)
+    def post(self):
+        pw = PayloadWrapper()
+
+        try:
+            params = request.get_json(force=True)
+            job = hit_jobs.submit(params)
+
+            res = pw.pending([job], 'submitted')
+            return res, 202, pw.headers()
+
+        except Exception as message:
+            print(message)
+            return pw.failure(message, retry_after(message))
 
 
+@ns.route('/hits/cache')
+class HitCacheStats(Resource):
+    @api.hide
+    def options(self):
+        pw = PayloadWrapper()
+        return "OK", 200, pw.headers()
+
+    @ns.doc('hit rates of the hit computation result cache')
+    def get(self):
+        pw = PayloadWrapper()
+        res = pw.success([hit_jobs.cache_stats()])
+        return res, 200, pw.headers()
+
+
+@ns.route('/hits/<string:job_id>')
+class HitResults(Resource):
+    @api.hide
+    def options(self):
+        pw = PayloadWrapper()
+        return "OK", 200, pw.headers()
+
+    @ns.doc('poll a hit computation for its status and results')
+    def get(self, job_id):
+        pw = PayloadWrapper()
+
+        job = hit_jobs.summary(job_id)
+        if job is None:
+            res = pw.error('no such job {}'.format(job_id))
+            return res, 404, pw.headers()
+
+        if job['status'] in ('pending', 'running'):
+            res = pw.pending([job], job['status'])
+            return res, 202, pw.headers()
+
+        try:
+            hits = hit_jobs.result(job_id)
+            res = pw.success(hits, job_id)
+            return res, 200, pw.headers()
+
+        except Exception as message:
+            print(message)
+            return pw.failure(message, retry_after(message))
+
 
 def startup():
     # if local  host=('127.0.0.1')
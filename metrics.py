@@ -0,0 +1,196 @@
+import time
+import threading
+
+# Request and Elasticsearch metrics in the Prometheus text format, served at
+# /metrics by main.py, la_main.py and async_main.py (see instrument()).
+#
+#   http_request_duration_seconds{app,route,method}   latency histogram per route
+#   http_requests_total{app,route,method,status}       requests by status
+#   http_request_errors_total{app,route}               responses with status >= 400
+#   http_requests_in_flight{app,route}                 requests being served
+#   http_response_size_bytes{app,route}                body sizes (streams are not counted)
+#   es_request_duration_seconds{operation}             wall time of Elasticsearch calls
+#   es_took_seconds{operation}                         time Elasticsearch reports (took)
+#   es_overhead_seconds{operation}                     wall time - took: network, queueing, (de)serialization
+#   es_errors_total{operation}                         failed Elasticsearch calls
+#
+# Metrics are per process; with several gunicorn workers each one is scraped
+# on its own or summed by the scraper.
+#
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+# https://prometheus.io/docs/practices/histograms/
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def labels_text(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape(value)) for name, value in pairs) + '}'
+
+
+def number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = dict()
+        self.lock = threading.Lock()
+
+    def header(self):
+        return ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        with self.lock:
+            return self.header() + ['{}{} {}'.format(self.name, labels_text(self.labels, key), number(value))
+                                    for key, value in sorted(self.values.items())]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels, value=0):
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, *labels, value):
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry['counts'][i] += 1
+                    break
+            entry['sum'] += value
+            entry['count'] += 1
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            for key, entry in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, entry['counts']):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(self.name, labels_text(self.labels, key, [('le', number(bound))]), cumulative))
+                lines.append('{}_sum{} {}'.format(self.name, labels_text(self.labels, key), repr(entry['sum'])))
+                lines.append('{}_count{} {}'.format(self.name, labels_text(self.labels, key), entry['count']))
+        return lines
+
+
+requestDuration = Histogram('http_request_duration_seconds', 'Time to serve a request', ('app', 'route', 'method'))
+requests = Counter('http_requests_total', 'Requests served', ('app', 'route', 'method', 'status'))
+requestErrors = Counter('http_request_errors_total', 'Responses with status 400 or more', ('app', 'route'))
+inFlight = Gauge('http_requests_in_flight', 'Requests being served', ('app', 'route'))
+responseSize = Histogram('http_response_size_bytes', 'Response body sizes', ('app', 'route'), SIZE_BUCKETS)
+esDuration = Histogram('es_request_duration_seconds', 'Wall time of Elasticsearch calls', ('operation',))
+esTook = Histogram('es_took_seconds', 'Time Elasticsearch reports spending (took)', ('operation',))
+esOverhead = Histogram('es_overhead_seconds', 'Wall time of Elasticsearch calls less took', ('operation',))
+esErrors = Counter('es_errors_total', 'Failed Elasticsearch calls', ('operation',))
+
+REGISTRY = [requestDuration, requests, requestErrors, inFlight, responseSize, esDuration, esTook, esOverhead, esErrors]
+# Functions returning extra Metric objects at scrape time, e.g. cache stats
+COLLECTORS = list()
+
+
+def render():
+    """ Every metric in the Prometheus text format """
+    lines = list()
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    for collect in COLLECTORS:
+        for metric in collect():
+            lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def es_call(operation, seconds, took_ms=None):
+    """ Record an Elasticsearch call of `seconds` wall time that reported `took_ms` """
+    esDuration.observe(operation, value=seconds)
+    if took_ms is not None:
+        esTook.observe(operation, value=took_ms / 1000.0)
+        esOverhead.observe(operation, value=max(0.0, seconds - took_ms / 1000.0))
+
+
+def request_started(app, route):
+    inFlight.inc(app, route)
+    return time.perf_counter()
+
+
+def request_finished(app, route, method, status, started, size=None):
+    inFlight.dec(app, route)
+    requestDuration.observe(app, route, method, value=time.perf_counter() - started)
+    requests.inc(app, route, method, str(status))
+    if status >= 400:
+        requestErrors.inc(app, route)
+    if size is not None:
+        responseSize.observe(app, route, value=size)
+
+
+def instrument(app, name):
+    """ Record request metrics of a Flask app and serve them at /metrics """
+    from flask import g, request, Response
+
+    def route():
+        return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+    @app.before_request
+    def start_timer():
+        g.metricsRoute = route()
+        g.metricsStarted = request_started(name, g.metricsRoute)
+
+    @app.after_request
+    def record(response):
+        started = g.pop('metricsStarted', None)
+        if started is not None:
+            size = None if response.is_streamed else response.calculate_content_length()
+            request_finished(name, g.metricsRoute, request.method, response.status_code, started, size)
+        return response
+
+    @app.teardown_request
+    def record_failure(error):
+        # after_request is skipped when a handler raises
+        started = g.pop('metricsStarted', None)
+        if started is not None:
+            request_finished(name, g.metricsRoute, request.method, 500, started)
+
+    def serve_metrics():
+        return Response(render(), content_type=CONTENT_TYPE)
+
+    app.add_url_rule('/metrics', 'metrics', serve_metrics)
+    return app
@@ -41,6 +41,8 @@ class PayloadWrapper:
         return result
 
     def error(self, message=''):
+        if isinstance(message, Exception):
+            message = str(message)
 
         result = {
             "status": 'error',
@@ -51,6 +53,17 @@ class PayloadWrapper:
         }
         return result
         
+    def failure(self, message, retry_after=None):
+        """ (result, status, headers) of a failed request: 400, or 503 with a
+            Retry-After header when the backend is unavailable for retry_after seconds
+        """
+        result = self.error(message)
+        if retry_after is None:
+            return result, 400, self.headers()
+        headers = self.headers()
+        headers['Retry-After'] = str(retry_after)
+        return result, 503, headers
+
     def headers(self):
         return {
         'Content-Type': 'application/json',
@@ -0,0 +1,368 @@
+import math
+import time
+import heapq
+import random
+import asyncio
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import metrics
+
+# Timeouts, retries, hedged requests and a circuit breaker for calls to
+# Elasticsearch, used by timed() and timed_async() in elastic_search_wrapper.py.
+#
+#   timeout   every call gets request_timeout=timeout (seconds), or the
+#             operation's own entry in timeouts, e.g. {'aggregate': 20}
+#   retries   idempotent calls failing with a retryable error (connection
+#             errors, timeouts, 429/502/503/504) are retried after a random
+#             sleep of 0..backoff*2**attempt seconds ("full jitter")
+#   hedge     when an idempotent call has not answered after the hedge
+#             quantile (p95) of the operation's recent latencies, a second,
+#             identical call is sent on a pool of `workers` threads. The
+#             first good answer of the two is used and the slower call is
+#             left to finish in the background; an error is only reported
+#             once both calls have failed.
+#   breaker   after `failures` retryable failures in a row calls fail at once
+#             with CircuitOpenError for `reset` seconds, then one trial call
+#             is let through; its success closes the breaker again
+#
+# https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+# https://research.google/pubs/the-tail-at-scale/
+# https://martinfowler.com/bliki/CircuitBreaker.html
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+retries = metrics.Counter('es_retries_total', 'Elasticsearch calls retried', ('operation',))
+timeouts = metrics.Counter('es_timeouts_total', 'Elasticsearch calls that timed out', ('operation',))
+hedges = metrics.Counter('es_hedges_total', 'Hedged Elasticsearch calls sent', ('operation',))
+hedgeWins = metrics.Counter('es_hedge_wins_total', 'Hedged Elasticsearch calls whose answer was used', ('operation',))
+rejections = metrics.Counter('es_breaker_rejections_total', 'Elasticsearch calls failed fast by the open circuit breaker', ('operation',))
+trips = metrics.Counter('es_breaker_trips_total', 'Times the circuit breaker opened')
+breakerState = metrics.Gauge('es_breaker_state', 'Circuit breaker state: 0 closed, 1 half-open, 2 open')
+
+metrics.REGISTRY.extend([retries, timeouts, hedges, hedgeWins, rejections, trips, breakerState])
+
+
+class CircuitOpenError(Exception):
+    """ Raised instead of calling Elasticsearch while the breaker is open """
+
+
+class CircuitBreaker:
+    def __init__(self, failures=5, reset=30):
+        self.failures = failures
+        self.reset = reset
+        self.state = CLOSED
+        self.count = 0
+        self.openedAt = 0.0
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def set_state(self, state):
+        self.state = state
+        breakerState.set(value=STATES[state])
+
+    def allow(self):
+        """ Whether a call may go ahead; in half-open only one trial call does """
+        if self.failures <= 0:
+            return True
+        with self.lock:
+            if self.state == OPEN and time.monotonic() - self.openedAt >= self.reset:
+                self.set_state(HALF_OPEN)
+                self.trial = False
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self.trial:
+                self.trial = True
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.count = 0
+            if self.state != CLOSED:
+                self.set_state(CLOSED)
+
+    def failure(self):
+        if self.failures <= 0:
+            return
+        with self.lock:
+            self.count += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.count >= self.failures):
+                self.set_state(OPEN)
+                self.openedAt = time.monotonic()
+                trips.inc()
+
+    def retry_after(self):
+        """ Whole seconds until an open breaker lets a trial call through """
+        with self.lock:
+            left = self.reset - (time.monotonic() - self.openedAt) if self.state == OPEN else 0
+        return max(1, math.ceil(left))
+
+    def release(self):
+        """ A call let through that ended neither in success nor failure """
+        with self.lock:
+            self.trial = False
+
+
+class Scheduler:
+    """ Runs actions after a delay on one timer thread, instead of a
+        threading.Timer (a new thread) per call
+    """
+
+    def __init__(self):
+        self.heap = list()
+        self.order = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def after(self, delay, action):
+        """ Run action() in delay seconds, unless cancel() is called first """
+        entry = [time.monotonic() + delay, next(self.order), action]
+        with self.condition:
+            heapq.heappush(self.heap, entry)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='es-hedge-timer', daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        return entry
+
+    def cancel(self, entry):
+        with self.condition:
+            entry[2] = None
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    self.condition.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                entry = heapq.heappop(self.heap)
+                action, entry[2] = entry[2], None
+            if action is not None:
+                action()
+
+
+class Hedge:
+    """ The two calls of a hedged request. The first runs on a thread of its
+        own and the second is sent to the pool when its timer fires; the
+        first good answer completes future, which the caller waits on.
+    """
+
+    def __init__(self, policy, operation, call, kwargs):
+        self.policy = policy
+        self.operation = operation
+        self.call = call
+        self.kwargs = kwargs
+        self.lock = threading.Lock()
+        self.future = Future()
+        self.running = 1
+        self.errors = dict()
+
+    def start(self):
+        threading.Thread(target=self.attempt, args=(False,), name='es-call', daemon=True).start()
+
+    def send(self):
+        with self.lock:
+            if self.future.done():
+                return
+            self.running += 1
+        hedges.inc(self.operation)
+        self.policy.executor().submit(self.attempt, True)
+
+    def attempt(self, second):
+        try:
+            answer = self.policy.timed(self.operation, self.call, self.kwargs)
+        except Exception as error:
+            with self.lock:
+                self.running -= 1
+                self.errors[second] = error
+                if self.running == 0 and not self.future.done():
+                    # the first call's error is the one to report
+                    self.future.set_exception(self.errors.get(False, error))
+            return
+        with self.lock:
+            if self.future.done():
+                return
+            self.future.set_result(answer)
+        if second:
+            hedgeWins.inc(self.operation)
+
+
+class Policy:
+    """ How calls to Elasticsearch are made. retryable(error) tells which
+        errors are worth retrying and count against the breaker; other
+        errors (a bad query, a missing index) are passed on as they are.
+    """
+
+    def __init__(self, timeout=None, timeouts=None, retries=2, backoff=0.1, hedge=True, hedge_quantile=0.95,
+                 hedge_min_delay=0.05, min_samples=20, window=200, breaker=None,
+                 retryable=lambda error: False, is_timeout=lambda error: False, workers=8):
+        self.timeout = timeout
+        self.timeouts = timeouts or dict()
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge = hedge
+        self.hedgeQuantile = hedge_quantile
+        self.hedgeMinDelay = hedge_min_delay
+        self.minSamples = min_samples
+        self.window = window
+        self.breaker = breaker or CircuitBreaker(failures=0)
+        self.retryable = retryable
+        self.isTimeout = is_timeout
+        self.workers = workers
+        self.latencies = dict()
+        self.lock = threading.Lock()
+        self._executor = None
+        self.scheduler = Scheduler()
+
+    def executor(self):
+        if self._executor is None:
+            with self.lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='es-hedge')
+        return self._executor
+
+    def after_fork(self):
+        """ A forked child has none of the parent's hedge threads """
+        self.lock = threading.Lock()
+        self._executor = None
+        self.scheduler = Scheduler()
+
+    def observe(self, operation, seconds):
+        with self.lock:
+            samples = self.latencies.get(operation)
+            if samples is None:
+                samples = self.latencies[operation] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def hedge_delay(self, operation):
+        """ Seconds to wait before hedging operation, None while there are too few samples """
+        if not self.hedge:
+            return None
+        with self.lock:
+            samples = sorted(self.latencies.get(operation, ()))
+        if len(samples) < self.minSamples:
+            return None
+        return max(self.hedgeMinDelay, samples[min(len(samples) - 1, int(self.hedgeQuantile * len(samples)))])
+
+    def sleep_time(self, attempt):
+        return random.uniform(0, self.backoff * 2 ** attempt)
+
+    def arguments(self, operation, kwargs):
+        timeout = self.timeouts.get(operation, self.timeout)
+        if timeout is not None and 'request_timeout' not in kwargs:
+            kwargs = dict(kwargs, request_timeout=timeout)
+        return kwargs
+
+    def failed(self, operation, error):
+        """ Count error; True when it is worth retrying """
+        if self.isTimeout(error):
+            timeouts.inc(operation)
+        if self.retryable(error):
+            self.breaker.failure()
+            return True
+        self.breaker.release()
+        return False
+
+    def call(self, operation, call, idempotent=True, **kwargs):
+        """ call(**kwargs) under the policy. Calls that are not idempotent,
+            like scrolls, get the timeout and the breaker but are neither
+            retried nor hedged.
+        """
+        kwargs = self.arguments(operation, kwargs)
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                rejections.inc(operation)
+                raise CircuitOpenError('Elasticsearch circuit breaker is open')
+            try:
+                answer = self.hedged(operation, call, kwargs) if idempotent else self.timed(operation, call, kwargs)
+            except Exception as error:
+                if not self.failed(operation, error) or not idempotent or attempt >= self.retries:
+                    raise
+                retries.inc(operation)
+                time.sleep(self.sleep_time(attempt))
+                attempt += 1
+                continue
+            self.breaker.success()
+            return answer
+
+    def timed(self, operation, call, kwargs):
+        start = time.perf_counter()
+        answer = call(**kwargs)
+        self.observe(operation, time.perf_counter() - start)
+        return answer
+
+    def hedged(self, operation, call, kwargs):
+        delay = self.hedge_delay(operation)
+        if delay is None:
+            return self.timed(operation, call, kwargs)
+        # the first call gets a thread of its own rather than one of the
+        # pool, so time spent waiting for a pool thread never counts
+        # toward the hedge delay
+        hedge = Hedge(self, operation, call, kwargs)
+        hedge.start()
+        timer = self.scheduler.after(delay, hedge.send)
+        try:
+            return hedge.future.result()
+        finally:
+            self.scheduler.cancel(timer)
+
+    async def call_async(self, operation, call, idempotent=True, **kwargs):
+        """ call() for coroutine functions, e.g. the AsyncElasticsearch methods """
+        kwargs = self.arguments(operation, kwargs)
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                rejections.inc(operation)
+                raise CircuitOpenError('Elasticsearch circuit breaker is open')
+            try:
+                if idempotent:
+                    answer = await self.hedged_async(operation, call, kwargs)
+                else:
+                    answer = await self.timed_async(operation, call, kwargs)
+            except asyncio.CancelledError:
+                self.breaker.release()
+                raise
+            except Exception as error:
+                if not self.failed(operation, error) or not idempotent or attempt >= self.retries:
+                    raise
+                retries.inc(operation)
+                await asyncio.sleep(self.sleep_time(attempt))
+                attempt += 1
+                continue
+            self.breaker.success()
+            return answer
+
+    async def timed_async(self, operation, call, kwargs):
+        start = time.perf_counter()
+        answer = await call(**kwargs)
+        self.observe(operation, time.perf_counter() - start)
+        return answer
+
+    async def hedged_async(self, operation, call, kwargs):
+        delay = self.hedge_delay(operation)
+        if delay is None:
+            return await self.timed_async(operation, call, kwargs)
+        first = asyncio.ensure_future(self.timed_async(operation, call, kwargs))
+        done, _ = await asyncio.wait([first], timeout=delay)
+        if done:
+            return first.result()
+        hedges.inc(operation)
+        second = asyncio.ensure_future(self.timed_async(operation, call, kwargs))
+        pending = {first, second}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            hedgeWins.inc(operation)
+                        return task.result()
+            return first.result()
+        finally:
+            for task in (first, second):
+                if not task.done():
+                    task.cancel()
@@ -0,0 +1,109 @@
+import os
+import json
+import gzip
+import zlib
+
+from flask import request, make_response
+
+# JSON encoding and compression of API responses.
+#
+# orjson (and brotli for br) are used when installed; otherwise responses
+# fall back to the stdlib encoder and gzip/deflate.
+#
+# https://github.com/ijl/orjson
+# https://flask-restplus.readthedocs.io/en/stable/api.html#flask_restplus.Api.representation
+# https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Accept-Encoding
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Bodies smaller than this are sent as they are
+MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', 5))
+BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 4))
+
+
+def plain(value):
+    """ Fallback for values the encoders do not know: numpy scalars (hit
+        positions and angles) as numbers, arrays as lists, anything else as
+        its string
+    """
+    if np is not None and isinstance(value, np.generic):
+        return value.item()
+    if np is not None and isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+
+def dumps(data):
+    """ data as UTF-8 encoded JSON bytes """
+    if orjson is not None:
+        return orjson.dumps(data, default=plain, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(data, default=plain, separators=(',', ':')).encode('utf-8')
+
+
+def accepted_encodings(accept_encoding):
+    """ Encodings the client accepts (q > 0), from an Accept-Encoding header """
+    accepted = set()
+    for item in (accept_encoding or '').split(','):
+        name, _, params = item.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                pass
+        if name and quality > 0:
+            accepted.add(name.strip().lower())
+    return accepted
+
+
+def compress(body, accept_encoding):
+    """ body compressed with the best encoding the client accepts.
+        Inputs:
+            body [bytes]: Response body
+            accept_encoding [str]: Accept-Encoding request header
+        Output:
+            (body [bytes], encoding [str or None])
+    """
+    if len(body) < MIN_SIZE:
+        return body, None
+    accepted = accepted_encodings(accept_encoding)
+    if brotli is not None and 'br' in accepted:
+        return brotli.compress(body, quality=BROTLI_QUALITY), 'br'
+    if 'gzip' in accepted or '*' in accepted:
+        return gzip.compress(body, compresslevel=GZIP_LEVEL), 'gzip'
+    if 'deflate' in accepted:
+        return zlib.compress(body, GZIP_LEVEL), 'deflate'
+    return body, None
+
+
+def output_json(data, code, headers=None):
+    """ flask_restplus representation for application/json, see register() """
+    body, encoding = compress(dumps(data), request.headers.get('Accept-Encoding'))
+    response = make_response(body, code)
+    response.headers.extend(headers or {})
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['Vary'] = 'Accept-Encoding'
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def register(api):
+    """ Serve the JSON responses of a flask_restplus Api with output_json """
+    api.representations['application/json'] = output_json
+    return api
@@ -0,0 +1,111 @@
+import sys
+import json
+import time
+import argparse
+import statistics
+
+import search_queries
+from source_fields import SENTENCE_FIELDS
+from sqlite_search_backend import SQLiteSearchWrapper
+
+# Latency of la_main.py sentence searches on the SQLite backend and, with
+# --es, on Elasticsearch, over the same corpus and queries.
+#
+#   python search_benchmark.py la.db --load sentences.ndjson
+#   python search_benchmark.py la.db --es --repeat 50 --page-size 20
+#
+# Queries are /search bodies ({"text": ..., "queryrule": ..., "rhetclass": ...})
+# or /query bodies ({"includeany": ..., "excludeany": ...}), from --queries
+# (a JSON list) or QUERIES below. The ES response cache is turned off.
+
+QUERIES = [
+    {'text': 'service vietnam', 'queryrule': 'or'},
+    {'text': 'service vietnam', 'queryrule': 'and'},
+    {'text': 'ptsd', 'queryrule': 'or', 'rhetclass': 'FindingSentence'},
+    {'includeany': 'knee back', 'excludeany': 'shoulder'},
+    {'exactphrase': 'in-service incurrence'},
+    {'includeall': 'hearing loss tinnitus', 'rhetclass': 'EvidenceSentence'},
+]
+
+
+def query_body(spec, page_size):
+    """ The body la_main.py sends for a /search or /query request """
+    if 'text' in spec:
+        queryBody = search_queries.simple_sentences(spec.get('rhetclass', ''), spec['text'], spec.get('queryrule', ''))
+    else:
+        queryBody = search_queries.compound_sentences(spec.get('rhetclass', ''), spec.get('includeany', ''), spec.get('includeall', ''),
+                                                      spec.get('exactphrase', ''), spec.get('excludeany', ''))
+    queryBody['_source'] = SENTENCE_FIELDS
+    return search_queries.sentence_page(queryBody, {'page_size': page_size})
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def run(es, index, bodies, repeat):
+    """ Milliseconds per search and the ids of each query's first page """
+    times = list()
+    ids = list()
+    for body in bodies:
+        hits, total = es.search_page(index, body)
+        ids.append([hit['_id'] for hit in hits])
+        for _ in range(repeat):
+            start = time.perf_counter()
+            es.search_page(index, body)
+            times.append((time.perf_counter() - start) * 1000)
+    return times, ids
+
+
+def summary(times):
+    return {'searches': len(times),
+            'mean_ms': round(statistics.mean(times), 3),
+            'p50_ms': round(percentile(times, 50), 3),
+            'p95_ms': round(percentile(times, 95), 3),
+            'p99_ms': round(percentile(times, 99), 3)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare SQLite FTS5 and Elasticsearch sentence search latency')
+    parser.add_argument('db')
+    parser.add_argument('--index', default='la-sentence')
+    parser.add_argument('--load', nargs='*', default=None, help='CSV/JSON/NDJSON files to load into the SQLite index first')
+    parser.add_argument('--id-field', default=None)
+    parser.add_argument('--queries', default=None, help='JSON file with a list of query specs')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--page-size', type=int, default=20)
+    parser.add_argument('--es', action='store_true', help='also run the queries against Elasticsearch')
+    args = parser.parse_args(argv)
+
+    sqlite = SQLiteSearchWrapper(args.db)
+    if args.load:
+        from bulk_ingest import read_documents, actions
+        sqlite.delete_index(args.index)
+        indexed, errors = sqlite.bulk(args.index, actions(read_documents(args.load), args.id_field))
+        print("loaded {} documents, {} failed".format(indexed, len(errors)))
+
+    specs = QUERIES
+    if args.queries:
+        with open(args.queries) as file:
+            specs = json.load(file)
+    bodies = [query_body(spec, args.page_size) for spec in specs]
+
+    times, sqliteIds = run(sqlite, args.index, bodies, args.repeat)
+    report = {'sqlite': summary(times)}
+
+    if args.es:
+        import elastic_search_wrapper
+        elastic_search_wrapper.searchCache.ttl = 0
+        times, esIds = run(elastic_search_wrapper.ElasticSearchWrapper(), args.index, bodies, args.repeat)
+        report['elasticsearch'] = summary(times)
+        # how many of the first page ids the two backends agree on
+        report['first_page_overlap'] = [round(len(set(a) & set(b)) / max(len(a), len(b), 1), 3)
+                                        for a, b in zip(sqliteIds, esIds)]
+
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
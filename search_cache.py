@@ -0,0 +1,135 @@
+import json
+import time
+import fnmatch
+import threading
+import collections
+
+
+def overlaps(read, written):
+    """ Whether a search of `read` sees writes to `written`. Both may be comma
+        separated lists or wildcard patterns (ais*, ais_full, ...).
+    """
+    read = str(read).split(',')
+    written = str(written).split(',')
+    return any(fnmatch.fnmatchcase(r, w) or fnmatch.fnmatchcase(w, r) for r in read for w in written)
+
+
+class SearchCache:
+    """ Process wide cache of search results keyed by (index, query body).
+
+        Entries expire `ttl` seconds after they are stored, and the least
+        recently used entries are dropped once the cached results take more
+        than `max_bytes` (measured as their JSON size). Writes to an index
+        drop every entry read from it, see invalidate(). A ttl of 0 turns
+        the cache off.
+
+        Invalidation is per process: writes made elsewhere (other gunicorn
+        workers, bulk_ingest.py, vaultwrite.py) are only seen once entries
+        expire, so results can be up to `ttl` seconds stale; keep it short.
+
+        A search that was sent before a write may answer after it; read
+        generation(index) before searching and pass it to put(), which
+        then skips results that predate a write.
+    """
+
+    def __init__(self, ttl=10, max_bytes=64*1024*1024):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale_puts = 0
+        # invalidations per written index (or pattern)
+        self.generations = dict()
+
+    @staticmethod
+    def key(index, query, version=None):
+        """ Key for a search; the query is canonicalized so that key order
+            does not matter. With an index version (see index_versions.py)
+            the entry is only used while the index has that version.
+        """
+        key = (index, json.dumps(query, sort_keys=True, separators=(',', ':'), default=str))
+        return key + (version['etag'],) if version is not None else key
+
+    def get(self, key):
+        if self.ttl <= 0:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry['expires'] < time.monotonic():
+                self.__drop(key)
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry['value']
+
+    def generation(self, index):
+        """ Changes whenever an index that a search of `index` reads is written """
+        with self.lock:
+            return self.__generation(index)
+
+    def __generation(self, index):
+        return sum(count for written, count in self.generations.items() if overlaps(index, written))
+
+    def put(self, key, value, generation=None):
+        """ Store value, unless `generation` is given and the index was written since """
+        if self.ttl <= 0:
+            return
+        size = len(json.dumps(value, default=str))
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if generation is not None and generation != self.__generation(key[0]):
+                self.stale_puts += 1
+                return
+            if key in self.entries:
+                self.__drop(key)
+            self.entries[key] = {'value': value, 'size': size, 'expires': time.monotonic() + self.ttl}
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self.__drop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def __drop(self, key):
+        entry = self.entries.pop(key)
+        self.bytes -= entry['size']
+
+    def invalidate(self, index):
+        """ Drop every entry read from `index`, see overlaps(), and make
+            searches of it that are in flight skip put()
+        """
+        with self.lock:
+            self.generations[str(index)] = self.generations.get(str(index), 0) + 1
+            for key in list(self.entries):
+                if overlaps(key[0], index):
+                    self.__drop(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries),
+                    'bytes': self.bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'expired': self.expired,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'stale_puts': self.stale_puts,
+                    'ttl': self.ttl,
+                    'max_bytes': self.max_bytes}
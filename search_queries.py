@@ -0,0 +1,484 @@
+import json
+
+# Query bodies for the search endpoints, shared by main.py, la_main.py and async_main.py
+# https://www.elastic.co/guide/en/elasticsearch/reference/7.x/query-dsl.html
+
+
+def match(field, query, **options):
+    match = {"query": query}
+    match.update(options)
+    return {"match": {field: match}}
+
+
+def all_ships():
+    return {
+        "from": 0, "size": 5000,
+        "query": {
+            "match_all": {}
+        }
+    }
+
+
+def ship(vessel_name):
+    return {
+        "from": 0, "size": 1000,
+        "query": match("vessel_name", vessel_name)
+    }
+
+
+def mmsi(mmsi):
+    return {
+        "from": 0, "size": 1000,
+        "query": match("mmsi", mmsi)
+    }
+
+
+def all_satellites():
+    return {
+        "from": 0, "size": 1000,
+        "query": {
+            "match_all": {}
+        }
+    }
+
+
+def satellite(designator):
+    return {
+        "from": 0, "size": 1000,
+        "query": match("international_designator", designator)
+    }
+
+
+# most inputs accepted by one batch lookup
+BATCH_LIMIT = 500
+
+
+def batch(lookups, source=None):
+    """ Queries for a batch lookup, e.g. /ships/batch. Repeated values are
+        looked up once.
+        Inputs:
+            lookups [dict]: kind -> (values, query builder), e.g. {'mmsis': (['366', '367'], mmsi)}
+            source: _source of every query (see source_fields.source_filter)
+        Output:
+            keys [list]: (kind, value) of each query
+            queries [list]: Query bodies, for ElasticSearchWrapper.msearch
+    """
+    keys = list()
+    queries = list()
+    for kind, (values, builder) in lookups.items():
+        for value in dict.fromkeys(values or []):
+            queryBody = builder(value)
+            if source is not None:
+                queryBody['_source'] = source
+            keys.append((kind, value))
+            queries.append(queryBody)
+    if len(queries) > BATCH_LIMIT:
+        raise ValueError("at most {} values can be looked up at once, got {}".format(BATCH_LIMIT, len(queries)))
+    return keys, queries
+
+
+def keyed(keys, results):
+    """ Batch results as {kind: {value: hits}} """
+    answer = dict()
+    for (kind, value), hits in zip(keys, results):
+        answer.setdefault(kind, dict())[value] = hits
+    return answer
+
+
+# https://www.elastic.co/guide/en/elasticsearch/reference/7.x/search-aggregations-bucket-geotilegrid-aggregation.html
+# https://www.elastic.co/guide/en/elasticsearch/reference/7.x/search-aggregations-bucket-geohashgrid-aggregation.html
+GRIDS = {
+    'geotile': {'aggregation': 'geotile_grid', 'precision': 7, 'max_precision': 29, 'min_precision': 0},
+    'geohash': {'aggregation': 'geohash_grid', 'precision': 5, 'max_precision': 12, 'min_precision': 1},
+}
+# AIS times look like 2015-01-01 05:01:44; ISO times are accepted too
+AIS_TIME_FORMAT = "yyyy-MM-dd HH:mm:ss||strict_date_optional_time"
+
+
+def bbox_filter(bbox, field="geo"):
+    """ geo_bounding_box filter for bbox 'min_lon,min_lat,max_lon,max_lat' """
+    bbox = [float(x) for x in bbox.split(',')]
+    if len(bbox) != 4:
+        raise ValueError("bbox must be min_lon,min_lat,max_lon,max_lat")
+    west, south, east, north = bbox
+    return {"geo_bounding_box": {field: {
+        "top_left": {"lat": north, "lon": west},
+        "bottom_right": {"lat": south, "lon": east}
+    }}}
+
+
+def time_filter(start=None, end=None, field="base_date_time", format=AIS_TIME_FORMAT):
+    """ range filter on field for start <= time <= end; either may be None """
+    bounds = {"format": format}
+    if start:
+        bounds["gte"] = start
+    if end:
+        bounds["lte"] = end
+    return {"range": {field: bounds}}
+
+
+def ais_filters(args):
+    """ bbox, start/end and vessel_name filters from request args """
+    filters = []
+    if args.get('bbox'):
+        filters.append(bbox_filter(args.get('bbox')))
+    if args.get('start') or args.get('end'):
+        filters.append(time_filter(args.get('start'), args.get('end')))
+    if args.get('vessel_name'):
+        filters.append(match("vessel_name", args.get('vessel_name')))
+    return filters
+
+
+def ship_heatmap(args):
+    """ Aggregation query for /ships/heatmap: AIS position counts and
+        centroids per geotile or geohash cell.
+        Inputs:
+            args [dict]: Request args: grid (geotile or geohash), precision, size (most cells),
+                         bbox (min_lon,min_lat,max_lon,max_lat), start, end, vessel_name
+        Output:
+            queryBody [dict]: size 0 search with a 'cells' aggregation
+    """
+    grid = args.get('grid') or 'geotile'
+    if grid not in GRIDS:
+        raise ValueError("grid must be one of {}".format(', '.join(GRIDS)))
+    grid = GRIDS[grid]
+    precision = int(args.get('precision') or grid['precision'])
+    if not grid['min_precision'] <= precision <= grid['max_precision']:
+        raise ValueError("precision must be between {} and {}".format(grid['min_precision'], grid['max_precision']))
+
+    return {
+        "size": 0,
+        "query": {
+            "bool": {"filter": ais_filters(args)}
+        },
+        "aggs": {
+            "cells": {
+                grid['aggregation']: {
+                    "field": "geo",
+                    "precision": precision,
+                    "size": min(int(args.get('size') or 10000), 65535)
+                },
+                "aggs": {
+                    "centroid": {"geo_centroid": {"field": "geo"}}
+                }
+            }
+        }
+    }
+
+
+def heatmap_cells(aggregations):
+    """ Cells of a ship_heatmap() answer as [{key, count, lat, lon}] """
+    cells = list()
+    for bucket in aggregations['cells']['buckets']:
+        location = bucket['centroid'].get('location', {})
+        cells.append({'key': bucket['key'],
+                      'count': bucket['doc_count'],
+                      'lat': location.get('lat'),
+                      'lon': location.get('lon')})
+    return cells
+
+
+# indices the aggregation endpoints can run against
+AIS_INDICES = ('ais', 'ais_full')
+TLE_INDICES = ('tle', 'tle_full')
+# keyword field vessels are grouped by; use 'mmsi.keyword' for dynamically mapped indices
+MMSI_FIELD = 'mmsi'
+# search_after tiebreakers for streams without a point in time (after the time sort)
+AIS_TIEBREAKER = [{MMSI_FIELD: 'asc'}]
+TLE_TIEBREAKER = [{'satellite_number': 'asc'}]
+
+
+def index_arg(args, indices):
+    """ Index named by the 'index' request arg, one of indices (the first by default) """
+    index = args.get('index') or indices[0]
+    if index not in indices:
+        raise ValueError("index must be one of {}".format(', '.join(indices)))
+    return index
+
+
+def latest_ships(args, source=True):
+    """ Aggregation query for /ships/latest: the latest AIS record of each
+        vessel, a page of vessels at a time.
+        Inputs:
+            args [dict]: Request args: bbox, start, end, vessel_name (see ship_heatmap),
+                         page_size (vessels per page) and after (cursor of the previous page)
+            source: _source of the returned records
+        Output:
+            queryBody [dict]: size 0 search with a 'vessels' composite aggregation
+    """
+    # https://www.elastic.co/guide/en/elasticsearch/reference/7.x/search-aggregations-bucket-composite-aggregation.html
+    # https://www.elastic.co/guide/en/elasticsearch/reference/7.x/search-aggregations-metrics-top-hits-aggregation.html
+    vessels = {
+        "size": min(int(args.get('page_size') or 1000), 10000),
+        "sources": [{"mmsi": {"terms": {"field": MMSI_FIELD}}}]
+    }
+    if args.get('after'):
+        vessels["after"] = json.loads(args.get('after'))
+
+    return {
+        "size": 0,
+        "query": {
+            "bool": {"filter": ais_filters(args)}
+        },
+        "aggs": {
+            "vessels": {
+                "composite": vessels,
+                "aggs": {
+                    "latest": {
+                        "top_hits": {
+                            "size": 1,
+                            "sort": [{"base_date_time": {"order": "desc"}}],
+                            "_source": source
+                        }
+                    }
+                }
+            }
+        }
+    }
+
+
+def latest_hits(aggregations, queryBody):
+    """ Hits and cursor of a latest_ships() answer; the cursor is None on the last page """
+    vessels = aggregations['vessels']
+    hits = [hit for bucket in vessels['buckets'] for hit in bucket['latest']['hits']['hits']]
+    full = len(vessels['buckets']) >= queryBody['aggs']['vessels']['composite']['size']
+    cursor = vessels.get('after_key') if full else None
+    return hits, cursor
+
+
+CALENDAR_INTERVALS = ('1m', '1h', '1d', '1w', '1M', '1q', '1y',
+                      'minute', 'hour', 'day', 'week', 'month', 'quarter', 'year')
+
+
+def tle_filters(args):
+    """ start/end and designator filters from request args """
+    filters = []
+    if args.get('start') or args.get('end'):
+        filters.append(time_filter(args.get('start'), args.get('end'), field="timestamp"))
+    if args.get('designator'):
+        filters.append(match("international_designator", args.get('designator')))
+    return filters
+
+
+def activity_histogram(args, filters, time_field, id_field):
+    """ Aggregation query for /ships/histogram and /satellites/histogram:
+        document counts and distinct ids per time bucket.
+        Inputs:
+            args [dict]: Request args: interval (calendar like 1d, 1M or fixed like 6h, 30m; default 1d),
+                         start, end, split (true for per id counts) and top (ids per bucket when split)
+            filters [list]: Query filters, e.g. from ais_filters()
+            time_field [str]: Date field to bucket on
+            id_field [str]: Vessel or satellite id field, for distinct counts and splits
+        Output:
+            queryBody [dict]: size 0 search with an 'activity' date_histogram aggregation
+    """
+    # https://www.elastic.co/guide/en/elasticsearch/reference/7.x/search-aggregations-bucket-datehistogram-aggregation.html
+    interval = args.get('interval') or '1d'
+    histogram = {
+        "field": time_field,
+        "calendar_interval" if interval in CALENDAR_INTERVALS else "fixed_interval": interval,
+        # bucket keys come out in the first format
+        "format": AIS_TIME_FORMAT,
+        "min_doc_count": 0
+    }
+    if args.get('start') and args.get('end'):
+        histogram["extended_bounds"] = {"min": args.get('start'), "max": args.get('end')}
+
+    metrics = {"distinct": {"cardinality": {"field": id_field}}}
+    if str(args.get('split', '')).lower() in ('true', '1', 'yes'):
+        metrics["split"] = {"terms": {"field": id_field, "size": min(int(args.get('top') or 10), 1000)}}
+
+    return {
+        "size": 0,
+        "query": {
+            "bool": {"filter": filters}
+        },
+        "aggs": {
+            "activity": {
+                "date_histogram": histogram,
+                "aggs": metrics
+            }
+        }
+    }
+
+
+def histogram_buckets(aggregations):
+    """ Buckets of an activity_histogram() answer as [{time, count, distinct, split}] """
+    buckets = list()
+    for bucket in aggregations['activity']['buckets']:
+        entry = {'time': bucket.get('key_as_string', bucket['key']),
+                 'count': bucket['doc_count'],
+                 'distinct': bucket['distinct']['value']}
+        if 'split' in bucket:
+            entry['split'] = {str(split['key']): split['doc_count'] for split in bucket['split']['buckets']}
+        buckets.append(entry)
+    return buckets
+
+
+def ship_stream(vessel_name=None):
+    """ Query for /ships/stream: every ship, or the ships with vessel_name """
+    if vessel_name:
+        return {"query": match("vessel_name", vessel_name)}
+    return {"query": {"match_all": {}}}
+
+
+def satellite_stream(designator=None):
+    """ Query for /satellites/stream: every satellite, or the satellites with designator """
+    if designator:
+        return {"query": match("international_designator", designator)}
+    return {"query": {"match_all": {}}}
+
+
+def case(caseid):
+    return {
+        "from": 0, "size": 1000,
+        "query": match("caseID", caseid)
+    }
+
+
+def compound_sentences(rhetclass, includeany, includeall, exactphrase, excludeany):
+    """ Query for /query: sentences with any/all of some words or an exact
+        phrase, without any of other words, optionally of one rhetClass
+    """
+    mustPhrase = []
+    if (len(includeany.strip()) > 0):
+        mustPhrase.append(match("text", includeany, operator='or'))
+
+    if (len(includeall.strip()) > 0):
+        mustPhrase.append(match("text", includeall, operator='and'))
+
+    if (len(exactphrase.strip()) > 0):
+        mustPhrase.append({"match_phrase": {"text": {"query": exactphrase}}})
+
+    filterPhrase = {}
+    if rhetclass.find("Sentence") > -1:
+        filterPhrase = match("rhetClass", rhetclass)
+
+    must_notPhrase = {}
+    if (len(excludeany.strip()) > 0):
+        must_notPhrase = match("text", excludeany)
+
+    boolPhrase = {}
+    if (len(mustPhrase) > 0):
+        boolPhrase['must'] = mustPhrase
+
+    if (len(filterPhrase) > 0):
+        boolPhrase['filter'] = filterPhrase
+
+    if (len(must_notPhrase) > 0):
+        boolPhrase['must_not'] = must_notPhrase
+
+    return {
+        "from": 0, "size": 1000,
+        "query": {
+            "bool": boolPhrase
+        }
+    }
+
+
+def simple_sentences(rhetclass, text, queryrule):
+    """ Query for /search: sentences matching text, optionally of one rhetClass """
+    if (len(queryrule.strip()) == 0):
+        queryrule = 'or'
+
+    queryBody = {
+        "from": 0, "size": 1000,
+        "query": match("text", text, operator=queryrule)
+    }
+
+    if rhetclass.find("Sentence") > -1:
+        queryBody['query'] = {
+            "bool": {
+                "must": [
+                    match("rhetClass", rhetclass),
+                    match("text", text, operator=queryrule)
+                ]
+            }
+        }
+    return queryBody
+
+
+# Sentence results are sorted by score, with doc values keyword fields to
+# break ties so that a cursor (the sort values of the last hit) picks up where
+# a page ended. Not _id, which needs fielddata. Sentences of one paragraph with
+# equal scores still tie; add a keyword field unique per sentence here if the
+# index has one. With a dynamic mapping, strings have a .keyword subfield.
+SENTENCE_TIEBREAKER = ['caseID.keyword', 'context.keyword']
+SENTENCE_SORT = [{"_score": {"order": "desc"}}] + [{field: {"order": "asc", "unmapped_type": "keyword"}}
+                                                   for field in SENTENCE_TIEBREAKER]
+# sentences per page unless the request asks for more, up to SENTENCE_MAX_PAGE_SIZE
+SENTENCE_PAGE_SIZE = 50
+SENTENCE_MAX_PAGE_SIZE = 1000
+# Matches are counted up to this many unless the request asks otherwise
+TOTAL_HITS_LIMIT = 1000
+
+
+def sentence_page(queryBody, args):
+    """ Add paging, hit counting and highlighting to a /query or /search body.
+        Inputs:
+            queryBody [dict]: From compound_sentences() or simple_sentences()
+            args [dict]: Request args: page_size (default 50, at most 1000), after (cursor of
+                         the previous page), total (true, false or a count to stop
+                         counting at) and highlight (true for matched fragments of text)
+        Output:
+            queryBody [dict]
+    """
+    # https://www.elastic.co/guide/en/elasticsearch/reference/7.x/paginate-search-results.html#search-after
+    # https://www.elastic.co/guide/en/elasticsearch/reference/7.x/search-your-data.html#track-total-hits
+    # https://www.elastic.co/guide/en/elasticsearch/reference/7.x/highlighting.html
+    queryBody.pop('from', None)
+    queryBody['size'] = max(1, min(int(args.get('page_size') or SENTENCE_PAGE_SIZE), SENTENCE_MAX_PAGE_SIZE))
+    queryBody['sort'] = SENTENCE_SORT
+    if args.get('after'):
+        queryBody['search_after'] = json.loads(args.get('after'))
+
+    total = str(args.get('total') or TOTAL_HITS_LIMIT).lower()
+    if total in ('true', 'false'):
+        queryBody['track_total_hits'] = total == 'true'
+    else:
+        queryBody['track_total_hits'] = int(total)
+
+    if str(args.get('highlight')).lower() == 'true':
+        queryBody['highlight'] = {
+            "fields": {"text": {"fragment_size": 150, "number_of_fragments": 3, "no_match_size": 0}},
+            "pre_tags": ["<em>"], "post_tags": ["</em>"]
+        }
+    return queryBody
+
+
+def page_cursor(hits, queryBody):
+    """ Cursor for the page after hits of a sentence_page() query; None on the last page """
+    if len(hits) < queryBody['size']:
+        return None
+    return hits[-1]['sort']
+
+
+def context_sentences(context):
+    """ Query for /context: the other sentences in the same document and paragraph """
+    # https://stackoverflow.com/questions/37709100/how-do-i-do-a-partial-match-in-elasticsearch
+    return {
+        "from": 0, "size": 100,
+        "query": match("context", context)
+    }
+
+
+def context_batches(hits, source=None):
+    """ Batches of context_sentences() queries for the distinct contexts of
+        sentence hits, see batch(), each of at most BATCH_LIMIT queries (a
+        page may hold up to SENTENCE_MAX_PAGE_SIZE hits). Hits without a
+        context are skipped.
+        Output:
+            [(keys, queries), ...]
+    """
+    contexts = list(dict.fromkeys(hit['_source'].get('context') for hit in hits if hit['_source'].get('context')))
+    return [batch({'contexts': (contexts[start:start + BATCH_LIMIT], context_sentences)}, source)
+            for start in range(0, len(contexts), BATCH_LIMIT)]
+
+
+def with_paragraphs(hits, keys, results):
+    """ Copies of sentence hits, each with the hits of its context batch query
+        (the other sentences of its paragraph) as 'paragraph'. The hits
+        themselves are not changed: they may be held by the search cache.
+    """
+    paragraphs = keyed(keys, results).get('contexts', {})
+    return [dict(hit, paragraph=paragraphs.get(hit['_source'].get('context'), [])) for hit in hits]
@@ -0,0 +1,103 @@
+import asyncio
+import threading
+
+import metrics
+from search_cache import overlaps
+
+# Coalescing of identical concurrent calls ("single flight"). When a
+# dashboard opens, many clients ask for the same /ships or /stats/ais within
+# milliseconds, before the first answer is in the response cache; the first
+# request makes the Elasticsearch call and the others wait for its result
+# instead of making their own.
+#
+#   flights = SingleFlight()
+#   hits = flights.do((index, 'search', body), fetch)   # fetch() runs once per key at a time
+#
+# Keys start with the index read, so that forget(index) after a write makes
+# later requests start a call of their own rather than join one that may
+# have read the index before the write.
+#
+# https://pkg.go.dev/golang.org/x/sync/singleflight
+
+coalesced = metrics.Counter('single_flight_coalesced_total', 'Calls answered by an identical call already in flight', ('operation',))
+leaders = metrics.Counter('single_flight_calls_total', 'Calls made on behalf of every identical caller', ('operation',))
+
+metrics.REGISTRY.extend([leaders, coalesced])
+
+
+def reads(key, written):
+    """ Whether the call with key reads from the written index (lists and patterns as in SearchCache.invalidate) """
+    return overlaps(key[0], written)
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """ Threads asking for the same key while a call for it runs get that call's result (or error) """
+
+    def __init__(self):
+        self.flights = dict()
+        self.lock = threading.Lock()
+
+    def do(self, key, call, *args, **kwargs):
+        operation = key[1]
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+        if not leader:
+            coalesced.inc(operation)
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        leaders.inc(operation)
+        try:
+            flight.value = call(*args, **kwargs)
+            return flight.value
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self.lock:
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+            flight.done.set()
+
+    def forget(self, index):
+        """ Later calls reading index do not join the ones in flight """
+        with self.lock:
+            for key in [key for key in self.flights if reads(key, index)]:
+                del self.flights[key]
+
+
+class AsyncSingleFlight:
+    """ SingleFlight for coroutines. The call runs as a task of its own, so
+        a caller that is cancelled (a client going away) does not cancel it
+        for the others.
+    """
+
+    def __init__(self):
+        self.flights = dict()
+
+    async def do(self, key, call, *args, **kwargs):
+        operation = key[1]
+        task = self.flights.get(key)
+        if task is None:
+            leaders.inc(operation)
+            task = self.flights[key] = asyncio.ensure_future(call(*args, **kwargs))
+            task.add_done_callback(lambda done: self.flights.pop(key, None) if self.flights.get(key) is done else None)
+        else:
+            coalesced.inc(operation)
+        return await asyncio.shield(task)
+
+    def forget(self, index):
+        for key in [key for key in self.flights if reads(key, index)]:
+            del self.flights[key]
@@ -0,0 +1,34 @@
+# Compact default _source projections for the search endpoints; clients ask
+# for other fields with ?fields=a,b,c or for whole documents with ?fields=*
+# https://www.elastic.co/guide/en/elasticsearch/reference/7.x/search-fields.html#source-filtering
+
+AIS_FIELDS = ['mmsi', 'vessel_name', 'base_date_time', 'lat', 'lon', 'sog', 'cog']
+TLE_FIELDS = ['satellite_number', 'international_designator', 'timestamp', 'text']
+SENTENCE_FIELDS = ['text', 'rhetClass', 'context', 'caseID']
+
+FIELDS_HELP = "comma separated _source fields to return, or * for every field"
+
+
+def source_filter(fields, default=None):
+    """ _source value for a search body.
+        Inputs:
+            fields [str or list]: Requested fields, comma separated or a list; '*' for every field
+            default [list]: Fields returned when none are requested (None for every field)
+        Output:
+            _source [list or bool]: Includes list, or True for the whole document
+    """
+    if isinstance(fields, str):
+        fields = fields.split(',')
+    fields = [str(f).strip() for f in (fields or []) if str(f).strip()]
+    if not fields:
+        return list(default) if default is not None else True
+    if '*' in fields:
+        return True
+    return fields
+
+
+def with_field(source, field):
+    """ source_filter() value that also returns field """
+    if source is True or field in source:
+        return source
+    return source + [field]
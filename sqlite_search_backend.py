@@ -0,0 +1,369 @@
+import os
+import re
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import threading
+import uuid
+
+from index_versions import IndexVersions
+from source_fields import SENTENCE_FIELDS
+
+# Embedded full-text backend for la_main.py, for small deployments and CI
+# without an Elasticsearch cluster:
+#
+#   LA_SEARCH_BACKEND=sqlite LA_SEARCH_DB=la.db python la_main.py
+#   python sqlite_search_backend.py la.db la-sentence sentences.ndjson
+#
+# Each index is a SQLite FTS5 table ranked with BM25. SQLiteSearchWrapper has
+# the read and write methods of ElasticSearchWrapper that la_main.py uses, and
+# takes the same query bodies, as built by search_queries.py: match (or/and),
+# match_phrase, match_all and bool must/filter/must_not, sorted by score (ties
+# are broken by _id here, whatever tiebreaker fields the sort names),
+# search_after, track_total_hits and highlight.
+#
+# https://www.sqlite.org/fts5.html
+# https://www.elastic.co/guide/en/elasticsearch/reference/7.x/query-dsl-match-query.html
+
+DB_PATH = os.environ.get('LA_SEARCH_DB', 'la_search.db')
+
+# Full-text columns of an index; other _source fields are stored but can't be searched
+INDEX_FIELDS = {
+    'la-sentence': SENTENCE_FIELDS,
+    'la-document': ['caseID'],
+}
+
+# ES standard analyzer: lower case words, no stemming
+TOKEN = re.compile(r'\w+', re.UNICODE)
+
+
+def quote(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def terms(text):
+    return ['"{}"'.format(token) for token in TOKEN.findall(str(text or ''))]
+
+
+class QueryError(ValueError):
+    pass
+
+
+def retry_after(error):
+    """ Seconds to wait before trying again when another process holds the
+        database lock, None for other errors; see elastic_search_wrapper.retry_after()
+    """
+    if isinstance(error, sqlite3.OperationalError) and 'locked' in str(error):
+        return 1
+    return None
+
+
+def compile_query(query, fields):
+    """ FTS5 MATCH expression for an ES query, or None for match_all.
+        Raises QueryError for shapes that have no FTS5 equivalent.
+    """
+    if not query or 'match_all' in query:
+        return None
+
+    if 'match' in query or 'match_phrase' in query:
+        kind = 'match' if 'match' in query else 'match_phrase'
+        field, options = next(iter(query[kind].items()))
+        if not isinstance(options, dict):
+            options = {'query': options}
+        if field not in fields:
+            raise QueryError("{} is not a full-text field of this index".format(field))
+        words = terms(options.get('query'))
+        if not words:
+            # ES matches nothing for a query without terms
+            return '{} : ""'.format(quote(field))
+        if kind == 'match_phrase':
+            return '{} : "{}"'.format(quote(field), ' '.join(word.strip('"') for word in words))
+        operator = ' AND ' if str(options.get('operator', 'or')).lower() == 'and' else ' OR '
+        return '{} : ({})'.format(quote(field), operator.join(words))
+
+    if 'bool' in query:
+        clauses = query['bool']
+
+        def listed(kind):
+            value = clauses.get(kind) or []
+            return [value] if isinstance(value, dict) else value
+
+        positive = [compile_query(clause, fields) for clause in listed('must') + listed('filter')]
+        positive = [expression for expression in positive if expression is not None]
+        negative = [compile_query(clause, fields) for clause in listed('must_not')]
+        if None in negative:
+            raise QueryError("must_not match_all matches nothing")
+        should = [compile_query(clause, fields) for clause in listed('should')]
+        if should:
+            if None in should:
+                should = []
+            elif positive:
+                raise QueryError("should next to must/filter is not supported")
+            else:
+                positive = ['(' + ' OR '.join('(' + e + ')' for e in should) + ')']
+
+        expression = ' AND '.join('(' + e + ')' for e in positive)
+        if negative:
+            if not expression:
+                raise QueryError("must_not needs a must, filter or should clause inside another query")
+            expression = '({}) NOT ({})'.format(expression, ' OR '.join('(' + e + ')' for e in negative))
+        return expression or None
+
+    raise QueryError("unsupported query: {}".format(', '.join(query)))
+
+
+def compile_search(query, fields):
+    """ (scoring, filters, excludes) of a top level ES query: the FTS5
+        expression ranked by bm25 (None when nothing scores), expressions
+        rows must also match and expressions rows must not match. filter
+        clauses don't score in ES, so they are kept out of the ranking.
+    """
+    if not query or 'bool' not in query:
+        return compile_query(query, fields), [], []
+    clauses = query['bool']
+
+    def listed(kind):
+        value = clauses.get(kind) or []
+        return [value] if isinstance(value, dict) else value
+
+    scoring, filters, excludes = list(), list(), list()
+    for clause in listed('must'):
+        expression, more, fewer = compile_search(clause, fields)
+        if expression is not None:
+            scoring.append(expression)
+        filters.extend(more)
+        excludes.extend(fewer)
+    for clause in listed('filter'):
+        expression = compile_query(clause, fields)
+        if expression is not None:
+            filters.append(expression)
+    for clause in listed('must_not'):
+        expression = compile_query(clause, fields)
+        if expression is None:
+            raise QueryError("must_not match_all matches nothing")
+        excludes.append(expression)
+    should = [compile_query(clause, fields) for clause in listed('should')]
+    if should and None not in should:
+        if scoring or filters:
+            raise QueryError("should next to must/filter is not supported")
+        scoring = ['(' + ' OR '.join('(' + e + ')' for e in should) + ')']
+
+    expression = ' AND '.join('(' + e + ')' for e in scoring) if scoring else None
+    return expression, filters, excludes
+
+
+class SQLiteSearchWrapper:
+    """ ElasticSearchWrapper look-alike over a SQLite database of FTS5 tables.
+        Connections are per thread; the database may be shared by processes.
+    """
+    local = threading.local()
+    versions = IndexVersions(ttl=float(os.environ.get('ES_STATS_TTL', 10)))
+
+    def __init__(self, path=None):
+        self.path = path or DB_PATH
+
+    @property
+    def db(self):
+        connections = getattr(self.local, 'connections', None)
+        if connections is None:
+            connections = self.local.connections = dict()
+        if self.path not in connections:
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            connections[self.path] = db
+        return connections[self.path]
+
+    def fields(self, index):
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info({})'.format(quote(index)))]
+        if not columns:
+            raise QueryError("no such index: {}".format(index))
+        return [column for column in columns if column not in ('_id', '_source')]
+
+    def create_index(self, index, fields=None):
+        fields = fields or INDEX_FIELDS.get(index, SENTENCE_FIELDS)
+        columns = ', '.join(['_id UNINDEXED', '_source UNINDEXED'] + [quote(field) for field in fields])
+        with self.db:
+            self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5({}, tokenize='unicode61')".format(quote(index), columns))
+            # _id -> rowid of the FTS5 table, which can't index _id itself
+            self.db.execute('CREATE TABLE IF NOT EXISTS {} (_id TEXT PRIMARY KEY)'.format(quote(index + '__ids')))
+        self.versions.invalidate(index)
+
+    def delete_index(self, index):
+        with self.db:
+            self.db.execute('DROP TABLE IF EXISTS {}'.format(quote(index)))
+            self.db.execute('DROP TABLE IF EXISTS {}'.format(quote(index + '__ids')))
+        self.versions.invalidate(index)
+
+    def bulk(self, index, documents, max_retries=3, initial_backoff=2):
+        """ Index documents ({'_id': ..., '_source': ...} or plain dicts) in
+            one transaction; same result as ElasticSearchWrapper.bulk()
+        """
+        self.create_index(index)
+        fields = self.fields(index)
+        table = quote(index)
+        ids = quote(index + '__ids')
+        insert = 'INSERT INTO {} (rowid, _id, _source, {}) VALUES ({})'.format(
+            table, ', '.join(quote(field) for field in fields), ', '.join('?' * (len(fields) + 3)))
+        indexed = 0
+        errors = list()
+        with self.db:
+            for document in documents:
+                action = document if '_source' in document else {'_source': document}
+                source = action['_source']
+                id = str(action['_id']) if action.get('_id') is not None else uuid.uuid4().hex
+                try:
+                    self.db.execute('INSERT OR IGNORE INTO {} (_id) VALUES (?)'.format(ids), (id,))
+                    row = self.db.execute('SELECT rowid FROM {} WHERE _id = ?'.format(ids), (id,)).fetchone()[0]
+                    self.db.execute('DELETE FROM {} WHERE rowid = ?'.format(table), (row,))
+                    values = [source.get(field) for field in fields]
+                    values = [value if value is None or isinstance(value, str) else json.dumps(value) for value in values]
+                    self.db.execute(insert, [row, id, json.dumps(source, default=str)] + values)
+                    indexed += 1
+                except (sqlite3.Error, TypeError, ValueError, AttributeError) as error:
+                    errors.append({'index': {'_id': id, 'error': str(error)}})
+        self.versions.invalidate(index)
+        return indexed, errors
+
+    def add_item(self, index, id, data):
+        indexed, errors = self.bulk(index, [{'_id': id, '_source': data}])
+        return {'_index': index, '_id': str(id), 'result': 'created' if indexed else errors}
+
+    def delete_by_ids(self, index, ids):
+        deleted = 0
+        with self.db:
+            for id in ids:
+                row = self.db.execute('SELECT rowid FROM {} WHERE _id = ?'.format(quote(index + '__ids')), (str(id),)).fetchone()
+                if row is not None:
+                    self.db.execute('DELETE FROM {} WHERE rowid = ?'.format(quote(index)), row)
+                    self.db.execute('DELETE FROM {} WHERE rowid = ?'.format(quote(index + '__ids')), row)
+                    deleted += 1
+        self.versions.invalidate(index)
+        return {'deleted': deleted}
+
+    def smoketest(self):
+        index = 'smoke-index'
+        self.delete_index(index)
+        done = self.add_item(index, 1, {'text': 'smoketest', 'timestamp': time.time()})
+        res = self.search(index, {"query": {"match": {"text": {"query": "smoketest"}}}})
+        return res, done
+
+    def search_page(self, index, query):
+        """ Hits and total of a search, see ElasticSearchWrapper.search_page() """
+        fields = self.fields(index)
+        expression, filters, excludes = compile_search(query.get('query'), fields)
+        table = quote(index)
+
+        # ES gives hits of a query without scoring clauses (only filter or
+        # must_not) a score of 0, and match_all hits a score of 1
+        score = '-bm25({})'.format(table) if expression is not None else '0.0' if filters or excludes else '1.0'
+        conditions = ['{} MATCH ?'.format(table)] if expression is not None else []
+        params = [expression] if expression is not None else []
+        for clause in filters:
+            conditions.append('rowid IN (SELECT rowid FROM {0} WHERE {0} MATCH ?)'.format(table))
+            params.append(clause)
+        if excludes:
+            conditions.append('rowid NOT IN (SELECT rowid FROM {0} WHERE {0} MATCH ?)'.format(table))
+            params.append(' OR '.join('(' + e + ')' for e in excludes))
+        matching = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+
+        sort = [next(iter(s)) if isinstance(s, dict) else s for s in query.get('sort') or []]
+        if sort and sort[0] != '_score':
+            raise QueryError("only sorting by _score is supported")
+
+        highlight = (query.get('highlight') or {}).get('fields', {})
+        highlighted = [field for field in highlight if field in fields] if expression is not None else []
+        columns = ['_id', '_source', score + ' AS score']
+        for field in highlighted:
+            # fragment_size is in characters in ES and in tokens here
+            tokens = max(1, min(64, int(highlight[field].get('fragment_size', 100)) // 6))
+            pre = (query['highlight'].get('pre_tags') or ['<em>'])[0].replace("'", "''")
+            post = (query['highlight'].get('post_tags') or ['</em>'])[0].replace("'", "''")
+            columns.append("snippet({}, {}, '{}', '{}', '...', {})".format(table, fields.index(field) + 2, pre, post, tokens))
+
+        sql = 'SELECT * FROM (SELECT {} FROM {}{})'.format(', '.join(columns), table, matching)
+        after = query.get('search_after')
+        pageParams = list()
+        if after is not None:
+            sql += ' WHERE score < ? OR (score = ? AND _id > ?)'
+            pageParams.extend([after[0], after[0], str(after[1]) if len(after) > 1 else ''])
+        sql += ' ORDER BY score DESC, _id ASC LIMIT ? OFFSET ?'
+        pageParams.extend([int(query.get('size', 10)), int(query.get('from', 0))])
+        rows = self.db.execute(sql, params + pageParams).fetchall()
+
+        source = query.get('_source', True)
+        hits = list()
+        for row in rows:
+            document = json.loads(row[1])
+            if isinstance(source, list):
+                document = {field: document[field] for field in source if field in document}
+            elif source is False:
+                document = {}
+            hit = {'_index': index, '_id': row[0], '_score': row[2], '_source': document}
+            if sort:
+                hit['sort'] = [row[2], row[0]]
+            snippets = {field: [snippet] for field, snippet in zip(highlighted, row[3:]) if snippet}
+            if snippets:
+                hit['highlight'] = snippets
+            hits.append(hit)
+
+        track = query.get('track_total_hits', 10000)
+        total = None
+        if track is not False:
+            limit = '' if track is True else ' LIMIT {}'.format(int(track))
+            count = self.db.execute('SELECT count(*) FROM (SELECT 1 FROM {}{}{})'.format(table, matching, limit), params).fetchone()[0]
+            reached = track is not True and count >= int(track)
+            total = {'value': count, 'relation': 'gte' if reached else 'eq'}
+        return hits, total
+
+    def search(self, index, query):
+        hits, total = self.search_page(index, query)
+        return hits
+
+    def msearch(self, index, queries):
+        return [self.search(index, query) for query in queries]
+
+    def cache_stats(self):
+        return {'backend': 'sqlite', 'path': self.path}
+
+    def stats(self, index):
+        """ The parts of an indices.stats() response that index_versions.summarize() reads """
+        table = quote(index)
+        count = self.db.execute('SELECT count(*) FROM {}'.format(table)).fetchone()[0]
+        changes = self.db.execute('SELECT max(rowid) FROM {}'.format(table)).fetchone()[0] or 0
+        page_size = self.db.execute('PRAGMA page_size').fetchone()[0]
+        pages = self.db.execute('PRAGMA page_count').fetchone()[0]
+        primaries = {'docs': {'count': count, 'deleted': 0},
+                     'store': {'size_in_bytes': page_size * pages},
+                     'indexing': {'index_total': changes, 'delete_total': changes - count}}
+        return {'indices': {index: {'primaries': primaries, 'total': primaries}}}
+
+    def index_version(self, index):
+        version = self.versions.get(index)
+        if version is None:
+            version = self.versions.put(index, self.stats(index))
+        return version
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load CSV/JSON/NDJSON documents into a SQLite full-text index for la_main.py')
+    parser.add_argument('db')
+    parser.add_argument('index')
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--id-field', default=None, help='document field to use as _id')
+    parser.add_argument('--fields', default=None, help='comma separated full-text fields (default: {})'.format(','.join(SENTENCE_FIELDS)))
+    args = parser.parse_args(argv)
+
+    from bulk_ingest import read_documents, actions
+    es = SQLiteSearchWrapper(args.db)
+    es.create_index(args.index, args.fields.split(',') if args.fields else None)
+    start = time.monotonic()
+    indexed, errors = es.bulk(args.index, actions(read_documents(args.paths), args.id_field))
+    print(json.dumps({'index': args.index, 'indexed': indexed, 'failed': len(errors), 'errors': errors[:10],
+                      'seconds': time.monotonic() - start}, indent=2))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,32 +4,17 @@ import os
 
 from datetime import datetime
 from elastic_search_wrapper import ElasticSearchWrapper
+from bulk_ingest import ingest
 
 # https://www.elastic.co/guide/en/elasticsearch/reference/current/cat-indices.html
 # https://www.elastic.co/guide/en/elasticsearch/reference/current/docker.html
 
 
 
-def elasticsearch_publish():
-
-    #  https://elasticsearch-py.readthedocs.io/en/master/
-    # by default we connect to localhost:9200
-    es = ElasticSearchWrapper()
-
-
-    infoIndex = 'vault-info'
-    es.delete_index(infoIndex)
-    
-    es.create_index(infoIndex)  # ignore if exist
-    
-
-    
-    
+def read_files(data_path):
     # Getting the list of files in <data_path>:
-    data_path = './data/vault'
     list_of_files = os.listdir(data_path)
 
-    # ...and creating new lists for the texts of the sentences...
     documentCount = 0
     
     print(list_of_files)
@@ -38,16 +23,35 @@ def elasticsearch_publish():
         print ( f"{data_path}/{filename}" )
 
         # ... and opening the given filename...
-        file = open(f"{data_path}/{filename}")
-        
         try:
-            # ...using the json file loader to translate the json data...
-            data = json.load(file)
-            res = es.add_item(infoIndex, documentCount, data)
+            with open(f"{data_path}/{filename}") as file:
+                # ...using the json file loader to translate the json data...
+                data = json.load(file)
+            yield {'_id': documentCount, '_source': data}
 
             documentCount += 1
 
         except Exception as ex:
             print(ex)
+
+
+def elasticsearch_publish():
+
+    #  https://elasticsearch-py.readthedocs.io/en/master/
+    # by default we connect to localhost:9200
+    es = ElasticSearchWrapper()
+
+
+    infoIndex = 'vault-info'
+    es.delete_index(infoIndex)
+    
+    es.create_index(infoIndex)  # ignore if exist
+    
+
+    
+    
+    # each file is one document; they go in with bulk requests, see bulk_ingest.py
+    report = ingest(es, infoIndex, read_files('./data/vault'), threads=2, chunk_size=100)
+    print(report)
             
 elasticsearch_publish()